@@ -1,36 +1,113 @@
-from flask import Flask, jsonify, request, Response
+from flask import Flask, request
 import os
-from app.extensions import db
+from app.extensions import db, init_engine
 from dotenv import load_dotenv
-from app.models import Coin, Duty, Ksb
-import json
+from app.models import Coin, Duty, Ksb, coins_duties, duties_ksbs
+from app.batch import BatchSpec, Link, apply_batch, delete_batch
+from app.fieldsets import InvalidFieldset, Shape
+from app.pagination import is_paginated, paginated_response
+from app.search import COIN_SEARCH, DUTY_SEARCH, KSB_SEARCH, SEARCHABLES, search_params
+from app.streaming import list_response
+from app.versioning import bump, conditional
+from app.changes import ChangesCompacted, change_params, current_seq, read_changes, record
+from app.response_cache import response_cache, cached, coin_tags, duty_tags, graph_tags, ksb_tags
+from app.serialization import json_response
+from http_compression import init_compression
+from metrics import init_metrics
+from app.query_stats import init_query_stats
+from app.seed import seed_command
+from app.migrations import has_string_keys, migrate_to_integer_keys
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
 
 app = Flask(__name__)
 
 if not app.config.get("SQLALCHEMY_DATABASE_URI"):
     app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("db_url")
 
-db.init_app(app)
+init_engine(app)
+app.cli.add_command(seed_command)
+init_query_stats(app, db)
+init_metrics(app)
+init_compression(app, variants=response_cache)
 
 load_dotenv()
 
+COIN_TABLES = ("coins", "coins_duties", "duties")
+DUTY_TABLES = ("duties", "duties_ksbs", "ksbs")
+KSB_TABLES = ("ksbs",)
+GRAPH_TABLES = ("coins", "coins_duties", "duties", "duties_ksbs", "ksbs")
+
+KSB_SHAPE = Shape(Ksb, {"id": "id", "ksb_name": "ksb_name"})
+DUTY_SHAPE = Shape(
+    Duty,
+    {"id": "id", "duty_name": "duty_name", "description": "duty_description"},
+    relations={"ksbs": ("ksbs", KSB_SHAPE)},
+    default_include=("ksbs",),
+)
+COIN_SHAPE = Shape(
+    Coin,
+    {"id": "id", "coin_name": "coin_name"},
+    relations={"duties": ("duties", DUTY_SHAPE)},
+    default_include=("duties",),
+)
+
+COIN_BATCH = BatchSpec(
+    Coin,
+    "Coin",
+    fields={"coin_name": "coin_name"},
+    required="coin_name",
+    entity_tag="coin",
+    unique=("coin_name",),
+    link=Link("duty_ids", coins_duties, "coin_pk", "duty_pk", Duty.__table__),
+    reverse_tag="duty.coins",
+    cascades=((coins_duties, "coin_pk"),),
+)
+DUTY_BATCH = BatchSpec(
+    Duty,
+    "Duty",
+    fields={"duty_name": "duty_name", "description": "duty_description"},
+    required="duty_name",
+    entity_tag="duty",
+    unique=("duty_name", "duty_description"),
+    link=Link("ksb_ids", duties_ksbs, "duty_pk", "ksb_pk", Ksb.__table__),
+    link_tag="duty.ksbs",
+    reverse_tag="ksb.duties",
+    cascades=((coins_duties, "duty_pk"), (duties_ksbs, "duty_pk")),
+)
+KSB_BATCH = BatchSpec(
+    Ksb,
+    "Ksb",
+    fields={"ksb_name": "ksb_name"},
+    required="ksb_name",
+    entity_tag="ksb",
+    unique=("ksb_name",),
+    cascades=((duties_ksbs, "ksb_pk"),),
+)
+
 
 @app.get("/coins")
+@conditional(*COIN_TABLES)
+@cached("coins", coin_tags)
 def get_coins():
-    coins = Coin.query.all()
-    data = [coin.to_dict(include_duties=True) for coin in coins]
-    return Response(json.dumps(data, sort_keys=False), mimetype="application/json")
+    fieldset = COIN_SHAPE.parse(request.args)
+    statement = fieldset.statement()
+    if "q" in request.args:
+        return search_response(COIN_SEARCH, fieldset)
+    if is_paginated(request.args):
+        return paginated_response(statement, Coin.pk, fieldset.serialize_rows)
+    return list_response(statement, fieldset.serialize_rows)
 
 
 @app.get("/coins/<ID>")
+@conditional(*COIN_TABLES)
+@cached("coins", coin_tags)
 def get_coin_by_id(ID):
-    coin = Coin.query.filter_by(id=ID).first()
+    fieldset = COIN_SHAPE.parse(request.args)
+    coin = db.session.execute(fieldset.statement().where(Coin.id == ID)).first()
     if not coin:
-        return jsonify({"error": "Coin not found"}), 404
-    return Response(
-        json.dumps(coin.to_dict(include_duties=True), sort_keys=False),
-        mimetype="application/json",
-    )
+        return json_response({"error": "Coin not found"}, 404)
+    return json_response(fieldset.serialize_rows([coin])[0])
 
 
 @app.post("/coins")
@@ -44,59 +121,106 @@ def create_coin():
     if duty_ids:
         duties = Duty.query.filter(Duty.id.in_(duty_ids)).all()
         new_coin.duties = duties
+        bump("coins_duties")
 
     db.session.add(new_coin)
+    bump("coins")
+    db.session.flush()
+    record("coins", upserts=[new_coin.id])
+    record("coins_duties", upserts=[(new_coin.id, duty.id) for duty in new_coin.duties])
     db.session.commit()
-    return jsonify(new_coin.to_dict()), 201
+    response_cache.invalidate("coins", *(("duty.coins", id) for id in duty_ids))
+    return json_response(new_coin.to_dict(), 201)
+
+
+@app.post("/coins/batch")
+def batch_coins():
+    return apply_batch(COIN_BATCH, request.json)
+
+
+@app.delete("/coins")
+def delete_coins():
+    return delete_batch(COIN_BATCH, request.args.get("ids", ""))
 
 
 @app.put("/coins/<ID>")
 def update_coin(ID):
     data = request.json
-    coin = Coin.query.filter_by(id=ID).first()
+    coin = Coin.query.options(selectinload(Coin.duties)).filter_by(id=ID).first()
 
     if "coin_name" in data:
         coin.coin_name = data["coin_name"]
+        bump("coins")
+        record("coins", upserts=[ID])
+
+    changed = [("coin", ID)]
 
     if "duty_ids" in data:
         duty_ids = data["duty_ids"]
 
         new_duties = Duty.query.filter(Duty.id.in_(duty_ids)).all()
+        old_ids, new_ids = {duty.id for duty in coin.duties}, {duty.id for duty in new_duties}
         coin.duties = new_duties
+        bump("coins_duties")
+        record(
+            "coins_duties",
+            upserts=[(ID, id) for id in new_ids - old_ids],
+            deletes=[(ID, id) for id in old_ids - new_ids],
+        )
+        changed.extend(("duty.coins", id) for id in old_ids ^ new_ids)
 
     db.session.commit()
-    return Response(
-        json.dumps(coin.to_dict(include_duties=True), sort_keys=False),
-        mimetype="application/json",
-    )
+    response_cache.invalidate(*changed)
+    return json_response(coin.to_dict(include_duties=True))
 
 
 @app.delete("/coins/<ID>")
 def delete_coin(ID):
     coin = Coin.query.filter_by(id=ID).first()
     if not coin:
-        return jsonify({"error": "Coin not found"}), 404
+        return json_response({"error": "Coin not found"}, 404)
     db.session.delete(coin)
+    bump("coins", "coins_duties")
+    record("coins", deletes=[ID])
     db.session.commit()
-    return jsonify({"message": "deleted"}), 200
+    response_cache.invalidate(("coin", ID))
+    return json_response({"message": "deleted"}, 200)
 
 
 @app.get("/duties")
+@conditional(*DUTY_TABLES)
+@cached("duties", duty_tags)
 def get_duties():
-    duties = Duty.query.all()
-    data = [duty.to_dict(include_ksbs=True) for duty in duties]
-    return Response(json.dumps(data, sort_keys=False), mimetype="application/json")
+    fieldset = DUTY_SHAPE.parse(request.args)
+    statement = fieldset.statement()
+    if "q" in request.args:
+        return search_response(DUTY_SEARCH, fieldset)
+    if is_paginated(request.args):
+        return paginated_response(statement, Duty.pk, fieldset.serialize_rows)
+    return list_response(statement, fieldset.serialize_rows)
 
 
 @app.get("/duties/<ID>")
+@conditional(*DUTY_TABLES)
+@cached("duties", duty_tags)
 def get_duties_by_id(ID):
-    duty = Duty.query.filter_by(id=ID).first()
+    fieldset = DUTY_SHAPE.parse(request.args)
+    duty = db.session.execute(fieldset.statement().where(Duty.id == ID)).first()
     if not duty:
-        return jsonify({"error": "Duty not found"}), 404
-    return Response(
-        json.dumps(duty.to_dict(include_ksbs=True), sort_keys=False),
-        mimetype="application/json",
-    )
+        return json_response({"error": "Duty not found"}, 404)
+    return json_response(fieldset.serialize_rows([duty])[0])
+
+
+@app.get("/duties/<ID>/coins")
+@conditional(*COIN_TABLES)
+@cached(None, coin_tags, lambda ID: {("duty", ID), ("duty.coins", ID)})
+def get_duty_coins(ID):
+    duty_pk = db.session.query(Duty.pk).filter_by(id=ID).scalar()
+    if duty_pk is None:
+        return json_response({"error": "Duty not found"}, 404)
+    coins = Coin.query.join(coins_duties).filter(coins_duties.c.duty_pk == duty_pk).all()
+    data = [coin.to_dict() for coin in coins]
+    return json_response(data)
 
 
 @app.post("/duties")
@@ -110,57 +234,106 @@ def create_duty():
     if ksb_ids:
         ksbs = Ksb.query.filter(Ksb.id.in_(ksb_ids)).all()
         new_duty.ksbs = ksbs
+        bump("duties_ksbs")
 
     db.session.add(new_duty)
+    bump("duties")
+    db.session.flush()
+    record("duties", upserts=[new_duty.id])
+    record("duties_ksbs", upserts=[(new_duty.id, ksb.id) for ksb in new_duty.ksbs])
     db.session.commit()
-    return jsonify(new_duty.to_dict()), 201
+    response_cache.invalidate("duties", *(("ksb.duties", id) for id in ksb_ids))
+    return json_response(new_duty.to_dict(), 201)
+
+
+@app.post("/duties/batch")
+def batch_duties():
+    return apply_batch(DUTY_BATCH, request.json)
+
+
+@app.delete("/duties")
+def delete_duties():
+    return delete_batch(DUTY_BATCH, request.args.get("ids", ""))
 
 
 @app.put("/duties/<ID>")
 def update_duty(ID):
     data = request.json
-    duty = Duty.query.filter_by(id=ID).first()
+    duty = Duty.query.options(selectinload(Duty.ksbs)).filter_by(id=ID).first()
+    changed = []
 
     if "duty_name" in data:
         duty.duty_name = data["duty_name"]
+        bump("duties")
+        record("duties", upserts=[ID])
+        changed.append(("duty", ID))
 
     if "ksb_ids" in data:
         ksb_ids = data["ksb_ids"]
         new_ksbs = Ksb.query.filter(Ksb.id.in_(ksb_ids)).all()
+        old_ids, new_ids = {ksb.id for ksb in duty.ksbs}, {ksb.id for ksb in new_ksbs}
         duty.ksbs = new_ksbs
+        bump("duties_ksbs")
+        record(
+            "duties_ksbs",
+            upserts=[(ID, id) for id in new_ids - old_ids],
+            deletes=[(ID, id) for id in old_ids - new_ids],
+        )
+        changed.append(("duty.ksbs", ID))
+        changed.extend(("ksb.duties", id) for id in old_ids ^ new_ids)
 
     db.session.commit()
-    return Response(
-        json.dumps(duty.to_dict(include_ksbs=True), sort_keys=False),
-        mimetype="application/json",
-    )
+    response_cache.invalidate(*changed)
+    return json_response(duty.to_dict(include_ksbs=True))
 
 
 @app.delete("/duties/<ID>")
 def delete_duty(ID):
     duty = Duty.query.filter_by(id=ID).first()
     if not duty:
-        return jsonify({"error": "Duty not found"}), 404
+        return json_response({"error": "Duty not found"}, 404)
     db.session.delete(duty)
+    bump("duties", "coins_duties", "duties_ksbs")
+    record("duties", deletes=[ID])
     db.session.commit()
-    return jsonify({"message": "deleted"}), 200
+    response_cache.invalidate(("duty", ID), ("duty.ksbs", ID))
+    return json_response({"message": "deleted"}, 200)
 
 
 @app.get("/ksbs")
+@conditional(*KSB_TABLES)
+@cached("ksbs", ksb_tags)
 def get_ksbs():
-    ksbs = Ksb.query.all()
-    data = [ksb.to_dict() for ksb in ksbs]
-    return Response(json.dumps(data, sort_keys=False), mimetype="application/json")
+    fieldset = KSB_SHAPE.parse(request.args)
+    statement = fieldset.statement()
+    if "q" in request.args:
+        return search_response(KSB_SEARCH, fieldset)
+    if is_paginated(request.args):
+        return paginated_response(statement, Ksb.pk, fieldset.serialize_rows)
+    return list_response(statement, fieldset.serialize_rows)
 
 
 @app.get("/ksbs/<ID>")
+@conditional(*KSB_TABLES)
+@cached("ksbs", ksb_tags)
 def get_ksb_by_id(ID):
-    ksb = Ksb.query.filter_by(id=ID).first()
+    fieldset = KSB_SHAPE.parse(request.args)
+    ksb = db.session.execute(fieldset.statement().where(Ksb.id == ID)).first()
     if not ksb:
-        return jsonify({"error": "Ksb not found"}), 404
-    return Response(
-        json.dumps(ksb.to_dict(), sort_keys=False), mimetype="application/json"
-    )
+        return json_response({"error": "Ksb not found"}, 404)
+    return json_response(fieldset.serialize_rows([ksb])[0])
+
+
+@app.get("/ksbs/<ID>/duties")
+@conditional(*DUTY_TABLES)
+@cached(None, duty_tags, lambda ID: {("ksb", ID), ("ksb.duties", ID)})
+def get_ksb_duties(ID):
+    ksb_pk = db.session.query(Ksb.pk).filter_by(id=ID).scalar()
+    if ksb_pk is None:
+        return json_response({"error": "Ksb not found"}, 404)
+    duties = Duty.query.join(duties_ksbs).filter(duties_ksbs.c.ksb_pk == ksb_pk).all()
+    data = [duty.to_dict() for duty in duties]
+    return json_response(data)
 
 
 @app.post("/ksbs")
@@ -169,8 +342,22 @@ def create_ksb():
     ksb_name = data["ksb_name"]
     new_ksb = Ksb(ksb_name=ksb_name)
     db.session.add(new_ksb)
+    bump("ksbs")
+    db.session.flush()
+    record("ksbs", upserts=[new_ksb.id])
     db.session.commit()
-    return jsonify(new_ksb.to_dict()), 201
+    response_cache.invalidate("ksbs")
+    return json_response(new_ksb.to_dict(), 201)
+
+
+@app.post("/ksbs/batch")
+def batch_ksbs():
+    return apply_batch(KSB_BATCH, request.json)
+
+
+@app.delete("/ksbs")
+def delete_ksbs():
+    return delete_batch(KSB_BATCH, request.args.get("ids", ""))
 
 
 @app.put("/ksbs/<ID>")
@@ -178,24 +365,135 @@ def update_ksb(ID):
     new_name = request.json["ksb_name"]
     ksb = Ksb.query.filter_by(id=ID).first()
     ksb.ksb_name = new_name
+    bump("ksbs")
+    record("ksbs", upserts=[ID])
     db.session.commit()
-    return Response(
-        json.dumps(ksb.to_dict(), sort_keys=False), mimetype="application/json"
-    )
+    response_cache.invalidate(("ksb", ID))
+    return json_response(ksb.to_dict())
 
 
 @app.delete("/ksbs/<ID>")
 def delete_ksb(ID):
     ksb = Ksb.query.filter_by(id=ID).first()
     if not ksb:
-        return jsonify({"error": "Ksb not found"}), 404
+        return json_response({"error": "Ksb not found"}, 404)
     db.session.delete(ksb)
+    bump("ksbs", "duties_ksbs")
+    record("ksbs", deletes=[ID])
     db.session.commit()
-    return jsonify({"message": "deleted"}), 200
-
-
-with app.app_context():
-    db.create_all()
+    response_cache.invalidate(("ksb", ID))
+    return json_response({"message": "deleted"}, 200)
+
+
+def search_response(searchable, fieldset):
+    try:
+        q, limit = search_params(request.args)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+    return json_response(fieldset.serialize_rows(searchable.search(fieldset.statement(), q, limit)))
+
+
+@app.get("/search")
+@conditional("coins", "duties", "ksbs")
+def search():
+    try:
+        q, limit = search_params(request.args)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+    results = {}
+    for name, searchable, shape in (
+        ("coins", COIN_SEARCH, COIN_SHAPE),
+        ("duties", DUTY_SEARCH, DUTY_SHAPE),
+        ("ksbs", KSB_SEARCH, KSB_SHAPE),
+    ):
+        fieldset = shape.parse({"include": ""})
+        results[name] = fieldset.serialize_rows(searchable.search(fieldset.statement(), q, limit))
+    return json_response(results)
+
+
+@app.get("/graph")
+@conditional(*GRAPH_TABLES)
+@cached(None, graph_tags)
+def get_graph():
+    # Every coin, duty and KSB once, without nested copies, plus the links
+    # as [owner id, target id] pairs: five queries, and a payload that grows
+    # with entities plus links rather than coins x duties. seq is where to
+    # start reading GET /changes from; it is read first, so a write landing
+    # in between is replayed rather than missed.
+    graph = {"seq": current_seq(db.session)}
+    for name, shape in (("coins", COIN_SHAPE), ("duties", DUTY_SHAPE), ("ksbs", KSB_SHAPE)):
+        fieldset = shape.parse({"include": ""})
+        rows = db.session.execute(fieldset.statement().order_by(shape.table.c.pk)).all()
+        graph[name] = fieldset.serialize_rows(rows)
+    for name, link, owner, target in (
+        ("coins_duties", coins_duties, Coin, Duty),
+        ("duties_ksbs", duties_ksbs, Duty, Ksb),
+    ):
+        owner_pk, target_pk = link.c
+        statement = (
+            select(owner.id, target.id)
+            .join_from(link, owner, owner.pk == owner_pk)
+            .join(target, target.pk == target_pk)
+            .order_by(owner_pk, target_pk)
+        )
+        graph[name] = [list(row) for row in db.session.execute(statement)]
+    return json_response(graph)
+
+
+@app.get("/changes")
+def get_changes():
+    # Upserts carry current rows (links as [owner id, target id] pairs) and
+    # deletes carry ids, in the /graph layout. A deleted coin, duty or KSB
+    # takes its links with it; they are not listed separately. 410 means the
+    # cursor is older than the compacted log, or from a log since recreated:
+    # reload /graph.
+    try:
+        since, limit = change_params(request.args)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+    try:
+        next_seq, more, latest = read_changes(since, limit)
+    except ChangesCompacted:
+        return json_response({"error": "since is outside the change log, reload /graph"}, 410)
+
+    upserts = {name: [] for name in GRAPH_TABLES}
+    deletes = {name: [] for name in GRAPH_TABLES}
+    for (table_name, entity_id, target_id), deleted in latest.items():
+        key = entity_id if target_id is None else [entity_id, target_id]
+        (deletes if deleted else upserts)[table_name].append(key)
+    for name, shape in (("coins", COIN_SHAPE), ("duties", DUTY_SHAPE), ("ksbs", KSB_SHAPE)):
+        if upserts[name]:
+            fieldset = shape.parse({"include": ""})
+            statement = fieldset.statement().where(shape.table.c.id.in_(upserts[name]))
+            upserts[name] = fieldset.serialize_rows(db.session.execute(statement.order_by(shape.table.c.pk)).all())
+    return json_response({"since": since, "next": next_seq, "more": more, "upserts": upserts, "deletes": deletes})
+
+
+@app.errorhandler(InvalidFieldset)
+def invalid_fieldset(error):
+    return json_response({"error": str(error)}, 400)
+
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    return json_response(response_cache.stats())
+
+
+def create_schema():
+    # Run once per deployment (gunicorn calls it in the master before forking
+    # workers), not on every import.
+    with app.app_context():
+        with db.engine.begin() as connection:
+            if has_string_keys(connection):
+                migrate_to_integer_keys(connection)
+        db.create_all()
+        with db.engine.begin() as connection:
+            for searchable in SEARCHABLES:
+                searchable.ensure_index(connection)
+
+
+app.cli.command("create-schema")(create_schema)
 
 if __name__ == "__main__":
+    create_schema()
     app.run(debug=True)
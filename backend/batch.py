@@ -0,0 +1,228 @@
+from sqlalchemy import bindparam, delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from app.extensions import db
+from app.response_cache import response_cache
+from app.serialization import json_response
+from app.versioning import bump
+from app.changes import record
+import uuid
+
+
+class Link:
+    def __init__(self, key, table, owner_column, target_column, target):
+        self.key = key
+        self.table = table
+        self.owner_column = owner_column
+        self.target_column = target_column
+        self.target = target
+
+
+class BatchSpec:
+    def __init__(
+        self,
+        model,
+        label,
+        fields,
+        required,
+        entity_tag,
+        unique=(),
+        link=None,
+        link_tag=None,
+        reverse_tag=None,
+        cascades=(),
+    ):
+        self.table = model.__table__
+        self.label = label
+        self.fields = fields
+        self.required = required
+        self.entity_tag = entity_tag
+        self.unique = unique
+        self.link = link
+        self.link_tag = link_tag or entity_tag
+        self.reverse_tag = reverse_tag
+        self.cascades = cascades
+
+
+def select_in(columns, column, values):
+    values = list(values)
+    if not values:
+        return []
+    return db.session.execute(select(*columns).where(column.in_(values))).all()
+
+
+def apply_batch(spec, items):
+    # Validate every item up front, resolve all referenced IDs and unique
+    # values with one query each, then write the valid items with executemany
+    # statements and a single commit. Invalid items are reported and skipped.
+    if not isinstance(items, list):
+        return json_response({"error": "Expected a JSON array"}, 400)
+
+    table = spec.table
+    results = [None] * len(items)
+    pending = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = {"index": index, "error": "Expected an object"}
+            continue
+        if item.get(spec.required) is None and ("id" not in item or spec.required in item):
+            results[index] = {"index": index, "error": f"{spec.required} is required"}
+            continue
+        if "id" in item and not isinstance(item["id"], str):
+            results[index] = {"index": index, "error": "id must be a string"}
+            continue
+        invalid = [
+            key for key in spec.fields if key in item and not isinstance(item[key], (str, type(None)))
+        ]
+        if invalid:
+            results[index] = {"index": index, "error": f"{invalid[0]} must be a string"}
+            continue
+        links = item.get(spec.link.key) if spec.link else None
+        if links is not None and not (isinstance(links, list) and all(isinstance(id, str) for id in links)):
+            results[index] = {"index": index, "error": f"{spec.link.key} must be a list of ids"}
+            continue
+        row = {column: item[key] for key, column in spec.fields.items() if key in item}
+        pending.append((index, item.get("id"), row, links))
+
+    # Public ids are resolved to surrogate keys once, for the owners being
+    # updated and for every link target.
+    update_ids = {id for _, id, _, _ in pending if id}
+    existing_ids = dict(select_in([table.c.id, table.c.pk], table.c.id, update_ids))
+
+    known_targets = {}
+    if spec.link:
+        wanted = {target for _, _, _, links in pending for target in links or ()}
+        target = spec.link.target
+        known_targets = dict(select_in([target.c.id, target.c.pk], target.c.id, wanted))
+
+    owners = {}
+    for column in spec.unique:
+        values = {row[column] for _, _, row, _ in pending if row.get(column) is not None}
+        owners[column] = dict(select_in([table.c[column], table.c.id], table.c[column], values))
+
+    creates, updates, link_rows, relinked = [], [], [], []
+    for index, id, row, links in pending:
+        error = None
+        if id and id not in existing_ids:
+            error = f"{spec.label} not found"
+        for column in spec.unique:
+            value = row.get(column)
+            if error or value is None:
+                continue
+            owner = owners[column].get(value)
+            if owner is not None and owner != id:
+                error = f"{column} '{value}' already exists"
+        if not error and links:
+            unknown = sorted(set(links) - known_targets.keys())
+            if unknown:
+                error = f"Unknown {spec.link.key}: {', '.join(unknown)}"
+        if error:
+            results[index] = {"index": index, "error": error}
+            continue
+
+        if id:
+            if row:
+                updates.append({"_id": id, **row})
+            status = "updated"
+        else:
+            id = str(uuid.uuid4())
+            creates.append({"id": id, **dict.fromkeys(spec.fields.values()), **row})
+            status = "created"
+        for column in spec.unique:
+            if row.get(column) is not None:
+                owners[column][row[column]] = id
+        if links is not None:
+            relinked.append(id)
+            link_rows.extend((id, target) for target in dict.fromkeys(links))
+        results[index] = {"index": index, "id": id, "status": status}
+
+    owner_pks = dict(existing_ids)
+    if creates:
+        owner_pks.update(db.session.execute(insert(table).returning(table.c.id, table.c.pk), creates).all())
+
+    updates_by_columns = {}
+    for row in updates:
+        updates_by_columns.setdefault(tuple(sorted(row)), []).append(row)
+    for columns, rows in updates_by_columns.items():
+        db.session.execute(
+            update(table)
+            .where(table.c.id == bindparam("_id"))
+            .values({column: bindparam(column) for column in columns if column != "_id"}),
+            rows,
+        )
+
+    retargeted = set()
+    if relinked:
+        link_table = spec.link.table
+        owner_column = link_table.c[spec.link.owner_column]
+        target_column = link_table.c[spec.link.target_column]
+        relinked_pks = [owner_pks[id] for id in relinked]
+        target_table = spec.link.target
+        old_links = {
+            tuple(row)
+            for row in db.session.execute(
+                select(table.c.id, target_table.c.id)
+                .join_from(link_table, table, table.c.pk == owner_column)
+                .join(target_table, target_table.c.pk == target_column)
+                .where(owner_column.in_(relinked_pks))
+            )
+        }
+        new_links = set(link_rows)
+        record(link_table.name, upserts=new_links - old_links, deletes=old_links - new_links)
+        retargeted = {target for _, target in old_links | new_links}
+        db.session.execute(delete(link_table).where(owner_column.in_(relinked_pks)))
+        if link_rows:
+            db.session.execute(
+                insert(link_table),
+                [
+                    {spec.link.owner_column: owner_pks[id], spec.link.target_column: known_targets[target]}
+                    for id, target in link_rows
+                ],
+            )
+
+    if creates or updates:
+        bump(table.name)
+        record(table.name, upserts=[row["id"] for row in creates] + [row["_id"] for row in updates])
+    if relinked:
+        bump(spec.link.table.name)
+    try:
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        return json_response({"error": str(e.orig)}, 409)
+
+    tags = [table.name] if creates else []
+    tags += [(spec.entity_tag, row["_id"]) for row in updates]
+    tags += [(spec.link_tag, id) for id in relinked if id in existing_ids]
+    tags += [(spec.reverse_tag, target) for target in retargeted]
+    response_cache.invalidate(*tags)
+    return json_response({"results": results})
+
+
+def delete_batch(spec, ids):
+    ids = list(dict.fromkeys(id for id in ids.split(",") if id))
+    if not ids:
+        return json_response({"error": "ids is required"}, 400)
+
+    table = spec.table
+    existing = dict(select_in([table.c.id, table.c.pk], table.c.id, ids))
+    found = [id for id in ids if id in existing]
+
+    if found:
+        found_pks = [existing[id] for id in found]
+        for link_table, column in spec.cascades:
+            db.session.execute(delete(link_table).where(link_table.c[column].in_(found_pks)))
+        db.session.execute(delete(table).where(table.c.pk.in_(found_pks)))
+        bump(table.name, *(link_table.name for link_table, _ in spec.cascades))
+        record(table.name, deletes=found)
+        db.session.commit()
+
+    tags = [(spec.entity_tag, id) for id in found]
+    if spec.link_tag != spec.entity_tag:
+        tags += [(spec.link_tag, id) for id in found]
+    response_cache.invalidate(*tags)
+
+    results = [
+        {"id": id, "status": "deleted"} if id in existing else {"id": id, "error": f"{spec.label} not found"}
+        for id in ids
+    ]
+    return json_response({"results": results})
@@ -0,0 +1,107 @@
+from sqlalchemy import delete, func, insert, select, update
+from app.extensions import db
+from app.models import change_horizon, changes
+import os
+
+DEFAULT_LIMIT = 1000
+MAX_LIMIT = 10000
+CHANGE_LOG_RETAIN = int(os.getenv("CHANGE_LOG_RETAIN", "100000"))
+CHANGE_LOG_COMPACT_EVERY = int(os.getenv("CHANGE_LOG_COMPACT_EVERY", "1000"))
+KEY = (changes.c.table_name, changes.c.entity_id, changes.c.target_id)
+
+
+class ChangesCompacted(Exception):
+    pass
+
+
+def change_params(args):
+    try:
+        since = int(args.get("since", 0))
+        limit = int(args.get("limit", DEFAULT_LIMIT))
+    except ValueError:
+        raise ValueError("since and limit must be integers")
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+    return since, limit
+
+
+def record(table_name, upserts=(), deletes=()):
+    # Each key is a public id, or an (owner id, target id) pair for a link.
+    # Runs in the writer's transaction, so the log commits with the write.
+    rows = [
+        {
+            "table_name": table_name,
+            "entity_id": key[0] if isinstance(key, tuple) else key,
+            "target_id": key[1] if isinstance(key, tuple) else None,
+            "deleted": deleted,
+        }
+        for keys, deleted in ((upserts, False), (deletes, True))
+        for key in keys
+    ]
+    if not rows:
+        return
+    if db.engine.dialect.name != "sqlite":
+        # Concurrent writers would otherwise commit out of seq order, and a
+        # reader could move its cursor past a seq that is still in flight and
+        # never see it. Holding the horizon row until commit means seqs are
+        # allocated and committed one transaction at a time.
+        db.session.execute(select(change_horizon.c.seq).with_for_update())
+    seqs = db.session.scalars(insert(changes).returning(changes.c.seq), rows).all()
+    if any(seq % CHANGE_LOG_COMPACT_EVERY == 0 for seq in seqs):
+        compact(db.session)
+
+
+def bounds(executor):
+    # (horizon, current seq): cursors from horizon to current seq are valid.
+    top, floor = executor.execute(
+        select(func.max(changes.c.seq), select(change_horizon.c.seq).scalar_subquery())
+    ).one()
+    return floor, max(top or 0, floor)
+
+
+def current_seq(executor):
+    return bounds(executor)[1]
+
+
+def compact(executor, retain=CHANGE_LOG_RETAIN):
+    # An entry superseded by a later one for the same key tells no reader
+    # anything, so those always go. Entries more than `retain` seqs old go
+    # too, and the horizon moves up: readers from before it must reload.
+    latest = select(func.max(changes.c.seq)).group_by(*KEY)
+    executor.execute(delete(changes).where(changes.c.seq.not_in(latest)))
+    floor, top = bounds(executor)
+    cutoff = top - retain
+    if cutoff > floor:
+        executor.execute(delete(changes).where(changes.c.seq <= cutoff))
+        executor.execute(update(change_horizon).values(seq=cutoff))
+
+
+def reset(executor):
+    # For bulk loads that bypass record(): burn one seq, empty the log and put
+    # the horizon there, so every reader reloads.
+    seq = executor.execute(
+        insert(changes).returning(changes.c.seq),
+        {"table_name": "*", "entity_id": "*", "deleted": True},
+    ).scalar_one()
+    executor.execute(delete(changes))
+    executor.execute(update(change_horizon).values(seq=seq))
+
+
+def read_changes(since, limit):
+    # Returns (next seq, more to come, {key: deleted}) with only the latest
+    # entry per key. A cursor past the end means the log was recreated.
+    floor, top = bounds(db.session)
+    if not floor <= since <= top:
+        raise ChangesCompacted()
+    rows = db.session.execute(
+        select(changes.c.seq, *KEY, changes.c.deleted)
+        .where(changes.c.seq > since)
+        .order_by(changes.c.seq)
+        .limit(limit + 1)
+    ).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    latest = {}
+    for seq, table_name, entity_id, target_id, deleted in rows:
+        latest[table_name, entity_id, target_id] = deleted
+    return (rows[-1].seq if more else top), more, latest
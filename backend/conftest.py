@@ -0,0 +1,15 @@
+import importlib.util
+import os
+import sys
+
+# The image copies this directory to /app, imported as the `app` package, and
+# puts common/ on the path; a checkout gets the same layout here.
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, "common"))
+
+if "app" not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+        "app", os.path.join(HERE, "__init__.py"), submodule_search_locations=[HERE]
+    )
+    sys.modules["app"] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sys.modules["app"])
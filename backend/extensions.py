@@ -1,7 +1,65 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import DeclarativeBase
+import os
+
+# Applied to every new SQLite connection; an empty value leaves SQLite's own
+# default. WAL lets readers run alongside the one writer instead of queueing
+# behind it, and with WAL synchronous=NORMAL only skips the fsync per commit
+# (a power cut can lose the last commits, never corrupt the file).
+# busy_timeout (ms) is how long a writer waits for the lock before failing
+# with "database is locked"; cache_size is negative KiB per connection.
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": os.getenv("SQLITE_BUSY_TIMEOUT", "10000"),
+    "mmap_size": os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+    "cache_size": os.getenv("SQLITE_CACHE_SIZE", str(-64 * 1024)),
+}
+
 
 class Base(DeclarativeBase):
     pass
 
-db = SQLAlchemy(model_class=Base)
\ No newline at end of file
+db = SQLAlchemy(model_class=Base)
+
+
+def engine_options(url):
+    # Pool settings per worker process. Pre-ping and recycle guard against
+    # connections a server or proxy dropped while they sat idle, which a
+    # SQLite file cannot do, so they default off there.
+    url = make_url(url)
+    sqlite = url.get_backend_name() == "sqlite"
+    options = {
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "0" if sqlite else "1") == "1",
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "-1" if sqlite else "1800")),
+    }
+    # In-memory SQLite is one shared connection, not a sized pool.
+    if not sqlite or url.database not in (None, "", ":memory:"):
+        options.update(
+            pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+            pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        )
+    return options
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        if value:
+            cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+def init_engine(app):
+    # Options set in the app config win over the environment.
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        **engine_options(app.config["SQLALCHEMY_DATABASE_URI"]),
+        **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}),
+    }
+    db.init_app(app)
+    with app.app_context():
+        if db.engine.dialect.name == "sqlite":
+            event.listen(db.engine, "connect", set_sqlite_pragmas)
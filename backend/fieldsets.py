@@ -0,0 +1,117 @@
+from sqlalchemy import select
+from app.extensions import db
+
+IN_CHUNK = 1000
+
+
+class InvalidFieldset(ValueError):
+    pass
+
+
+class Shape:
+    def __init__(self, model, fields, relations=None, default_include=()):
+        self.model = model
+        self.table = model.__table__
+        # public name -> column name, in output order; "id" first
+        self.fields = fields
+        # public name -> (relationship attribute name, child Shape)
+        self.relations = relations or {}
+        self.default_include = default_include
+
+    def parse(self, args):
+        fields = self.pick(split_list(args["fields"]) if "fields" in args else None)
+        includes = {}
+        names = split_list(args["include"]) if "include" in args else self.default_include
+        for name in names:
+            child_fields = None
+            if name.endswith(")") and "(" in name:
+                name, _, inner = name[:-1].partition("(")
+                child_fields = split_list(inner)
+            if name not in self.relations:
+                raise InvalidFieldset(f"Unknown include '{name}'")
+            attribute, child = self.relations[name]
+            includes[name] = (attribute, child, child.pick(child_fields))
+        return FieldSet(self, fields, includes)
+
+    def pick(self, names):
+        if names is None:
+            return list(self.fields)
+        for name in names:
+            if name not in self.fields:
+                raise InvalidFieldset(f"Unknown field '{name}'")
+        # The id is always returned so clients and caches can key on it.
+        return [name for name in self.fields if name == "id" or name in names]
+
+    def columns(self, names):
+        return [self.table.c[self.fields[name]].label(name) for name in names]
+
+
+class Include:
+    def __init__(self, name, relationship, child, fields):
+        self.name = name
+        self.fields = fields
+        self.columns = child.columns(fields)
+        self.child_table = child.table
+        # For a many-to-many relationship the synchronize pairs give the two
+        # association-table columns: parent key -> owner, child key -> target.
+        self.link_table = relationship.secondary
+        self.owner = relationship.synchronize_pairs[0][1]
+        self.target = relationship.secondary_synchronize_pairs[0][1]
+
+
+class FieldSet:
+    # Reads straight from row tuples with Core selects: one query for the
+    # parents and one per included relationship for each batch of parents,
+    # without hydrating ORM objects. Each child dict is built once per batch
+    # and shared by every parent that embeds it.
+    def __init__(self, shape, fields, includes):
+        self.shape = shape
+        self.fields = fields
+        self.includes = [
+            Include(name, getattr(shape.model, attribute).property, child, child_fields)
+            for name, (attribute, child, child_fields) in includes.items()
+        ]
+
+    def statement(self):
+        # The surrogate key leads every row: it is the keyset pagination key
+        # and what included children are joined on, but it is never output.
+        return select(self.shape.table.c.pk, *self.shape.columns(self.fields))
+
+    def serialize_rows(self, rows):
+        result = []
+        for start in range(0, len(rows), IN_CHUNK):
+            chunk = rows[start : start + IN_CHUNK]
+            children = [(include.name, self.load(include, chunk)) for include in self.includes]
+            for row in chunk:
+                item = dict(zip(self.fields, row[1:]))
+                for name, by_parent in children:
+                    item[name] = by_parent.get(row.pk, [])
+                result.append(item)
+        return result
+
+    def load(self, include, rows):
+        statement = (
+            select(include.owner, *include.columns)
+            .join_from(include.link_table, include.child_table, include.child_table.c.pk == include.target)
+            .where(include.owner.in_([row.pk for row in rows]))
+        )
+        by_parent, shared = {}, {}
+        for owner, *values in db.session.execute(statement):
+            child = shared.get(values[0])
+            if child is None:
+                child = shared[values[0]] = dict(zip(include.fields, values))
+            by_parent.setdefault(owner, []).append(child)
+        return by_parent
+
+
+def split_list(value):
+    items, depth, current = [], 0, ""
+    for char in value:
+        if char == "," and depth == 0:
+            items.append(current)
+            current = ""
+            continue
+        depth += {"(": 1, ")": -1}.get(char, 0)
+        current += char
+    items.append(current)
+    return [item.strip() for item in items if item.strip()]
@@ -0,0 +1,49 @@
+import multiprocessing
+import os
+import shutil
+
+# The image copies this directory to /app, which the app imports as the
+# `app` package, so workers run from /.
+chdir = "/"
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+worker_class = "gthread"
+preload_app = True
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "100"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+accesslog = "-"
+
+# Must be set before prometheus_client is imported by the preloaded app.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus-backend")
+# Emptied and recreated here, when gunicorn loads this file: the app is
+# preloaded before any server hook runs, and metrics created at import time
+# open their files in this directory straight away.
+shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+
+def on_starting(server):
+    # Runs once in the master, after the app is preloaded and before any
+    # worker is forked.
+    from app.app import create_schema
+
+    create_schema()
+
+
+def post_fork(server, worker):
+    # Pooled connections opened by create_schema() belong to the master.
+    from app.app import app
+    from app.extensions import db
+
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
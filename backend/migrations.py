@@ -0,0 +1,60 @@
+from sqlalchemy import column, inspect, select, table, text, update
+from app.extensions import db
+from app.models import VERSIONED_TABLES, table_versions
+from app.seed import LINKS
+from app.changes import reset
+
+ENTITIES = {
+    "coins": ("id", "coin_name"),
+    "duties": ("id", "duty_name", "duty_description"),
+    "ksbs": ("id", "ksb_name"),
+}
+
+
+def has_string_keys(connection):
+    inspector = inspect(connection)
+    return inspector.has_table("coins") and "pk" not in {c["name"] for c in inspector.get_columns("coins")}
+
+
+def migrate_to_integer_keys(connection):
+    # Moves a database keyed on string UUIDs onto integer surrogate keys. Every
+    # public id is kept, so the API is unchanged. The old tables are renamed
+    # aside, the new ones created and filled with INSERT ... SELECT, and the
+    # old ones dropped, all in the caller's transaction.
+    if connection.dialect.name == "sqlite":
+        # pysqlite would otherwise run each DDL statement in autocommit.
+        connection.exec_driver_sql("BEGIN")
+    for name in (*ENTITIES, *LINKS):
+        connection.exec_driver_sql(f"ALTER TABLE {name} RENAME TO {name}_legacy")
+        if connection.dialect.name == "postgresql":
+            # Index and constraint names are schema-wide and would collide.
+            for (index,) in connection.execute(
+                text("SELECT indexname FROM pg_indexes WHERE tablename = :name"), {"name": f"{name}_legacy"}
+            ):
+                connection.exec_driver_sql(f'ALTER INDEX "{index}" RENAME TO "{index}_legacy"')
+    db.metadata.create_all(connection)
+
+    for name, columns in ENTITIES.items():
+        legacy = table(f"{name}_legacy", *map(column, columns))
+        connection.execute(db.metadata.tables[name].insert().from_select(columns, select(legacy)))
+
+    for name, keys in LINKS.items():
+        legacy = table(f"{name}_legacy", *(column(id_column) for id_column, _, _ in keys))
+        entities = [db.metadata.tables[target].alias() for _, _, target in keys]
+        source = legacy
+        for (id_column, _, _), entity in zip(keys, entities):
+            source = source.join(entity, entity.c.id == legacy.c[id_column])
+        connection.execute(
+            db.metadata.tables[name].insert().from_select(
+                [key for _, key, _ in keys], select(*(entity.c.pk for entity in entities)).select_from(source)
+            )
+        )
+
+    for name in (*LINKS, *ENTITIES):
+        connection.exec_driver_sql(f"DROP TABLE {name}_legacy")
+    reset(connection)
+    connection.execute(
+        update(table_versions)
+        .where(table_versions.c.table_name.in_(VERSIONED_TABLES))
+        .values(version=table_versions.c.version + 1)
+    )
@@ -1,26 +1,77 @@
 from app.extensions import db
-from sqlalchemy import Table, Column, String, ForeignKey
+from sqlalchemy import Table, Column, String, Integer, Boolean, ForeignKey, Index, event
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 import uuid
 
+# Links are keyed on the integer surrogate keys. The composite primary key
+# serves lookups from the first column; the second index serves the reverse
+# direction (coins by duty, duties by KSB) without touching the table.
 coins_duties = Table(
     "coins_duties",
     db.metadata,
-    Column("coin_id", String, ForeignKey("coins.id"), primary_key=True),
-    Column("duty_id", String, ForeignKey("duties.id"), primary_key=True),
+    Column("coin_pk", Integer, ForeignKey("coins.pk"), primary_key=True),
+    Column("duty_pk", Integer, ForeignKey("duties.pk"), primary_key=True),
+    Index("ix_coins_duties_duty_pk_coin_pk", "duty_pk", "coin_pk"),
 )
 
 duties_ksbs = Table(
     "duties_ksbs",
     db.metadata,
-    Column("duty_id", String, ForeignKey("duties.id"), primary_key=True),
-    Column("ksb_id", String, ForeignKey("ksbs.id"), primary_key=True),
+    Column("duty_pk", Integer, ForeignKey("duties.pk"), primary_key=True),
+    Column("ksb_pk", Integer, ForeignKey("ksbs.pk"), primary_key=True),
+    Index("ix_duties_ksbs_ksb_pk_duty_pk", "ksb_pk", "duty_pk"),
 )
 
+VERSIONED_TABLES = ("coins", "duties", "ksbs", "coins_duties", "duties_ksbs")
+
+table_versions = Table(
+    "table_versions",
+    db.metadata,
+    Column("table_name", String, primary_key=True),
+    Column("version", Integer, nullable=False, default=0),
+)
+
+
+@event.listens_for(table_versions, "after_create")
+def seed_table_versions(target, connection, **kw):
+    connection.execute(
+        target.insert(), [{"table_name": name, "version": 0} for name in VERSIONED_TABLES]
+    )
+
+
+# Change log behind GET /changes. AUTOINCREMENT keeps seq from ever being
+# reused, and entries must become visible in seq order: SQLite runs one
+# writer at a time, and elsewhere record() serializes writers on the
+# change_horizon row. target_id is set for link rows only.
+changes = Table(
+    "changes",
+    db.metadata,
+    Column("seq", Integer, primary_key=True),
+    Column("table_name", String, nullable=False),
+    Column("entity_id", String, nullable=False),
+    Column("target_id", String, nullable=True),
+    Column("deleted", Boolean, nullable=False),
+    Index("ix_changes_key_seq", "table_name", "entity_id", "target_id", "seq"),
+    sqlite_autoincrement=True,
+)
+
+# Readers whose cursor is older than this seq have missed compacted entries.
+change_horizon = Table(
+    "change_horizon",
+    db.metadata,
+    Column("seq", Integer, nullable=False),
+)
+
+
+@event.listens_for(change_horizon, "after_create")
+def seed_change_horizon(target, connection, **kw):
+    connection.execute(target.insert(), {"seq": 0})
+
 
 class Coin(db.Model):
     __tablename__ = "coins"
-    id: Mapped[str] = mapped_column(primary_key=True, default=lambda: str(uuid.uuid4()))
+    pk: Mapped[int] = mapped_column(primary_key=True)
+    id: Mapped[str] = mapped_column(unique=True, default=lambda: str(uuid.uuid4()))
     coin_name: Mapped[str] = mapped_column(nullable=False, unique=True)
 
     duties = relationship("Duty", secondary=coins_duties, back_populates="coins")
@@ -37,7 +88,8 @@ class Coin(db.Model):
 
 class Duty(db.Model):
     __tablename__ = "duties"
-    id: Mapped[str] = mapped_column(primary_key=True, default=lambda: str(uuid.uuid4()))
+    pk: Mapped[int] = mapped_column(primary_key=True)
+    id: Mapped[str] = mapped_column(unique=True, default=lambda: str(uuid.uuid4()))
     duty_name: Mapped[str] = mapped_column(nullable=False, unique=True)
     duty_description: Mapped[str] = mapped_column(nullable=True, unique=True)
 
@@ -57,7 +109,8 @@ class Duty(db.Model):
 
 class Ksb(db.Model):
     __tablename__ = "ksbs"
-    id: Mapped[str] = mapped_column(primary_key=True, default=lambda: str(uuid.uuid4()))
+    pk: Mapped[int] = mapped_column(primary_key=True)
+    id: Mapped[str] = mapped_column(unique=True, default=lambda: str(uuid.uuid4()))
     ksb_name: Mapped[str] = mapped_column(nullable=False, unique=True)
 
     duties = relationship("Duty", secondary=duties_ksbs, back_populates="ksbs")
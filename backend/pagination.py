@@ -0,0 +1,68 @@
+from flask import request, url_for
+from app.extensions import db
+from app.serialization import json_response
+import base64
+import binascii
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+
+def is_paginated(args):
+    return "limit" in args or "after" in args
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        return base64.b64decode(padded, altchars=b"-_", validate=True).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+
+def page_params(args):
+    try:
+        limit = int(args.get("limit", DEFAULT_LIMIT))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+    after = args.get("after")
+    if after is not None:
+        after = decode_cursor(after)
+    return limit, after
+
+
+def paginated_response(statement, key_column, serialize_rows):
+    # Keyset pagination: seek past the last key instead of using OFFSET, so
+    # every page costs one index range scan however deep the client pages.
+    try:
+        limit, after = page_params(request.args)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    if after is not None:
+        try:
+            after = key_column.type.python_type(after)
+        except ValueError:
+            return json_response({"error": "Invalid cursor"}, 400)
+        statement = statement.where(key_column > after)
+    rows = db.session.execute(statement.order_by(key_column).limit(limit + 1)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(str(getattr(rows[-1], key_column.key)))
+
+    response = json_response({"items": serialize_rows(rows), "next": next_cursor})
+    if next_cursor:
+        # Every other parameter (fields, include, stream, ...) carries over.
+        args = request.args.to_dict(flat=False)
+        args["after"] = [next_cursor]
+        next_url = url_for(request.endpoint, **(request.view_args or {}), **args)
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return response
@@ -0,0 +1,64 @@
+import logging
+import os
+import time
+from collections import Counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "100"))
+REPEAT_THRESHOLD = int(os.environ.get("SQL_REPEAT_THRESHOLD", "10"))
+
+logger = logging.getLogger("app.sql")
+if os.environ.get("SLOW_QUERY_LOG"):
+    handler = logging.FileHandler(os.environ["SLOW_QUERY_LOG"])
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+
+class QueryStats:
+    __slots__ = ("count", "seconds", "statements")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+
+def init_query_stats(app, db):
+    with app.app_context():
+        engine = db.engine
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def end_query(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            logger.warning("slow query %.1fms: %s", elapsed * 1000, statement)
+        if has_request_context() and "query_stats" in g:
+            stats = g.query_stats
+            stats.count += 1
+            stats.seconds += elapsed
+            stats.statements[statement] += 1
+
+    @app.before_request
+    def reset_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def add_server_timing(response):
+        # Queries issued while a streamed body is generated run after the
+        # headers are sent, so they are not counted here.
+        stats = g.get("query_stats") or QueryStats()
+        timings = [f'db;dur={stats.seconds * 1000:.2f};desc="{stats.count} queries"']
+        if "start_time" in g:
+            timings.append(f"total;dur={(time.perf_counter() - g.start_time) * 1000:.2f}")
+        response.headers.add("Server-Timing", ", ".join(timings))
+        for statement, count in stats.statements.items():
+            if count > REPEAT_THRESHOLD:
+                logger.warning("possible N+1: %s %s ran %d times: %s", request.method, request.path, count, statement)
+        return response
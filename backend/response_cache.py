@@ -0,0 +1,245 @@
+from flask import Response, g, request
+from collections import OrderedDict
+from functools import wraps
+from app.changes import MAX_LIMIT, ChangesCompacted, current_seq, read_changes
+from app.extensions import db
+from app.streaming import wants_ndjson
+import os
+import threading
+
+
+class ResponseCache:
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._keys_by_tag = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        # Change log position and table versions this worker has caught up
+        # with, and a counter bumped by every invalidation.
+        self._cursor = None
+        self._synced = {}
+        self._generation = 0
+        self._sync_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def generation(self):
+        return self._generation
+
+    def set(self, key, body, headers, tags, generation=None):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            # Something was invalidated while the body was being built, maybe
+            # something it was built from.
+            if generation is not None and generation != self._generation:
+                return
+            self._discard(key)
+            self._entries[key] = (body, headers, tags, {})
+            self._size += len(body)
+            for tag in tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_variant(self, key, encoding):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[3].get(encoding) if entry else None
+
+    def set_variant(self, key, encoding, body):
+        # Compressed copies of a cached body live and die with its entry and
+        # count against the same byte budget.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or encoding in entry[3]:
+                return
+            entry[3][encoding] = body
+            self._size += len(body)
+            while self._size > self.max_bytes and self._entries:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        with self._lock:
+            self._generation += bool(tags)
+            for tag in tags:
+                for key in self._keys_by_tag.pop(tag, ()):
+                    if self._discard(key):
+                        self.invalidations += 1
+
+    def sync(self, versions):
+        # Catches up with writes made by any worker process. Each worker only
+        # reads the change log once the table versions it was handed show a
+        # write it has not applied yet, and evicts just what the logged
+        # changes touched, so entries unrelated to a write stay cached.
+        if self._is_synced(versions):
+            return
+        with self._sync_lock:
+            if self._is_synced(versions):
+                return
+            tags = set()
+            since = self._cursor
+            try:
+                if since is None:
+                    raise ChangesCompacted()
+                more = True
+                while more:
+                    since, more, latest = read_changes(since, MAX_LIMIT)
+                    for table_name, entity_id, target_id in latest:
+                        tags.update(change_tags(table_name, entity_id, target_id))
+                self.invalidate(*tags)
+            except ChangesCompacted:
+                # First sync, or the log moved on without us: start over.
+                since = current_seq(db.session)
+                with self._lock:
+                    self._flush()
+            self._cursor = since
+            self._synced.update(versions)
+
+    def _is_synced(self, versions):
+        return all(self._synced.get(name, -1) >= version for name, version in versions.items())
+
+    def clear(self):
+        with self._lock:
+            self._flush()
+            self._cursor = None
+            self._synced = {}
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def _flush(self):
+        self._entries.clear()
+        self._keys_by_tag.clear()
+        self._size = 0
+        self._generation += 1
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        body, headers, tags, variants = entry
+        self._size -= len(body) + sum(map(len, variants.values()))
+        for tag in tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_ENTRIES", "1024")),
+    max_bytes=int(os.getenv("RESPONSE_CACHE_BYTES", str(64 * 1024 * 1024))),
+)
+
+
+def coin_tags(coin):
+    tags = {("coin", coin["id"])}
+    tags.update(("duty", duty["id"]) for duty in coin.get("duties", ()))
+    return tags
+
+
+def duty_tags(duty):
+    tags = {("duty", duty["id"]), ("duty.ksbs", duty["id"])}
+    tags.update(("ksb", ksb["id"]) for ksb in duty.get("ksbs", ()))
+    return tags
+
+
+def ksb_tags(ksb):
+    return {("ksb", ksb["id"])}
+
+
+def graph_tags(graph):
+    return {"coins", "coins_duties", "duties", "duties_ksbs", "ksbs"}
+
+
+# What a logged change can have made stale. The log does not tell creates from
+# updates, so an entity change evicts its table's list tag as well; lists hold
+# every entity anyway, and search results can gain one on a rename.
+CHANGE_TAGS = {
+    "coins": lambda id, _: ("coins", ("coin", id)),
+    "duties": lambda id, _: ("duties", ("duty", id)),
+    "ksbs": lambda id, _: ("ksbs", ("ksb", id)),
+    "coins_duties": lambda coin, duty: ("coins_duties", ("coin", coin), ("duty.coins", duty)),
+    "duties_ksbs": lambda duty, ksb: ("duties_ksbs", ("duty.ksbs", duty), ("ksb.duties", ksb)),
+}
+
+
+def change_tags(table_name, entity_id, target_id):
+    return CHANGE_TAGS[table_name](entity_id, target_id)
+
+
+def cached(list_tag, item_tags, route_tags=None):
+    # Entries are keyed on the URL. Writes made by this worker evict them
+    # straight away through the tags derived from the payload; writes made by
+    # other workers are picked up from the change log by sync(), which runs
+    # before every lookup and is free until @conditional's versions move.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            response_cache.sync(g.get("versions", {}))
+            key = (request.full_path, wants_ndjson())
+            g.cache_key = key
+            entry = response_cache.get(key)
+            if entry is not None:
+                body, headers, tags, variants = entry
+                return Response(body, headers=headers, mimetype="application/json")
+
+            generation = response_cache.generation()
+            response = view(*args, **kwargs)
+            data = getattr(response, "payload", None)
+            if (
+                not isinstance(response, Response)
+                or response.status_code != 200
+                or response.is_streamed
+                or data is None
+            ):
+                return response
+
+            if isinstance(data, dict) and "items" in data:
+                data = data["items"]
+            if isinstance(data, list):
+                tags = {list_tag} if list_tag else set()
+                for item in data:
+                    tags |= item_tags(item)
+            else:
+                tags = item_tags(data)
+            if route_tags:
+                tags |= route_tags(**kwargs)
+
+            headers = [(k, v) for k, v in response.headers if k == "Link"]
+            response_cache.set(key, response.get_data(), headers, frozenset(tags), generation)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,157 @@
+from contextlib import contextmanager
+from sqlalchemy import Index, column, event, func, inspect, literal_column, or_, table
+from sqlalchemy.schema import CreateIndex
+from app.extensions import db
+from app.models import Coin, Duty, Ksb
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+# The trigram tokenizer cannot match anything shorter than one trigram.
+MIN_INDEXED_LENGTH = 3
+SEARCHABLES = []
+
+
+@contextmanager
+def indexes_rebuilt_after(connection):
+    # Bulk loads skip the per-row triggers; one rebuild at the end is several
+    # times faster.
+    for searchable in SEARCHABLES:
+        searchable.drop_index(searchable.table, connection)
+    yield
+    for searchable in SEARCHABLES:
+        searchable.create_index(searchable.table, connection)
+
+
+def search_params(args):
+    q = args.get("q", "").strip()
+    if not q:
+        raise ValueError("q must not be empty")
+    try:
+        limit = int(args.get("limit", DEFAULT_LIMIT))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+    return q, limit
+
+
+class Searchable:
+    # Matches are returned in two tiers. Names starting with q come first, in
+    # name order (so an exact match leads), read from an index on lower(name).
+    # Substring matches on any column follow in creation order. On SQLite
+    # those come from an external-content FTS5 index with the trigram
+    # tokenizer, keyed on the integer surrogate key and kept current by
+    # triggers, so every write path (ORM, batch, seed) updates it and every
+    # worker process sees the same index. Both tiers stop at the limit;
+    # ordering substring matches by BM25 would score every match first.
+    # On PostgreSQL the prefix tier is a LIKE 'q%' on a text_pattern_ops
+    # index, which unlike a range on lower(name) is right under any
+    # collation, and the substring tier an ILIKE on pg_trgm GIN indexes.
+    def __init__(self, model, columns):
+        self.table = model.__table__
+        # the first column is the name
+        self.columns = [self.table.c[name] for name in columns]
+        self.name_index = Index(f"ix_{self.table.name}_{columns[0]}_lower", func.lower(self.columns[0]))
+        # PostgreSQL gets the pattern index below instead.
+        self.name_index.ddl_if(dialect="sqlite")
+        self.prefix_index_name = f"ix_{self.table.name}_{columns[0]}_prefix"
+        self.index_name = f"{self.table.name}_search"
+        self.index = table(self.index_name, column("rowid"))
+        event.listen(self.table, "after_create", self.create_index)
+        event.listen(self.table, "before_drop", self.drop_index)
+        SEARCHABLES.append(self)
+
+    def ddl(self):
+        name, index = self.table.name, self.index_name
+        names = ", ".join(c.name for c in self.columns)
+        insert = f"INSERT INTO {index}(rowid, {names}) VALUES (new.pk, {', '.join(f'new.{c.name}' for c in self.columns)});"
+        delete = (
+            f"INSERT INTO {index}({index}, rowid, {names}) "
+            f"VALUES ('delete', old.pk, {', '.join(f'old.{c.name}' for c in self.columns)});"
+        )
+        return [
+            f"CREATE VIRTUAL TABLE {index} USING fts5({names}, content='{name}', content_rowid='pk', tokenize='trigram')",
+            f"CREATE TRIGGER {index}_insert AFTER INSERT ON {name} BEGIN {insert} END",
+            f"CREATE TRIGGER {index}_delete AFTER DELETE ON {name} BEGIN {delete} END",
+            f"CREATE TRIGGER {index}_update AFTER UPDATE ON {name} BEGIN {delete} {insert} END",
+        ]
+
+    def postgresql_ddl(self):
+        name, index = self.table.name, self.index_name
+        trigrams = ", ".join(f"{c.name} gin_trgm_ops" for c in self.columns)
+        return [
+            f"CREATE INDEX IF NOT EXISTS {self.prefix_index_name} ON {name} (lower({self.columns[0].name}) text_pattern_ops)",
+            f"CREATE INDEX IF NOT EXISTS {index} ON {name} USING gin ({trigrams})",
+        ]
+
+    def create_index(self, target, connection, **kw):
+        if connection.dialect.name == "postgresql":
+            # Needs a role allowed to create the extension, or an existing one.
+            connection.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            for statement in self.postgresql_ddl():
+                connection.exec_driver_sql(statement)
+            return
+        if connection.dialect.name != "sqlite":
+            return
+        self.drop_index(target, connection)
+        for statement in self.ddl():
+            connection.exec_driver_sql(statement)
+        connection.exec_driver_sql(f"INSERT INTO {self.index_name}({self.index_name}) VALUES ('rebuild')")
+
+    def drop_index(self, target, connection, **kw):
+        if connection.dialect.name == "postgresql":
+            connection.exec_driver_sql(f"DROP INDEX IF EXISTS {self.prefix_index_name}")
+            connection.exec_driver_sql(f"DROP INDEX IF EXISTS {self.index_name}")
+            return
+        if connection.dialect.name != "sqlite":
+            return
+        for action in ("insert", "delete", "update"):
+            connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {self.index_name}_{action}")
+        connection.exec_driver_sql(f"DROP TABLE IF EXISTS {self.index_name}")
+
+    def ensure_index(self, connection):
+        # For databases whose tables predate the indexes.
+        # Reflection skips expression indexes, so checkfirst cannot be used.
+        if connection.dialect.name == "postgresql":
+            # Superseded by the pattern index, which serves the same prefixes.
+            connection.exec_driver_sql(f"DROP INDEX IF EXISTS {self.name_index.name}")
+            self.create_index(self.table, connection)
+            return
+        connection.execute(CreateIndex(self.name_index, if_not_exists=True))
+        if connection.dialect.name == "sqlite" and not inspect(connection).has_table(self.index_name):
+            self.create_index(self.table, connection)
+
+    def search(self, statement, q, limit):
+        q = q.lower()
+        name, pk = func.lower(self.columns[0]), self.table.c.pk
+        # LIKE patterns are built here rather than by concatenating in SQL, so
+        # the planner sees a constant it can match against an index.
+        escaped = q.replace("/", "//").replace("%", "/%").replace("_", "/_")
+        if db.engine.dialect.name == "postgresql":
+            prefixed = name.like(escaped + "%", escape="/")
+        else:
+            # [q, q with its last character incremented) covers every name
+            # starting with q, as an index range.
+            prefixed = (name >= q) & (name < q[:-1] + chr(ord(q[-1]) + 1))
+        rows = db.session.execute(statement.where(prefixed).order_by(name, pk).limit(limit)).all()
+        if len(rows) == limit or len(q) < MIN_INDEXED_LENGTH:
+            return rows
+
+        statement = statement.where(~prefixed)
+        if db.engine.dialect.name == "sqlite":
+            phrase = '"' + q.replace('"', '""') + '"'
+            # FTS5 returns matches in rowid order, so ordering on its rowid
+            # rather than pk avoids a sort.
+            statement = (
+                statement.join(self.index, self.index.c.rowid == pk)
+                .where(literal_column(self.index_name).op("MATCH")(phrase))
+                .order_by(self.index.c.rowid)
+            )
+        else:
+            statement = statement.where(or_(*(c.ilike(f"%{escaped}%", escape="/") for c in self.columns))).order_by(pk)
+        return rows + db.session.execute(statement.limit(limit - len(rows))).all()
+
+
+COIN_SEARCH = Searchable(Coin, ("coin_name",))
+DUTY_SEARCH = Searchable(Duty, ("duty_name", "duty_description"))
+KSB_SEARCH = Searchable(Ksb, ("ksb_name",))
@@ -0,0 +1,146 @@
+import click
+import csv
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from itertools import islice
+from sqlalchemy import select, update
+from app.extensions import db
+from app.models import VERSIONED_TABLES, table_versions
+from app.search import indexes_rebuilt_after
+from app.changes import reset
+
+TABLES = ("coins", "duties", "ksbs", "coins_duties", "duties_ksbs")
+BATCH_SIZE = 20_000
+# Link rows are given by public id and stored by surrogate key:
+# (id column in the input, key column in the table, referenced table).
+LINKS = {
+    "coins_duties": (("coin_id", "coin_pk", "coins"), ("duty_id", "duty_pk", "duties")),
+    "duties_ksbs": (("duty_id", "duty_pk", "duties"), ("ksb_id", "ksb_pk", "ksbs")),
+}
+
+
+def batched(rows, size=BATCH_SIZE):
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def generate(coins, duties, ksbs, duties_per_coin=5, ksbs_per_duty=5, seed=0):
+    # Yields (table, rows) batches. The same arguments always give the same
+    # graph, ids included, and links are produced lazily so a million of them
+    # never sit in memory at once.
+    rng = random.Random(seed)
+
+    def new_ids(count):
+        return [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(count)]
+
+    coin_ids, duty_ids, ksb_ids = new_ids(coins), new_ids(duties), new_ids(ksbs)
+    duties_per_coin = min(duties_per_coin, duties)
+    ksbs_per_duty = min(ksbs_per_duty, ksbs)
+
+    for batch in batched(enumerate(coin_ids)):
+        yield "coins", [{"id": id, "coin_name": f"Coin {i}"} for i, id in batch]
+    for batch in batched(enumerate(duty_ids)):
+        yield "duties", [
+            {"id": id, "duty_name": f"Duty {i}", "duty_description": f"Description of duty {i}"}
+            for i, id in batch
+        ]
+    for batch in batched(enumerate(ksb_ids)):
+        yield "ksbs", [{"id": id, "ksb_name": f"KSB {i}"} for i, id in batch]
+    for batch in batched(
+        (coin_id, duty_id) for coin_id in coin_ids for duty_id in rng.sample(duty_ids, duties_per_coin)
+    ):
+        yield "coins_duties", [{"coin_id": coin_id, "duty_id": duty_id} for coin_id, duty_id in batch]
+    for batch in batched(
+        (duty_id, ksb_id) for duty_id in duty_ids for ksb_id in rng.sample(ksb_ids, ksbs_per_duty)
+    ):
+        yield "duties_ksbs", [{"duty_id": duty_id, "ksb_id": ksb_id} for duty_id, ksb_id in batch]
+
+
+def read_csv(directory):
+    # One <table>.csv per table, headed with its column names. Missing files
+    # are skipped, so a directory can hold just the links for existing rows.
+    for name in TABLES:
+        path = os.path.join(directory, f"{name}.csv")
+        if not os.path.exists(path):
+            continue
+        with open(path, newline="") as f:
+            for batch in batched(csv.DictReader(f)):
+                yield name, [{key: value or None for key, value in row.items()} for row in batch]
+
+
+def load(connection, batches):
+    counts = dict.fromkeys(TABLES, 0)
+    pks = {}
+    with indexes_rebuilt_after(connection):
+        for name, rows in batches:
+            if name in LINKS:
+                for _, _, target in LINKS[name]:
+                    if target not in pks:
+                        table = db.metadata.tables[target]
+                        pks[target] = dict(connection.execute(select(table.c.id, table.c.pk)).all())
+                rows = [
+                    {key: pks[target][row[id_column]] for id_column, key, target in LINKS[name]}
+                    for row in rows
+                ]
+            connection.execute(db.metadata.tables[name].insert(), rows)
+            counts[name] += len(rows)
+    # Nothing here went through the change log, so change feed readers must
+    # reload; cached responses and ETags are keyed on the versions.
+    reset(connection)
+    connection.execute(
+        update(table_versions)
+        .where(table_versions.c.table_name.in_(VERSIONED_TABLES))
+        .values(version=table_versions.c.version + 1)
+    )
+    return counts
+
+
+@click.command("seed")
+@click.option("--coins", type=int, default=1000)
+@click.option("--duties", type=int, default=None, help="Defaults to coins / 10.")
+@click.option("--ksbs", type=int, default=None, help="Defaults to coins / 10.")
+@click.option("--duties-per-coin", type=int, default=5)
+@click.option("--ksbs-per-duty", type=int, default=5)
+@click.option("--seed", "seed_value", type=int, default=0)
+@click.option("--spec", type=click.File(), help="JSON object with any of the options above.")
+@click.option("--csv", "csv_dir", type=click.Path(exists=True, file_okay=False), help="Load <table>.csv files instead.")
+@click.option("--reset", is_flag=True, help="Drop and recreate every table first.")
+def seed_command(coins, duties, ksbs, duties_per_coin, ksbs_per_duty, seed_value, spec, csv_dir, reset):
+    """Bulk-load a curriculum graph with Core inserts."""
+    if reset:
+        db.drop_all()
+        db.create_all()
+
+    if csv_dir:
+        batches = read_csv(csv_dir)
+    else:
+        options = {
+            "coins": coins,
+            "duties": duties,
+            "ksbs": ksbs,
+            "duties_per_coin": duties_per_coin,
+            "ksbs_per_duty": ksbs_per_duty,
+            "seed": seed_value,
+            **(json.load(spec) if spec else {}),
+        }
+        for name in ("duties", "ksbs"):
+            if options[name] is None:
+                options[name] = max(options["coins"] // 10, 1)
+        batches = generate(**options)
+
+    # Every bulk batch would otherwise be reported as a slow query.
+    logging.getLogger("app.sql").setLevel(logging.ERROR)
+    started = time.perf_counter()
+    with db.engine.begin() as connection:
+        if connection.dialect.name == "sqlite":
+            # Safe for a one-off load: a crash mid-load leaves a database you
+            # would reseed anyway.
+            connection.exec_driver_sql("PRAGMA synchronous = OFF")
+        counts = load(connection, batches)
+    elapsed = time.perf_counter() - started
+    click.echo(", ".join(f"{count} {name}" for name, count in counts.items()) + f" in {elapsed:.1f}s")
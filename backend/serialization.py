@@ -0,0 +1,50 @@
+from flask import Response
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def stdlib_dumps(data):
+    # Compact and UTF-8, so the bytes match orjson's and ETags stay the same
+    # whichever encoder a worker picked up.
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+ENCODERS = {"json": (stdlib_dumps, json.loads)}
+if orjson is not None:
+    ENCODERS["orjson"] = (orjson.dumps, orjson.loads)
+
+
+def select_encoder(name=None):
+    if name in (None, "", "auto"):
+        name = "orjson" if "orjson" in ENCODERS else "json"
+    if name not in ENCODERS:
+        raise ValueError(f"JSON encoder '{name}' is not available")
+    return name
+
+
+encoder = select_encoder(os.getenv("JSON_ENCODER"))
+
+
+def use_encoder(name):
+    global encoder
+    encoder = select_encoder(name)
+
+
+def dumps(data):
+    return ENCODERS[encoder][0](data)
+
+
+def loads(body):
+    return ENCODERS[encoder][1](body)
+
+
+def json_response(data, status=200, headers=None):
+    response = Response(dumps(data), status=status, headers=headers, mimetype="application/json")
+    # Kept for the response cache, which derives its tags from it.
+    response.payload = data
+    return response
@@ -0,0 +1,61 @@
+from flask import Response, request, stream_with_context
+from itertools import chain
+from app.extensions import db
+from app.serialization import dumps, json_response
+import os
+
+NDJSON = "application/x-ndjson"
+STREAM_THRESHOLD = int(os.getenv("STREAM_THRESHOLD", "5000"))
+CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "1000"))
+
+
+def wants_ndjson():
+    return request.accept_mimetypes.best == NDJSON
+
+
+def list_response(statement, serialize_rows):
+    # Rows are read yield_per(CHUNK_SIZE) through a server-side cursor. Small
+    # collections are encoded in one go; once more than STREAM_THRESHOLD rows
+    # turn up (or the client asks with ?stream=1 or Accept: NDJSON) the body is
+    # written out a chunk at a time, so memory stays flat however large the
+    # table is. ?stream=0 always buffers.
+    ndjson = wants_ndjson()
+    stream = request.args.get("stream")
+    chunks = db.session.execute(
+        statement, execution_options={"yield_per": CHUNK_SIZE}
+    ).partitions()
+
+    if not ndjson and stream != "1":
+        head = []
+        for chunk in chunks:
+            head.extend(chunk)
+            if stream != "0" and len(head) > STREAM_THRESHOLD:
+                break
+        else:
+            return json_response(serialize_rows(head))
+        chunks = chain([head], chunks)
+
+    if ndjson:
+        return Response(stream_with_context(ndjson_chunks(chunks, serialize_rows)), mimetype=NDJSON)
+    return Response(
+        stream_with_context(array_chunks(chunks, serialize_rows)), mimetype="application/json"
+    )
+
+
+def array_chunks(chunks, serialize_rows):
+    # Each chunk is encoded as a list and spliced in without its brackets, which
+    # gives exactly the bytes of encoding the whole list at once, so the ETag
+    # of a collection does not depend on whether it was streamed.
+    yield b"["
+    separator = b""
+    for chunk in chunks:
+        items = serialize_rows(chunk)
+        if items:
+            yield separator + dumps(items)[1:-1]
+            separator = b","
+    yield b"]"
+
+
+def ndjson_chunks(chunks, serialize_rows):
+    for chunk in chunks:
+        yield b"".join(dumps(item) + b"\n" for item in serialize_rows(chunk))
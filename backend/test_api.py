@@ -1,10 +1,23 @@
 import pytest
 import os
+import json
+import gzip
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, text, update
 
 os.environ["db_url"] = "sqlite:///:memory:"
 
-from backend.app import app, db
-from backend.models import Coin, Duty
+from app.app import app, create_schema, db
+from app.models import Coin, Duty, Ksb
+from app.search import DUTY_SEARCH
+from app.response_cache import ResponseCache, response_cache
+from app import serialization, streaming
+from metrics import bucket_quantile, latency_summary, registry
+from app import query_stats
+from app.seed import generate, seed_command
+from app import changes
+from app.versioning import bump
+from app.extensions import engine_options, set_sqlite_pragmas
 
 
 @pytest.fixture()
@@ -13,12 +26,27 @@ def client():
     with app.test_client() as test_client:
         with app.app_context():
             db.create_all()
+            response_cache.clear()
 
             yield test_client
 
             db.drop_all()
 
 
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
 class TestCoins:
     def test_get_coins_empty(self, client):
         response = client.get("/coins")
@@ -214,7 +242,7 @@ class TestCoinDutyRelationships:
         assert coin_response.status_code == 201
         assert coin_response.json["coin_name"] == "automate"
 
-        coin = Coin.query.get(coin_id)
+        coin = Coin.query.filter_by(id=coin_id).first()
         assert len(coin.duties) == 2
 
     def test_get_coin_with_duties(self, client):
@@ -286,7 +314,7 @@ class TestCoinDutyRelationships:
 
         assert response.status_code == 200
 
-        coin = Coin.query.get(coin_id)
+        coin = Coin.query.filter_by(id=coin_id).first()
         assert len(coin.duties) == 2
         duty_ids = [duty.id for duty in coin.duties]
         assert duty2_id in duty_ids
@@ -311,7 +339,7 @@ class TestDutyKsbRelationships:
         assert duty_response.status_code == 201
         assert duty_response.json["duty_name"] == "duty_1"
 
-        duty = Duty.query.get(duty_id)
+        duty = Duty.query.filter_by(id=duty_id).first()
         assert len(duty.ksbs) == 2
 
     def test_get_duty_with_ksbs(self, client):
@@ -383,10 +411,993 @@ class TestDutyKsbRelationships:
 
         assert response.status_code == 200
 
-        duty = Duty.query.get(duty_id)
+        duty = Duty.query.filter_by(id=duty_id).first()
         assert len(duty.ksbs) == 2
 
         ksb_ids = [ksb.id for ksb in duty.ksbs]
         assert ksb2_id in ksb_ids
         assert ksb3_id in ksb_ids
         assert ksb1_id not in ksb_ids
+
+
+class TestQueryCounts:
+    def seed(self, client, n):
+        ksb_ids = [
+            client.post("/ksbs", json={"ksb_name": f"K{i}"}).json["id"] for i in range(n)
+        ]
+        duty_ids = [
+            client.post(
+                "/duties", json={"duty_name": f"duty_{i}", "ksb_ids": ksb_ids}
+            ).json["id"]
+            for i in range(n)
+        ]
+        coin_ids = [
+            client.post(
+                "/coins", json={"coin_name": f"coin_{i}", "duty_ids": duty_ids}
+            ).json["id"]
+            for i in range(n)
+        ]
+        return coin_ids, duty_ids
+
+    def queries_for(self, client, method, path, **kwargs):
+        with count_queries() as statements:
+            response = client.open(path, method=method, **kwargs)
+        assert response.status_code == 200
+        return len(statements)
+
+    def requests_for(self, coin_ids, duty_ids):
+        return [
+            ("GET", "/coins", {}),
+            ("GET", f"/coins/{coin_ids[0]}", {}),
+            ("GET", "/duties", {}),
+            ("GET", f"/duties/{duty_ids[0]}", {}),
+            ("PUT", f"/coins/{coin_ids[0]}", {"json": {"duty_ids": duty_ids}}),
+            ("PUT", f"/duties/{duty_ids[0]}", {"json": {"duty_name": "renamed"}}),
+        ]
+
+    def test_query_count_does_not_grow_with_rows(self, client):
+        small = self.requests_for(*self.seed(client, 2))
+        small_counts = [self.queries_for(client, m, p, **kw) for m, p, kw in small]
+
+        db.drop_all()
+        db.create_all()
+        response_cache.clear()
+
+        large = self.requests_for(*self.seed(client, 12))
+        large_counts = [self.queries_for(client, m, p, **kw) for m, p, kw in large]
+
+        assert small_counts == large_counts
+
+
+
+class TestPagination:
+    def test_unpaginated_list_is_unchanged(self, client):
+        client.post("/ksbs", json={"ksb_name": "K1"})
+        response = client.get("/ksbs")
+        assert isinstance(response.json, list)
+        assert "Link" not in response.headers
+
+    def test_pages_through_all_coins(self, client):
+        created = [client.post("/coins", json={"coin_name": f"coin_{i}"}).json["id"] for i in range(5)]
+
+        seen = []
+        response = client.get("/coins?limit=2")
+        while True:
+            assert response.status_code == 200
+            assert len(response.json["items"]) <= 2
+            seen.extend(coin["id"] for coin in response.json["items"])
+            if response.json["next"] is None:
+                assert "Link" not in response.headers
+                break
+            assert 'rel="next"' in response.headers["Link"]
+            response = client.get(
+                f"/coins?limit=2&after={response.json['next']}"
+            )
+
+        assert seen == created
+
+    def test_link_header_points_to_next_page(self, client):
+        for i in range(3):
+            client.post("/duties", json={"duty_name": f"duty_{i}"})
+        response = client.get("/duties?limit=2")
+        link = response.headers["Link"]
+        next_url = link[link.index("<") + 1 : link.index(">")]
+        next_page = client.get(next_url)
+        assert len(next_page.json["items"]) == 1
+        assert next_page.json["next"] is None
+        assert "ksbs" in next_page.json["items"][0]
+
+    def test_link_header_keeps_other_params(self, client):
+        for i in range(3):
+            client.post("/coins", json={"coin_name": f"coin_{i}"})
+        response = client.get("/coins?limit=1&fields=id&include=")
+        link = response.headers["Link"]
+        next_page = client.get(link[link.index("<") + 1 : link.index(">")])
+        assert next_page.json["items"][0].keys() == {"id"}
+        assert len(next_page.json["items"]) == 1
+
+    def test_invalid_cursor(self, client):
+        response = client.get("/ksbs?after=not*a*cursor")
+        assert response.status_code == 400
+        assert response.json["error"] == "Invalid cursor"
+
+    def test_invalid_limit(self, client):
+        assert client.get("/ksbs?limit=0").status_code == 400
+        assert client.get("/ksbs?limit=abc").status_code == 400
+
+
+class TestConditionalGets:
+    def test_get_returns_etag(self, client):
+        response = client.get("/coins")
+        assert response.status_code == 200
+        assert response.headers["ETag"]
+
+    def test_matching_etag_returns_304_without_loading_rows(self, client):
+        client.post("/coins", json={"coin_name": "automate"})
+        etag = client.get("/coins").headers["ETag"]
+
+        with count_queries() as statements:
+            response = client.get("/coins", headers={"If-None-Match": etag})
+
+        assert response.status_code == 304
+        assert response.data == b""
+        assert response.headers["ETag"] == etag
+        assert len(statements) == 1
+
+    def test_write_changes_etag(self, client):
+        post_response = client.post("/coins", json={"coin_name": "automate"})
+        coin_id = post_response.json["id"]
+        etag = client.get(f"/coins/{coin_id}").headers["ETag"]
+
+        client.put(f"/coins/{coin_id}", json={"coin_name": "houston"})
+        response = client.get(f"/coins/{coin_id}", headers={"If-None-Match": etag})
+
+        assert response.status_code == 200
+        assert response.json["coin_name"] == "houston"
+        assert response.headers["ETag"] != etag
+
+    def test_embedded_entity_write_changes_parent_etag(self, client):
+        ksb_id = client.post("/ksbs", json={"ksb_name": "K1"}).json["id"]
+        client.post("/duties", json={"duty_name": "duty_1", "ksb_ids": [ksb_id]})
+        duties_etag = client.get("/duties").headers["ETag"]
+        coins_etag = client.get("/coins").headers["ETag"]
+
+        client.put(f"/ksbs/{ksb_id}", json={"ksb_name": "K2"})
+
+        assert client.get("/duties", headers={"If-None-Match": duties_etag}).status_code == 200
+        assert client.get("/coins", headers={"If-None-Match": coins_etag}).status_code == 304
+
+    def test_missing_entity_has_no_etag(self, client):
+        response = client.get("/ksbs/does-not-exist")
+        assert response.status_code == 404
+        assert "ETag" not in response.headers
+
+    def test_star_matches_only_existing_resources(self, client):
+        coin_id = client.post("/coins", json={"coin_name": "automate"}).json["id"]
+
+        assert client.get(f"/coins/{coin_id}", headers={"If-None-Match": "*"}).status_code == 304
+        assert client.get("/coins/does-not-exist", headers={"If-None-Match": "*"}).status_code == 404
+
+    def test_versions_bumped_once_at_commit(self, client):
+        duty_id = client.post("/duties", json={"duty_name": "duty_1"}).json["id"]
+        coin_id = client.post("/coins", json={"coin_name": "automate"}).json["id"]
+
+        with count_queries() as statements:
+            client.put(f"/coins/{coin_id}", json={"coin_name": "houston", "duty_ids": [duty_id]})
+
+        bumps = [i for i, statement in enumerate(statements) if statement.startswith("UPDATE table_versions")]
+        writes = [i for i, statement in enumerate(statements) if statement.startswith(("INSERT", "UPDATE", "DELETE"))]
+        assert bumps == writes[-1:]
+        versions = dict(db.session.execute(text("SELECT table_name, version FROM table_versions")).all())
+        assert versions["coins"] == 2
+        assert versions["coins_duties"] == 1
+
+
+class TestResponseCache:
+    def test_repeat_get_is_served_from_cache(self, client):
+        client.post("/coins", json={"coin_name": "automate"})
+        first = client.get("/coins")
+
+        with count_queries() as statements:
+            second = client.get("/coins")
+
+        assert second.data == first.data
+        assert len(statements) == 1
+        assert response_cache.stats()["hits"] == 1
+
+    def test_write_evicts_cached_payload(self, client):
+        coin_id = client.post("/coins", json={"coin_name": "automate"}).json["id"]
+        client.get(f"/coins/{coin_id}")
+        client.get("/coins")
+
+        client.put(f"/coins/{coin_id}", json={"coin_name": "houston"})
+
+        assert client.get(f"/coins/{coin_id}").json["coin_name"] == "houston"
+        assert client.get("/coins").json[0]["coin_name"] == "houston"
+        assert response_cache.stats()["invalidations"] == 2
+
+    def test_ksb_rename_evicts_embedding_duties_only(self, client):
+        ksb_id = client.post("/ksbs", json={"ksb_name": "K1"}).json["id"]
+        other_id = client.post("/duties", json={"duty_name": "other"}).json["id"]
+        duty_id = client.post(
+            "/duties", json={"duty_name": "duty_1", "ksb_ids": [ksb_id]}
+        ).json["id"]
+        for path in ("/duties", f"/duties/{duty_id}", f"/duties/{other_id}", "/ksbs"):
+            client.get(path)
+
+        client.put(f"/ksbs/{ksb_id}", json={"ksb_name": "K2"})
+
+        assert response_cache.stats()["entries"] == 1
+        assert client.get(f"/duties/{duty_id}").json["ksbs"][0]["ksb_name"] == "K2"
+        ksb_names = [ksb["ksb_name"] for duty in client.get("/duties").json for ksb in duty["ksbs"]]
+        assert ksb_names == ["K2"]
+
+    def test_rename_keeps_unrelated_entries(self, client):
+        ksb_id = client.post("/ksbs", json={"ksb_name": "A"}).json["id"]
+        other_id = client.post("/ksbs", json={"ksb_name": "B"}).json["id"]
+        duty_id = client.post("/duties", json={"duty_name": "D", "ksb_ids": [other_id]}).json["id"]
+        paths = (f"/ksbs/{ksb_id}", f"/ksbs/{other_id}", f"/duties/{duty_id}")
+        for path in paths:
+            client.get(path)
+
+        client.put(f"/ksbs/{ksb_id}", json={"ksb_name": "A2"})
+        hits = response_cache.stats()["hits"]
+
+        assert client.get(paths[0]).json["ksb_name"] == "A2"
+        client.get(paths[1])
+        client.get(paths[2])
+        assert response_cache.stats()["hits"] == hits + 2
+        assert response_cache.stats()["entries"] == 3
+
+    def test_other_workers_writes_are_synced_from_change_log(self, client):
+        ksb_id = client.post("/ksbs", json={"ksb_name": "A"}).json["id"]
+        other_id = client.post("/ksbs", json={"ksb_name": "B"}).json["id"]
+        client.get(f"/ksbs/{ksb_id}")
+        client.get(f"/ksbs/{other_id}")
+
+        # A write committed by another process: logged, never invalidated here.
+        db.session.execute(update(Ksb).where(Ksb.id == ksb_id).values(ksb_name="A2"))
+        changes.record("ksbs", upserts=[ksb_id])
+        bump("ksbs")
+        db.session.commit()
+        hits = response_cache.stats()["hits"]
+
+        assert client.get(f"/ksbs/{ksb_id}").json["ksb_name"] == "A2"
+        assert client.get(f"/ksbs/{other_id}").json["ksb_name"] == "B"
+        assert response_cache.stats()["hits"] == hits + 1
+
+    def test_paginated_pages_are_cached_with_link_header(self, client):
+        for i in range(3):
+            client.post("/ksbs", json={"ksb_name": f"K{i}"})
+        first = client.get("/ksbs?limit=2")
+        second = client.get("/ksbs?limit=2")
+        assert second.headers["Link"] == first.headers["Link"]
+        assert response_cache.stats()["hits"] == 1
+
+    def test_stats_endpoint(self, client):
+        client.get("/ksbs")
+        response = client.get("/cache/stats")
+        assert response.status_code == 200
+        assert response.json["misses"] == 1
+        assert response.json["entries"] == 1
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(max_entries=2)
+        cache.set("a", b"1", [], frozenset({"x"}))
+        cache.set("b", b"2", [], frozenset({"x"}))
+        cache.get("a")
+        cache.set("c", b"3", [], frozenset({"x"}))
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        assert cache.stats()["evictions"] == 1
+
+    def test_byte_budget(self):
+        cache = ResponseCache(max_bytes=4)
+        cache.set("a", b"12", [], frozenset())
+        cache.set("b", b"345", [], frozenset())
+        assert cache.get("a") is None
+        assert cache.stats()["bytes"] == 3
+
+
+class TestBatch:
+    def test_batch_create_ksbs(self, client):
+        items = [{"ksb_name": f"K{i}"} for i in range(5)]
+        response = client.post("/ksbs/batch", json=items)
+        assert response.status_code == 200
+        results = response.json["results"]
+        assert [r["status"] for r in results] == ["created"] * 5
+        assert len(client.get("/ksbs").json) == 5
+
+    def test_batch_create_duties_with_links(self, client):
+        ksb_ids = [
+            r["id"]
+            for r in client.post(
+                "/ksbs/batch", json=[{"ksb_name": "K1"}, {"ksb_name": "K2"}]
+            ).json["results"]
+        ]
+        response = client.post(
+            "/duties/batch",
+            json=[
+                {"duty_name": "duty_1", "description": "first", "ksb_ids": ksb_ids},
+                {"duty_name": "duty_2"},
+            ],
+        )
+        duty_id = response.json["results"][0]["id"]
+        duty = client.get(f"/duties/{duty_id}").json
+        assert duty["description"] == "first"
+        assert sorted(k["id"] for k in duty["ksbs"]) == sorted(ksb_ids)
+
+    def test_batch_reports_errors_per_item(self, client):
+        client.post("/coins", json={"coin_name": "taken"})
+        response = client.post(
+            "/coins/batch",
+            json=[
+                {"coin_name": "taken"},
+                {"coin_name": "fresh", "duty_ids": ["missing"]},
+                {},
+                {"coin_name": "ok"},
+                {"coin_name": "ok"},
+                {"id": "missing", "coin_name": "ghost"},
+            ],
+        )
+        assert response.status_code == 200
+        results = response.json["results"]
+        assert results[0]["error"] == "coin_name 'taken' already exists"
+        assert results[1]["error"] == "Unknown duty_ids: missing"
+        assert results[2]["error"] == "coin_name is required"
+        assert results[3]["status"] == "created"
+        assert results[4]["error"] == "coin_name 'ok' already exists"
+        assert results[5]["error"] == "Coin not found"
+        assert sorted(c["coin_name"] for c in client.get("/coins").json) == ["ok", "taken"]
+
+    def test_batch_rejects_bad_types_per_item(self, client):
+        ksb_id = client.post("/ksbs", json={"ksb_name": "K1"}).json["id"]
+        coins = client.post(
+            "/coins/batch",
+            json=[{"coin_name": "a", "duty_ids": [1]}, {"coin_name": 5}, {"coin_name": "b"}],
+        )
+        assert coins.status_code == 200
+        results = coins.json["results"]
+        assert results[0]["error"] == "duty_ids must be a list of ids"
+        assert results[1]["error"] == "coin_name must be a string"
+        assert results[2]["status"] == "created"
+
+        ksbs = client.post("/ksbs/batch", json=[{"id": ksb_id, "ksb_name": None}, {"id": 7}])
+        assert ksbs.status_code == 200
+        assert ksbs.json["results"][0]["error"] == "ksb_name is required"
+        assert ksbs.json["results"][1]["error"] == "id must be a string"
+        assert client.get(f"/ksbs/{ksb_id}").json["ksb_name"] == "K1"
+
+    def test_batch_update(self, client):
+        duty_id = client.post("/duties", json={"duty_name": "duty_1"}).json["id"]
+        coin_id = client.post("/coins", json={"coin_name": "automate"}).json["id"]
+        client.get(f"/coins/{coin_id}")
+
+        response = client.post(
+            "/coins/batch",
+            json=[{"id": coin_id, "coin_name": "houston", "duty_ids": [duty_id]}],
+        )
+
+        assert response.json["results"][0]["status"] == "updated"
+        coin = client.get(f"/coins/{coin_id}").json
+        assert coin["coin_name"] == "houston"
+        assert [d["id"] for d in coin["duties"]] == [duty_id]
+
+    def test_batch_delete(self, client):
+        ksb_id = client.post("/ksbs", json={"ksb_name": "K1"}).json["id"]
+        duty_id = client.post("/duties", json={"duty_name": "d", "ksb_ids": [ksb_id]}).json["id"]
+        client.get(f"/duties/{duty_id}")
+
+        response = client.delete(f"/ksbs?ids={ksb_id},missing")
+
+        assert response.json["results"] == [
+            {"id": ksb_id, "status": "deleted"},
+            {"id": "missing", "error": "Ksb not found"},
+        ]
+        assert client.get(f"/ksbs/{ksb_id}").status_code == 404
+        assert client.get(f"/duties/{duty_id}").json["ksbs"] == []
+
+    def test_batch_delete_requires_ids(self, client):
+        assert client.delete("/coins").status_code == 400
+
+    def test_statement_count_does_not_grow_with_batch_size(self, client):
+        def statements_for(prefix, n):
+            with count_queries() as statements:
+                client.post(
+                    "/ksbs/batch", json=[{"ksb_name": f"{prefix}{i}"} for i in range(n)]
+                )
+            return len(statements)
+
+        assert statements_for("a", 5) == statements_for("b", 200)
+
+
+class TestReverseLookups:
+    def test_coins_for_duty(self, client):
+        duty_id = client.post("/duties", json={"duty_name": "duty_1"}).json["id"]
+        client.post("/coins", json={"coin_name": "linked", "duty_ids": [duty_id]})
+        client.post("/coins", json={"coin_name": "unlinked"})
+
+        response = client.get(f"/duties/{duty_id}/coins")
+
+        assert response.status_code == 200
+        assert [coin["coin_name"] for coin in response.json] == ["linked"]
+
+    def test_duties_for_ksb(self, client):
+        ksb_id = client.post("/ksbs", json={"ksb_name": "K1"}).json["id"]
+        client.post("/duties", json={"duty_name": "linked", "ksb_ids": [ksb_id]})
+        client.post("/duties", json={"duty_name": "unlinked"})
+
+        response = client.get(f"/ksbs/{ksb_id}/duties")
+
+        assert response.status_code == 200
+        assert [duty["duty_name"] for duty in response.json] == ["linked"]
+
+    def test_missing_parent(self, client):
+        assert client.get("/duties/missing/coins").status_code == 404
+        assert client.get("/ksbs/missing/duties").status_code == 404
+
+    def test_relinking_updates_cached_lookup(self, client):
+        duty_id = client.post("/duties", json={"duty_name": "duty_1"}).json["id"]
+        coin_id = client.post("/coins", json={"coin_name": "automate"}).json["id"]
+        assert client.get(f"/duties/{duty_id}/coins").json == []
+
+        client.put(f"/coins/{coin_id}", json={"duty_ids": [duty_id]})
+        assert [c["id"] for c in client.get(f"/duties/{duty_id}/coins").json] == [coin_id]
+
+        client.post("/coins/batch", json=[{"id": coin_id, "duty_ids": []}])
+        assert client.get(f"/duties/{duty_id}/coins").json == []
+
+    def test_lookup_uses_non_leading_key_index(self, client):
+        for table, column, index in (
+            ("coins_duties", "duty_pk", "ix_coins_duties_duty_pk_coin_pk"),
+            ("duties_ksbs", "ksb_pk", "ix_duties_ksbs_ksb_pk_duty_pk"),
+        ):
+            plan = db.session.execute(
+                text(f"EXPLAIN QUERY PLAN SELECT * FROM {table} WHERE {column} = 1")
+            ).all()
+            assert f"COVERING INDEX {index}" in " ".join(str(row[-1]) for row in plan)
+
+
+class TestFieldsets:
+    def seed(self, client):
+        ksb_id = client.post("/ksbs", json={"ksb_name": "K1"}).json["id"]
+        duty_id = client.post(
+            "/duties",
+            json={"duty_name": "duty_1", "description": "long text", "ksb_ids": [ksb_id]},
+        ).json["id"]
+        coin_id = client.post(
+            "/coins", json={"coin_name": "automate", "duty_ids": [duty_id]}
+        ).json["id"]
+        return coin_id, duty_id, ksb_id
+
+    def test_default_shape_is_unchanged(self, client):
+        coin_id, duty_id, _ = self.seed(client)
+        coin = client.get(f"/coins/{coin_id}").json
+        assert coin == {
+            "id": coin_id,
+            "coin_name": "automate",
+            "duties": [{"id": duty_id, "duty_name": "duty_1", "description": "long text"}],
+        }
+
+    def test_fields_and_include(self, client):
+        coin_id, duty_id, _ = self.seed(client)
+        response = client.get("/coins?fields=coin_name&include=duties(duty_name)")
+        assert response.json == [
+            {"id": coin_id, "coin_name": "automate", "duties": [{"id": duty_id, "duty_name": "duty_1"}]}
+        ]
+
+    def test_empty_include_skips_relationship(self, client):
+        _, duty_id, _ = self.seed(client)
+        with count_queries() as statements:
+            response = client.get(f"/duties/{duty_id}?fields=id,duty_name&include=")
+        assert response.json == {"id": duty_id, "duty_name": "duty_1"}
+        assert not any("duties_ksbs" in statement for statement in statements)
+        assert not any("duty_description" in statement for statement in statements)
+
+    def test_unselected_columns_are_not_loaded(self, client):
+        self.seed(client)
+        with count_queries() as statements:
+            client.get("/coins?include=duties(id,duty_name)")
+        assert not any("duty_description" in statement for statement in statements)
+
+    def test_fields_with_pagination(self, client):
+        _, _, ksb_id = self.seed(client)
+        response = client.get("/ksbs?limit=1&fields=id")
+        assert response.json["items"] == [{"id": ksb_id}]
+
+    def test_unknown_field(self, client):
+        response = client.get("/coins?fields=nope")
+        assert response.status_code == 400
+        assert response.json["error"] == "Unknown field 'nope'"
+        assert client.get("/coins?include=ksbs").status_code == 400
+        assert client.get("/coins?include=duties(nope)").status_code == 400
+
+
+class TestStreaming:
+    def seed(self, client, n=5):
+        client.post("/ksbs/batch", json=[{"ksb_name": f"K{i}"} for i in range(n)])
+
+    def test_stream_matches_buffered_body(self, client):
+        self.seed(client)
+        buffered = client.get("/ksbs")
+        streamed = client.get("/ksbs?stream=1")
+        assert "Content-Length" in buffered.headers
+        assert "Content-Length" not in streamed.headers
+        assert streamed.get_data() == buffered.get_data()
+        assert streamed.headers["ETag"] == buffered.headers["ETag"]
+
+    def test_ndjson(self, client):
+        self.seed(client)
+        response = client.get("/ksbs", headers={"Accept": "application/x-ndjson"})
+        assert response.mimetype == "application/x-ndjson"
+        lines = response.get_data(as_text=True).splitlines()
+        assert len(lines) == 5
+        assert sorted(json.loads(line)["ksb_name"] for line in lines) == [f"K{i}" for i in range(5)]
+        assert response.headers["ETag"] != client.get("/ksbs").headers["ETag"]
+
+    def test_streams_above_threshold(self, client, monkeypatch):
+        monkeypatch.setattr(streaming, "STREAM_THRESHOLD", 3)
+        monkeypatch.setattr(streaming, "CHUNK_SIZE", 2)
+        self.seed(client)
+        response = client.get("/ksbs")
+        assert "Content-Length" not in response.headers
+        assert len(json.loads(response.get_data())) == 5
+        assert "Content-Length" in client.get("/ksbs?stream=0").headers
+
+    def test_streamed_nested_collection(self, client, monkeypatch):
+        monkeypatch.setattr(streaming, "CHUNK_SIZE", 2)
+        ksb_id = client.post("/ksbs", json={"ksb_name": "K1"}).json["id"]
+        for i in range(5):
+            client.post("/duties", json={"duty_name": f"duty_{i}", "ksb_ids": [ksb_id]})
+        response = client.get("/duties?stream=1")
+        duties = json.loads(response.get_data())
+        assert len(duties) == 5
+        assert all(duty["ksbs"][0]["id"] == ksb_id for duty in duties)
+
+    def test_streamed_responses_are_not_cached(self, client):
+        self.seed(client)
+        client.get("/ksbs?stream=1").get_data()
+        assert response_cache.stats()["entries"] == 0
+
+
+class TestSerialization:
+    def test_encoders_produce_identical_bytes(self):
+        payload = [{"id": "1", "coin_name": "café", "duties": [], "description": None}]
+        encoded = {name: dumps(payload) for name, (dumps, _) in serialization.ENCODERS.items()}
+        assert len(set(encoded.values())) == 1
+
+    def test_unknown_encoder(self):
+        with pytest.raises(ValueError):
+            serialization.select_encoder("nope")
+
+    def test_responses_use_selected_encoder(self, client, monkeypatch):
+        client.post("/ksbs", json={"ksb_name": "K1"})
+        for name in serialization.ENCODERS:
+            monkeypatch.setattr(serialization, "encoder", name)
+            response = client.get("/ksbs?stream=0")
+            assert response.json[0]["ksb_name"] == "K1"
+            assert b", " not in response.data
+
+    def test_shared_child_payloads(self, client):
+        duty_id = client.post("/duties", json={"duty_name": "shared"}).json["id"]
+        client.post(
+            "/coins/batch",
+            json=[{"coin_name": f"coin_{i}", "duty_ids": [duty_id]} for i in range(3)],
+        )
+        coins = client.get("/coins").json
+        assert [coin["duties"] for coin in coins] == [
+            [{"id": duty_id, "duty_name": "shared", "description": None}]
+        ] * 3
+
+
+class TestCompression:
+    def seed(self, client, n=40):
+        client.post("/ksbs/batch", json=[{"ksb_name": f"KSB number {i}"} for i in range(n)])
+
+    def test_gzip_when_accepted(self, client):
+        self.seed(client)
+        plain = client.get("/ksbs")
+        response = client.get("/ksbs", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in response.headers["Vary"]
+        assert gzip.decompress(response.data) == plain.data
+        assert response.headers["ETag"] == plain.headers["ETag"][:-1] + '-gzip"'
+
+    def test_small_bodies_are_not_compressed(self, client):
+        client.post("/ksbs", json={"ksb_name": "K1"})
+        response = client.get("/ksbs", headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in response.headers
+
+    def test_identity_when_not_accepted(self, client):
+        self.seed(client)
+        assert "Content-Encoding" not in client.get("/ksbs").headers
+
+    def test_compressed_etag_revalidates(self, client):
+        self.seed(client)
+        headers = {"Accept-Encoding": "gzip"}
+        etag = client.get("/ksbs", headers=headers).headers["ETag"]
+        response = client.get("/ksbs", headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+
+    def test_compressed_variant_is_cached(self, client):
+        self.seed(client)
+        headers = {"Accept-Encoding": "gzip"}
+        first = client.get("/ksbs", headers=headers)
+        size = response_cache.stats()["bytes"]
+        second = client.get("/ksbs", headers=headers)
+        assert second.data == first.data
+        assert size > len(client.get("/ksbs").data)
+        assert response_cache.stats()["bytes"] == size
+
+    def test_streamed_response_is_compressed(self, client):
+        self.seed(client)
+        plain = client.get("/ksbs")
+        response = client.get("/ksbs?stream=1", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(response.get_data()) == plain.data
+
+
+class TestMetrics:
+    def count(self, route, status="200"):
+        labels = {"method": "GET", "route": route, "status": status}
+        return registry().get_sample_value("http_request_duration_seconds_count", labels) or 0
+
+    def test_requests_are_observed_by_route(self, client):
+        before = self.count("/coins/<ID>", "404")
+        client.get("/coins/missing")
+        assert self.count("/coins/<ID>", "404") == before + 1
+
+    def test_metrics_endpoint(self, client):
+        client.get("/ksbs")
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.mimetype == "text/plain"
+        assert 'http_request_duration_seconds_bucket{le="0.001",method="GET",route="/ksbs",status="200"}' in response.text
+
+    def test_metrics_endpoint_is_not_public(self, client):
+        assert client.get("/metrics", environ_base={"REMOTE_ADDR": "203.0.113.7"}).status_code == 404
+        assert client.get("/metrics", headers={"X-Forwarded-For": "203.0.113.7"}).status_code == 404
+        assert client.get("/metrics", headers={"X-Real-IP": "127.0.0.1"}).status_code == 404
+        assert client.get("/metrics", environ_base={"REMOTE_ADDR": "172.18.0.5"}).status_code == 200
+
+    def test_latency_summary(self, client):
+        client.get("/ksbs")
+        rows = [row for row in latency_summary() if row["route"] == "/ksbs"]
+        assert rows and rows[0]["count"] >= 1
+        assert rows[0]["p50"] <= rows[0]["p95"] <= rows[0]["p99"]
+
+    def test_bucket_quantile_interpolates(self):
+        buckets = [(0.1, 50.0), (0.2, 100.0), (float("inf"), 100.0)]
+        assert bucket_quantile(0.5, buckets) == pytest.approx(0.1)
+        assert bucket_quantile(0.75, buckets) == pytest.approx(0.15)
+
+
+class TestQueryStats:
+    def server_timing(self, response):
+        db_timing, total = response.headers["Server-Timing"].split(", ")
+        return db_timing, total
+
+    def test_server_timing_reports_queries(self, client):
+        client.post("/ksbs", json={"ksb_name": "K1"})
+        db_timing, total = self.server_timing(client.get("/ksbs"))
+        assert db_timing.startswith("db;dur=")
+        # the ETag lookup, the response cache's change log sync and the list
+        assert db_timing.endswith('desc="3 queries"')
+        assert total.startswith("total;dur=")
+
+    def test_cache_hits_run_no_queries(self, client):
+        client.get("/ksbs")
+        db_timing, _ = self.server_timing(client.get("/ksbs"))
+        assert db_timing.endswith('desc="1 queries"')
+
+    def test_repeated_statements_are_flagged(self, client, caplog, monkeypatch):
+        monkeypatch.setattr(query_stats, "REPEAT_THRESHOLD", 0)
+        with caplog.at_level("WARNING", logger="app.sql"):
+            client.get("/ksbs")
+        assert any(record.message.startswith("possible N+1: GET /ksbs") for record in caplog.records)
+
+    def test_statements_are_counted_per_request(self, client, caplog, monkeypatch):
+        monkeypatch.setattr(query_stats, "REPEAT_THRESHOLD", 1)
+        ids = [client.post("/ksbs", json={"ksb_name": name}).get_json()["id"] for name in "ABC"]
+        with caplog.at_level("WARNING", logger="app.sql"):
+            for ksb_id in ids:
+                client.get(f"/ksbs/{ksb_id}")
+        assert not any("N+1" in record.message for record in caplog.records)
+
+    def test_slow_queries_are_logged(self, client, caplog, monkeypatch):
+        monkeypatch.setattr(query_stats, "SLOW_QUERY_MS", 0)
+        with caplog.at_level("WARNING", logger="app.sql"):
+            client.get("/ksbs")
+        assert any(record.message.startswith("slow query") for record in caplog.records)
+
+
+class TestSeed:
+    def test_generate_is_deterministic(self):
+        first = list(generate(20, 4, 4, duties_per_coin=2, ksbs_per_duty=3, seed=7))
+        assert first == list(generate(20, 4, 4, duties_per_coin=2, ksbs_per_duty=3, seed=7))
+        assert first != list(generate(20, 4, 4, duties_per_coin=2, ksbs_per_duty=3, seed=8))
+        counts = {}
+        for name, rows in first:
+            counts[name] = counts.get(name, 0) + len(rows)
+        assert counts == {"coins": 20, "duties": 4, "ksbs": 4, "coins_duties": 40, "duties_ksbs": 12}
+
+    def test_seed_command(self, client):
+        etag = client.get("/coins").headers["ETag"]
+        result = app.test_cli_runner().invoke(seed_command, ["--coins", "30", "--duties-per-coin", "2"])
+        assert result.exit_code == 0, result.output
+        coins = client.get("/coins").get_json()
+        assert len(coins) == 30
+        assert all(len(coin["duties"]) == 2 for coin in coins)
+        assert len(client.get("/duties").get_json()) == 3
+        assert client.get("/coins").headers["ETag"] != etag
+        assert [coin["coin_name"] for coin in client.get("/coins?q=in 29&include=").get_json()] == ["Coin 29"]
+
+    def test_seed_from_csv(self, client, tmp_path):
+        (tmp_path / "ksbs.csv").write_text("id,ksb_name\nk1,First\nk2,Second\n")
+        (tmp_path / "duties.csv").write_text("id,duty_name,duty_description\nd1,Duty,\n")
+        (tmp_path / "duties_ksbs.csv").write_text("duty_id,ksb_id\nd1,k1\nd1,k2\n")
+        result = app.test_cli_runner().invoke(seed_command, ["--csv", str(tmp_path)])
+        assert result.exit_code == 0, result.output
+        duty = client.get("/duties/d1").get_json()
+        assert duty["description"] is None
+        assert sorted(ksb["ksb_name"] for ksb in duty["ksbs"]) == ["First", "Second"]
+
+
+class TestMigrations:
+    def test_string_keys_migrate_to_integer_keys(self, client):
+        etag = client.get("/coins").headers["ETag"]
+        with db.engine.begin() as connection:
+            for name in ("coins_duties", "duties_ksbs", "coins", "duties", "ksbs"):
+                connection.exec_driver_sql(f"DROP TABLE {name}")
+            for statement in (
+                "CREATE TABLE coins (id VARCHAR PRIMARY KEY, coin_name VARCHAR UNIQUE NOT NULL)",
+                "CREATE TABLE duties (id VARCHAR PRIMARY KEY, duty_name VARCHAR UNIQUE NOT NULL, duty_description VARCHAR)",
+                "CREATE TABLE ksbs (id VARCHAR PRIMARY KEY, ksb_name VARCHAR UNIQUE NOT NULL)",
+                "CREATE TABLE coins_duties (coin_id VARCHAR REFERENCES coins(id), duty_id VARCHAR REFERENCES duties(id), PRIMARY KEY (coin_id, duty_id))",
+                "CREATE TABLE duties_ksbs (duty_id VARCHAR REFERENCES duties(id), ksb_id VARCHAR REFERENCES ksbs(id), PRIMARY KEY (duty_id, ksb_id))",
+                "CREATE INDEX ix_coins_duties_duty_id ON coins_duties (duty_id)",
+                "INSERT INTO coins VALUES ('c1', 'Coin')",
+                "INSERT INTO duties VALUES ('d1', 'Duty', 'Desc'), ('d2', 'Other', NULL)",
+                "INSERT INTO ksbs VALUES ('k1', 'KSB')",
+                "INSERT INTO coins_duties VALUES ('c1', 'd1'), ('c1', 'd2')",
+                "INSERT INTO duties_ksbs VALUES ('d2', 'k1')",
+            ):
+                connection.exec_driver_sql(statement)
+
+        create_schema()
+
+        coin = client.get("/coins/c1").get_json()
+        assert coin["coin_name"] == "Coin"
+        assert sorted(duty["id"] for duty in coin["duties"]) == ["d1", "d2"]
+        assert [ksb["id"] for ksb in client.get("/duties/d2").get_json()["ksbs"]] == ["k1"]
+        assert [coin["id"] for coin in client.get("/duties/d1/coins").get_json()] == ["c1"]
+        assert client.get("/coins").headers["ETag"] != etag
+        created = client.post("/coins", json={"coin_name": "New"})
+        assert created.status_code == 201
+
+
+class TestSearch:
+    def test_ranks_exact_then_prefix_then_substring(self, client):
+        for name in ("Network Security", "Secure Coding", "Security", "Data Security Basics"):
+            client.post("/ksbs", json={"ksb_name": name})
+        names = [ksb["ksb_name"] for ksb in client.get("/ksbs?q=security").get_json()]
+        assert names[0] == "Security"
+        assert set(names[1:]) == {"Network Security", "Data Security Basics"}
+        names = [ksb["ksb_name"] for ksb in client.get("/ksbs?q=secur").get_json()]
+        assert set(names[:2]) == {"Secure Coding", "Security"}
+        assert len(names) == 4
+
+    def test_short_queries_match_word_prefixes(self, client):
+        for name in ("Go Basics", "Django", "Algorithms"):
+            client.post("/coins", json={"coin_name": name})
+        names = [coin["coin_name"] for coin in client.get("/coins?q=go").get_json()]
+        assert names == ["Go Basics"]
+
+    def test_index_follows_writes(self, client):
+        ksb_id = client.post("/ksbs", json={"ksb_name": "Testing"}).get_json()["id"]
+        client.put(f"/ksbs/{ksb_id}", json={"ksb_name": "Deployment"})
+        assert client.get("/ksbs?q=testing").get_json() == []
+        assert [ksb["id"] for ksb in client.get("/ksbs?q=deploy").get_json()] == [ksb_id]
+        client.post("/ksbs/batch", json=[{"ksb_name": "Deployment pipelines"}])
+        assert len(client.get("/ksbs?q=deploy").get_json()) == 2
+        client.delete(f"/ksbs/{ksb_id}")
+        assert [ksb["ksb_name"] for ksb in client.get("/ksbs?q=deploy").get_json()] == ["Deployment pipelines"]
+
+    def test_descriptions_and_includes(self, client):
+        ksb_id = client.post("/ksbs", json={"ksb_name": "K"}).get_json()["id"]
+        client.post("/duties", json={"duty_name": "Review", "description": "Peer review of 50% of changes", "ksb_ids": [ksb_id]})
+        duties = client.get("/duties?q=50%25").get_json()
+        assert [duty["duty_name"] for duty in duties] == ["Review"]
+        assert [ksb["id"] for ksb in duties[0]["ksbs"]] == [ksb_id]
+        assert client.get("/duties?q=100%25").get_json() == []
+
+    def test_search_endpoint(self, client):
+        client.post("/coins", json={"coin_name": "Cloud Engineer"})
+        client.post("/duties", json={"duty_name": "Operate cloud services"})
+        for i in range(5):
+            client.post("/ksbs", json={"ksb_name": f"Cloud skill {i}"})
+        response = client.get("/search?q=cloud&limit=3")
+        assert response.status_code == 200
+        assert response.headers["ETag"]
+        results = response.get_json()
+        assert [coin["coin_name"] for coin in results["coins"]] == ["Cloud Engineer"]
+        assert results["duties"] == [{"id": results["duties"][0]["id"], "duty_name": "Operate cloud services", "description": None}]
+        assert len(results["ksbs"]) == 3
+
+    def test_invalid_params(self, client):
+        assert client.get("/search?q=").status_code == 400
+        assert client.get("/search").status_code == 400
+        assert client.get("/coins?q=a&limit=0").status_code == 400
+        assert client.get("/search?q=abc&limit=x").status_code == 400
+
+    def test_quotes_in_query(self, client):
+        client.post("/ksbs", json={"ksb_name": 'The "right" tool'})
+        assert len(client.get('/ksbs?q="right"').get_json()) == 1
+
+    def test_uses_fts_index(self, client):
+        client.post("/coins", json={"coin_name": "Indexed"})
+        with count_queries() as statements:
+            client.get("/coins?q=index&include=")
+        search = next(s for s in statements if "MATCH" in s)
+        assert "coins_search" in search
+
+    def test_postgresql_indexes(self):
+        prefix, trigrams = DUTY_SEARCH.postgresql_ddl()
+        assert "ix_duties_duty_name_prefix ON duties (lower(duty_name) text_pattern_ops)" in prefix
+        assert "USING gin (duty_name gin_trgm_ops, duty_description gin_trgm_ops)" in trigrams
+
+
+class TestGraph:
+    def test_each_entity_once_with_links(self, client):
+        ksb_ids = [client.post("/ksbs", json={"ksb_name": f"K{i}"}).json["id"] for i in range(2)]
+        duty_ids = [
+            client.post("/duties", json={"duty_name": f"D{i}", "ksb_ids": ksb_ids}).json["id"]
+            for i in range(2)
+        ]
+        coin_ids = [
+            client.post("/coins", json={"coin_name": f"C{i}", "duty_ids": duty_ids}).json["id"]
+            for i in range(3)
+        ]
+
+        response = client.get("/graph")
+        assert response.status_code == 200
+        graph = response.get_json()
+        assert [coin["id"] for coin in graph["coins"]] == coin_ids
+        assert graph["coins"][0] == {"id": coin_ids[0], "coin_name": "C0"}
+        assert graph["duties"][0] == {"id": duty_ids[0], "duty_name": "D0", "description": None}
+        assert [ksb["id"] for ksb in graph["ksbs"]] == ksb_ids
+        assert graph["coins_duties"] == [[c, d] for c in coin_ids for d in duty_ids]
+        assert graph["duties_ksbs"] == [[d, k] for d in duty_ids for k in ksb_ids]
+
+        etag = response.headers["ETag"]
+        assert client.get("/graph", headers={"If-None-Match": etag}).status_code == 304
+        client.put(f"/coins/{coin_ids[0]}", json={"duty_ids": []})
+        graph = client.get("/graph").get_json()
+        assert [c for c, _ in graph["coins_duties"]].count(coin_ids[0]) == 0
+
+    def test_query_count_is_constant(self, client):
+        for i in range(3):
+            ksb_id = client.post("/ksbs", json={"ksb_name": f"K{i}"}).json["id"]
+            duty_id = client.post("/duties", json={"duty_name": f"D{i}", "ksb_ids": [ksb_id]}).json["id"]
+            client.post("/coins", json={"coin_name": f"C{i}", "duty_ids": [duty_id]})
+        with count_queries() as statements:
+            client.get("/graph")
+        # the ETag lookup, the response cache's change log sync, the change
+        # log seq, three entity tables and two link tables
+        assert len(statements) == 8
+
+
+class TestChanges:
+    def test_feed_follows_writes(self, client):
+        seq = client.get("/graph").get_json()["seq"]
+        ksb_id = client.post("/ksbs", json={"ksb_name": "K"}).json["id"]
+        duty_id = client.post("/duties", json={"duty_name": "D", "ksb_ids": [ksb_id]}).json["id"]
+        coin_id = client.post("/coins", json={"coin_name": "C", "duty_ids": [duty_id]}).json["id"]
+        client.put(f"/coins/{coin_id}", json={"coin_name": "Renamed"})
+
+        feed = client.get(f"/changes?since={seq}").get_json()
+        assert feed["since"] == seq and not feed["more"]
+        assert feed["upserts"]["coins"] == [{"id": coin_id, "coin_name": "Renamed"}]
+        assert feed["upserts"]["duties"] == [{"id": duty_id, "duty_name": "D", "description": None}]
+        assert feed["upserts"]["ksbs"] == [{"id": ksb_id, "ksb_name": "K"}]
+        assert feed["upserts"]["coins_duties"] == [[coin_id, duty_id]]
+        assert feed["upserts"]["duties_ksbs"] == [[duty_id, ksb_id]]
+        assert client.get(f"/changes?since={feed['next']}").get_json()["upserts"]["coins"] == []
+
+        seq = feed["next"]
+        client.put(f"/coins/{coin_id}", json={"duty_ids": []})
+        client.delete(f"/ksbs/{ksb_id}")
+        feed = client.get(f"/changes?since={seq}").get_json()
+        assert feed["upserts"]["coins"] == []
+        assert feed["deletes"]["coins_duties"] == [[coin_id, duty_id]]
+        assert feed["deletes"]["ksbs"] == [ksb_id]
+        assert feed["next"] == client.get("/graph").get_json()["seq"]
+
+    def test_batch_writes_are_logged(self, client):
+        duty_ids = [client.post("/duties", json={"duty_name": f"D{i}"}).json["id"] for i in range(2)]
+        coin_id = client.post("/coins", json={"coin_name": "C", "duty_ids": [duty_ids[0]]}).json["id"]
+        seq = client.get("/graph").get_json()["seq"]
+        results = client.post(
+            "/coins/batch",
+            json=[{"id": coin_id, "duty_ids": [duty_ids[1]]}, {"coin_name": "New"}],
+        ).json["results"]
+        client.delete(f"/duties?ids={duty_ids[0]}")
+
+        feed = client.get(f"/changes?since={seq}").get_json()
+        assert [coin["id"] for coin in feed["upserts"]["coins"]] == [results[1]["id"]]
+        assert feed["upserts"]["coins_duties"] == [[coin_id, duty_ids[1]]]
+        assert feed["deletes"]["coins_duties"] == [[coin_id, duty_ids[0]]]
+        assert feed["deletes"]["duties"] == [duty_ids[0]]
+
+    def test_paging_with_limit(self, client):
+        seq = client.get("/graph").get_json()["seq"]
+        ids = [client.post("/ksbs", json={"ksb_name": f"K{i}"}).json["id"] for i in range(5)]
+        seen = []
+        while True:
+            feed = client.get(f"/changes?since={seq}&limit=2").get_json()
+            seen += [ksb["id"] for ksb in feed["upserts"]["ksbs"]]
+            seq = feed["next"]
+            if not feed["more"]:
+                break
+        assert seen == ids
+
+    def test_compaction(self, client):
+        start = client.get("/graph").get_json()["seq"]
+        ksb_id = client.post("/ksbs", json={"ksb_name": "K0"}).json["id"]
+        for i in range(1, 5):
+            client.put(f"/ksbs/{ksb_id}", json={"ksb_name": f"K{i}"})
+        other = client.post("/ksbs", json={"ksb_name": "Other"}).json["id"]
+
+        changes.compact(db.session, retain=10)
+        db.session.commit()
+        assert db.session.execute(text("SELECT count(*) FROM changes")).scalar() == 2
+        feed = client.get(f"/changes?since={start}").get_json()
+        assert feed["upserts"]["ksbs"] == [{"id": ksb_id, "ksb_name": "K4"}, {"id": other, "ksb_name": "Other"}]
+
+        top = feed["next"]
+        changes.compact(db.session, retain=1)
+        db.session.commit()
+        assert client.get(f"/changes?since={start}").status_code == 410
+        assert client.get(f"/changes?since={top - 1}").status_code == 200
+        assert client.get(f"/changes?since={top + 1}").status_code == 410
+
+    def test_bulk_load_resets_readers(self, client):
+        seq = client.get("/graph").get_json()["seq"]
+        result = app.test_cli_runner().invoke(seed_command, ["--coins", "5"])
+        assert result.exit_code == 0, result.output
+        assert client.get(f"/changes?since={seq}").status_code == 410
+        graph = client.get("/graph").get_json()
+        assert len(graph["coins"]) == 5
+        assert client.get(f"/changes?since={graph['seq']}").status_code == 200
+
+    def test_invalid_params(self, client):
+        assert client.get("/changes?since=x").status_code == 400
+        assert client.get("/changes?limit=0").status_code == 400
+
+
+class TestEngine:
+    def test_pool_options(self, monkeypatch):
+        monkeypatch.setenv("DB_POOL_SIZE", "12")
+        assert engine_options("postgresql://db/app") == {
+            "pool_pre_ping": True,
+            "pool_recycle": 1800,
+            "pool_size": 12,
+            "max_overflow": 10,
+            "pool_timeout": 30.0,
+        }
+        assert engine_options("sqlite:///app.db")["pool_pre_ping"] is False
+        assert engine_options("sqlite:///app.db")["pool_size"] == 12
+        assert "pool_size" not in engine_options("sqlite:///:memory:")
+
+    def test_sqlite_pragmas(self, tmp_path):
+        with app.app_context():
+            assert event.contains(db.engine, "connect", set_sqlite_pragmas)
+        engine = create_engine(f"sqlite:///{tmp_path / 'app.db'}")
+        event.listen(engine, "connect", set_sqlite_pragmas)
+        with engine.connect() as connection:
+            assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+            assert connection.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+            assert connection.exec_driver_sql("PRAGMA busy_timeout").scalar() == 10000
+            assert connection.exec_driver_sql("PRAGMA cache_size").scalar() == -64 * 1024
+        engine.dispose()
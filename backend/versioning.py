@@ -0,0 +1,83 @@
+from flask import Response, g, request
+from functools import wraps
+from sqlalchemy import event, select, update
+from app.extensions import db
+from http_compression import strip_encoding
+from app.models import table_versions
+from app.streaming import wants_ndjson
+
+
+def bump(*tables):
+    # Counted once per table when the session commits; see bump_versions.
+    db.session.info.setdefault("bumped", set()).update(tables)
+
+
+@event.listens_for(db.session, "before_commit")
+def bump_versions(session):
+    # The counter rows are hot, so they are taken as late as possible and in
+    # one global order: every writer locks them sorted by name, right before
+    # commit, and two writers touching overlapping tables cannot deadlock.
+    tables = sorted(session.info.pop("bumped", ()))
+    if not tables:
+        return
+    session.flush()
+    matching = table_versions.c.table_name.in_(tables)
+    if db.engine.dialect.name != "sqlite":
+        session.execute(
+            select(table_versions.c.table_name).where(matching).order_by(table_versions.c.table_name).with_for_update()
+        )
+    session.execute(update(table_versions).where(matching).values(version=table_versions.c.version + 1))
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_bumps(session):
+    session.info.pop("bumped", None)
+
+
+def current_versions(tables):
+    rows = db.session.execute(
+        select(table_versions.c.table_name, table_versions.c.version).where(
+            table_versions.c.table_name.in_(tables)
+        )
+    )
+    return dict(rows.all())
+
+
+def etag_for(tables, versions=None):
+    versions = current_versions(tables) if versions is None else versions
+    return "-".join(str(versions.get(name, 0)) for name in tables)
+
+
+def conditional(*tables):
+    # Answer If-None-Match from the version counters alone; the view (and with
+    # it the ORM and the serializer) only runs when the client copy is stale.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            g.versions = current_versions(tables)
+            etag = etag_for(tables, g.versions)
+            if wants_ndjson():
+                etag += "-ndjson"
+            g.etag = etag
+            # Compressed variants carry an encoding suffix; they are current
+            # whenever the underlying representation is.
+            for tag in request.if_none_match.as_set():
+                if strip_encoding(tag) == etag:
+                    response = Response(status=304)
+                    response.set_etag(tag)
+                    return response
+
+            response = view(*args, **kwargs)
+            if isinstance(response, Response) and response.status_code == 200:
+                # "*" matches any current representation, so it needs the
+                # view to say whether there is one; a 404 stays a 404.
+                if request.if_none_match.star_tag:
+                    response.close()
+                    response = Response(status=304)
+                response.set_etag(etag)
+                response.vary.add("Accept")
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,169 @@
+"""Concurrent read/write throughput of the backend on one SQLite file.
+
+Run from the repository root:
+
+    python -m benchmarks.contention [--scale 1k] [--duration 5] [--processes 4]
+                                    [--readers 4] [--writers 2] [--profile defaults|tuned|both]
+                                    [--output contention.json]
+
+Several backend processes, like gunicorn workers, share one seeded SQLite
+file. In each of them reader threads fetch coins and duties while writer
+threads rewrite coins and their duty links, all at once, for --duration
+seconds. "defaults" runs with the SQLite settings the engine had before it
+was tuned (rollback journal, synchronous=FULL, pysqlite's 5s busy timeout,
+no mmap, 2 MiB cache); "tuned" runs with the settings in
+backend/extensions.py. A failed request is usually "database is locked".
+"""
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.load import ROOT, import_backend, percentile, sample_ids, seed, sizes_for
+
+PROFILES = {
+    "defaults": {
+        "SQLITE_JOURNAL_MODE": "DELETE",
+        "SQLITE_SYNCHRONOUS": "FULL",
+        "SQLITE_BUSY_TIMEOUT": "5000",
+        "SQLITE_MMAP_SIZE": "0",
+        "SQLITE_CACHE_SIZE": "-2000",
+    },
+    "tuned": {},
+}
+
+
+def reads(ids):
+    coins, duties = ids["coins"], ids["duties"]
+    return itertools.chain.from_iterable(
+        (f"/coins/{coin}", f"/duties/{duty}/coins", "/coins?limit=100")
+        for coin, duty in zip(itertools.cycle(coins), itertools.cycle(duties))
+    )
+
+
+def run_worker(db_path, args):
+    app = import_backend(db_path)
+    # Failures are counted, not logged.
+    app.logger.disabled = True
+    ids = sample_ids(lambda path: app.test_client().get(path).get_json())
+    coins, duties = ids["coins"], ids["duties"]
+    results = {"read": [], "write": []}
+    errors = {"read": 0, "write": 0}
+    lock = threading.Lock()
+
+    def worker(kind, n, slot):
+        client = app.test_client()
+        latencies, failed = [], 0
+        requests = reads(ids) if kind == "read" else itertools.count()
+        time.sleep(max(0.0, args.start_at - time.time()))
+        deadline = time.perf_counter() + args.duration
+        for i, request in zip(itertools.count(n), requests):
+            if time.perf_counter() >= deadline:
+                break
+            start = time.perf_counter()
+            if kind == "read":
+                response = client.get(request)
+            else:
+                # Each writer has coins of its own, so writers contend for the
+                # database lock rather than for the same rows.
+                coin = coins[(request * writers + slot) % len(coins)]
+                response = client.put(f"/coins/{coin}", json={
+                    "coin_name": f"Contention coin {slot}-{request}",
+                    "duty_ids": duties[i % len(duties):][:5],
+                })
+            latencies.append(time.perf_counter() - start)
+            failed += response.status_code >= 400
+        with lock:
+            results[kind].extend(latencies)
+            errors[kind] += failed
+
+    writers = args.processes * args.writers
+    threads = [
+        threading.Thread(target=worker, args=(kind, n * 7919, args.worker_index * count + n))
+        for kind, count in (("read", args.readers), ("write", args.writers))
+        for n in range(count)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {kind: {"latencies": results[kind], "errors": errors[kind]} for kind in results}
+
+
+def run_profile(db_path, profile, args):
+    env = {**os.environ, **PROFILES[profile]}
+    start_at = time.time() + 3 + args.processes
+    workers = [
+        subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.contention", *sys.argv[1:],
+             "--run-worker", str(index), "--db", db_path, "--start-at", str(start_at)],
+            cwd=ROOT,
+            env=env,
+            stdout=subprocess.PIPE,
+        )
+        for index in range(args.processes)
+    ]
+    outputs = [json.loads(worker.communicate()[0]) for worker in workers]
+
+    summary = {}
+    for kind in ("read", "write"):
+        latencies = sorted(itertools.chain.from_iterable(output[kind]["latencies"] for output in outputs))
+        summary[kind] = {
+            "requests": len(latencies),
+            "errors": sum(output[kind]["errors"] for output in outputs),
+            "rps": round(len(latencies) / args.duration, 1),
+        }
+        for q in (0.5, 0.99):
+            summary[kind][f"p{round(q * 100)}_ms"] = round(percentile(latencies, q) * 1000, 2) if latencies else None
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", default="1k", help="1k, 10k, 100k or a coin count")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per profile")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=4, help="reader threads per process")
+    parser.add_argument("--writers", type=int, default=2, help="writer threads per process")
+    parser.add_argument("--profile", choices=(*PROFILES, "both"), default="both")
+    parser.add_argument("--output", default="contention_results.json")
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    parser.add_argument("--run-worker", dest="worker_index", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--start-at", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker_index is not None:
+        json.dump(run_worker(args.db, args), sys.stdout)
+        return
+
+    profiles = tuple(PROFILES) if args.profile == "both" else (args.profile,)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        seeded = os.path.join(tmp, "seed.db")
+        seed(seeded, sizes_for(args.scale), args.seed)
+        for profile in profiles:
+            # Every profile starts from the same data, whatever the last one wrote.
+            db_path = os.path.join(tmp, f"{profile}.db")
+            shutil.copy(seeded, db_path)
+            results[profile] = run_profile(db_path, profile, args)
+            for kind, result in results[profile].items():
+                print(
+                    f"{profile:>8} {kind:<5} {result['rps']:>9} req/s  p50 {result['p50_ms']}ms"
+                    f"  p99 {result['p99_ms']}ms  errors {result['errors']}",
+                    file=sys.stderr,
+                )
+
+    with open(args.output, "w") as f:
+        json.dump({"meta": vars(args), "results": results}, f, indent=2)
+    print(f"wrote {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
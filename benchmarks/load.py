@@ -0,0 +1,451 @@
+"""Throughput and latency of every backend route and the main frontend pages.
+
+Run from the repository root:
+
+    python -m benchmarks.load [--scale 1k|10k|100k] [--target backend|frontend|all]
+                              [--duration 2] [--concurrency 8] [--output results.json]
+                              [--baseline benchmarks/baseline.json] [--threshold 0.25]
+                              [--save-baseline]
+
+A seeded SQLite file is built once per run. The backend is driven in-process
+through Flask test clients. The frontend is driven in-process too, talking
+over local HTTP to a backend served from a child process, as it does in
+production. Each target runs in its own process, because the two apps
+register the same metric names. Results go to --output as JSON and are
+compared against the baseline file when it exists and was recorded at the
+same scale; any route whose throughput or p99 moved by more than --threshold
+makes the run exit non-zero.
+"""
+import argparse
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_BASELINE = Path(__file__).with_name("baseline.json")
+SAMPLE_IDS = 200
+SCALES = {"1k": 1_000, "10k": 10_000, "100k": 100_000}
+
+
+def sizes_for(scale, duties_per_coin=5, ksbs_per_duty=5):
+    coins = SCALES[scale] if scale in SCALES else int(scale)
+    return {
+        "coins": coins,
+        "duties": max(coins // 10, duties_per_coin),
+        "ksbs": max(coins // 10, ksbs_per_duty),
+        "duties_per_coin": duties_per_coin,
+        "ksbs_per_duty": ksbs_per_duty,
+    }
+
+
+class Scenario:
+    def __init__(self, name, requests, role=None, on_response=None):
+        self.name = name
+        self.requests = requests
+        self.role = role
+        self.on_response = on_response
+        self.lock = threading.Lock()
+
+    def next(self):
+        with self.lock:
+            return next(self.requests, None)
+
+
+def get(path):
+    return itertools.repeat(("GET", path, None))
+
+
+def each(values, request):
+    return (request(value) for value in itertools.cycle(values))
+
+
+def numbered(request):
+    return (request(n) for n in itertools.count())
+
+
+def drain(values, request, size=1):
+    # Consumes ids created by an earlier scenario; stops when they run out.
+    def requests():
+        while len(values) >= size:
+            yield request([values.pop() for _ in range(size)])
+    return requests()
+
+
+def collect(values):
+    def on_response(body):
+        if "results" in body:
+            values.extend(result["id"] for result in body["results"] if "id" in result)
+        else:
+            values.append(body["id"])
+    return on_response
+
+
+def backend_scenarios(ids):
+    coins, duties, ksbs = ids["coins"], ids["duties"], ids["ksbs"]
+    created = {"coins": [], "duties": [], "ksbs": []}
+    batched = {"coins": [], "duties": [], "ksbs": []}
+    scenarios = [
+        Scenario("GET /coins", get("/coins")),
+        Scenario("GET /coins?limit=100", get("/coins?limit=100")),
+        Scenario("GET /coins/<ID>", each(coins, lambda id: ("GET", f"/coins/{id}", None))),
+        Scenario("GET /duties", get("/duties")),
+        Scenario("GET /duties/<ID>", each(duties, lambda id: ("GET", f"/duties/{id}", None))),
+        Scenario("GET /duties/<ID>/coins", each(duties, lambda id: ("GET", f"/duties/{id}/coins", None))),
+        Scenario("GET /ksbs", get("/ksbs")),
+        Scenario("GET /ksbs/<ID>", each(ksbs, lambda id: ("GET", f"/ksbs/{id}", None))),
+        Scenario("GET /ksbs/<ID>/duties", each(ksbs, lambda id: ("GET", f"/ksbs/{id}/duties", None))),
+        Scenario("GET /cache/stats", get("/cache/stats")),
+        Scenario("GET /search?q=", numbered(lambda n: ("GET", f"/search?q=Coin%20{n % 1000}", None))),
+        Scenario("GET /duties?q=", numbered(lambda n: ("GET", f"/duties?q=of%20duty%20{n % 1000}", None))),
+        Scenario(
+            "POST /ksbs",
+            numbered(lambda n: ("POST", "/ksbs", {"ksb_name": f"Bench KSB {n}"})),
+            on_response=collect(created["ksbs"]),
+        ),
+        Scenario(
+            "POST /duties",
+            numbered(lambda n: ("POST", "/duties", {
+                "duty_name": f"Bench duty {n}",
+                "description": f"Bench description {n}",
+                "ksb_ids": ksbs[n % len(ksbs):][:5],
+            })),
+            on_response=collect(created["duties"]),
+        ),
+        Scenario(
+            "POST /coins",
+            numbered(lambda n: ("POST", "/coins", {
+                "coin_name": f"Bench coin {n}",
+                "duty_ids": duties[n % len(duties):][:5],
+            })),
+            on_response=collect(created["coins"]),
+        ),
+        Scenario(
+            "PUT /ksbs/<ID>",
+            numbered(lambda n: ("PUT", f"/ksbs/{ksbs[n % len(ksbs)]}", {"ksb_name": f"Renamed KSB {n}"})),
+        ),
+        Scenario(
+            "PUT /duties/<ID>",
+            numbered(lambda n: ("PUT", f"/duties/{duties[n % len(duties)]}", {
+                "duty_name": f"Renamed duty {n}",
+                "ksb_ids": ksbs[n % len(ksbs):][:5],
+            })),
+        ),
+        Scenario(
+            "PUT /coins/<ID>",
+            numbered(lambda n: ("PUT", f"/coins/{coins[n % len(coins)]}", {
+                "coin_name": f"Renamed coin {n}",
+                "duty_ids": duties[n % len(duties):][:5],
+            })),
+        ),
+    ]
+    for kind, field in (("ksbs", "ksb_name"), ("duties", "duty_name"), ("coins", "coin_name")):
+        scenarios.append(Scenario(
+            f"POST /{kind}/batch",
+            numbered(lambda n, kind=kind, field=field: ("POST", f"/{kind}/batch", [
+                {field: f"Bench batch {kind} {n}-{i}"} for i in range(10)
+            ])),
+            on_response=collect(batched[kind]),
+        ))
+    for kind in ("coins", "duties", "ksbs"):
+        scenarios.append(Scenario(
+            f"DELETE /{kind}/<ID>",
+            drain(created[kind], lambda ids, kind=kind: ("DELETE", f"/{kind}/{ids[0]}", None)),
+        ))
+        scenarios.append(Scenario(
+            f"DELETE /{kind}?ids=",
+            drain(batched[kind], lambda ids, kind=kind: ("DELETE", f"/{kind}?ids={','.join(ids)}", None), size=10),
+        ))
+    return scenarios
+
+
+def frontend_scenarios(ids):
+    coins, duties = ids["coins"], ids["duties"]
+    return [
+        Scenario("GET /", get("/")),
+        Scenario("GET /?duty_id=<ID>", each(duties, lambda id: ("GET", f"/?duty_id={id}", None))),
+        Scenario("GET /admin", get("/admin"), role="admin"),
+        Scenario(
+            "GET /admin/coins/<ID>/edit",
+            each(coins, lambda id: ("GET", f"/admin/coins/{id}/edit", None)),
+            role="admin",
+        ),
+        Scenario(
+            "GET /admin/duties/<ID>/edit",
+            each(duties, lambda id: ("GET", f"/admin/duties/{id}/edit", None)),
+            role="admin",
+        ),
+        Scenario("GET /logs", get("/logs"), role="admin"),
+    ]
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def measure(scenario, make_client, duration, concurrency):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        client = make_client(scenario.role)
+        local = []
+        failed = 0
+        while time.perf_counter() < deadline:
+            request = scenario.next()
+            if request is None:
+                break
+            method, path, body = request
+            start = time.perf_counter()
+            response = client.open(path, method=method, json=body)
+            local.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                failed += 1
+            elif scenario.on_response:
+                scenario.on_response(response.get_json())
+        with lock:
+            latencies.extend(local)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    result = {"requests": len(latencies), "errors": sum(errors), "rps": round(len(latencies) / elapsed, 1)}
+    for q in (0.5, 0.95, 0.99):
+        result[f"p{round(q * 100)}_ms"] = round(percentile(latencies, q) * 1000, 2) if latencies else None
+    return result
+
+
+def run_scenarios(target, scenarios, make_client, args):
+    results = {}
+    for scenario in scenarios:
+        result = measure(scenario, make_client, args.duration, args.concurrency)
+        results[f"{target} {scenario.name}"] = result
+        print(
+            f"{target:>8} {scenario.name:<28} {result['rps']:>9} req/s  p50 {result['p50_ms']}ms"
+            f"  p99 {result['p99_ms']}ms  errors {result['errors']}",
+            file=sys.stderr,
+        )
+    return results
+
+
+def sample_ids(get_json):
+    return {
+        kind: [item["id"] for item in get_json(f"/{kind}?limit={SAMPLE_IDS}&fields=id&include=")["items"]]
+        for kind in ("coins", "duties", "ksbs")
+    }
+
+
+def backend_layout():
+    # The backend imports itself as the `app` package and the shared modules
+    # top-level, as laid out in its image: make a checkout look the same.
+    if str(ROOT / "common") not in sys.path:
+        sys.path.insert(0, str(ROOT / "common"))
+    if "app" not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            "app", ROOT / "backend" / "__init__.py", submodule_search_locations=[str(ROOT / "backend")]
+        )
+        sys.modules["app"] = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(sys.modules["app"])
+
+
+def import_backend(db_path):
+    os.environ["db_url"] = f"sqlite:///{db_path}"
+    backend_layout()
+    from app.app import app
+
+    logging.getLogger("app.sql").setLevel(logging.ERROR)
+    return app
+
+
+def run_backend(db_path, args):
+    app = import_backend(db_path)
+    ids = sample_ids(lambda path: app.test_client().get(path).get_json())
+    return run_scenarios("backend", backend_scenarios(ids), lambda role: app.test_client(), args)
+
+
+def serve_backend(db_path, port):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    make_server(
+        "127.0.0.1", port, import_backend(db_path), threaded=True, request_handler=QuietHandler
+    ).serve_forever()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_frontend(db_path, args):
+    import requests
+
+    port = free_port()
+    backend_url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.load", "--serve-backend", str(port), "--db", db_path],
+        cwd=ROOT,
+    )
+    try:
+        for _ in range(300):
+            try:
+                requests.get(f"{backend_url}/cache/stats", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        ids = sample_ids(lambda path: requests.get(f"{backend_url}{path}").json())
+
+        os.environ["BACKEND_URL"] = backend_url
+        sys.path[:0] = [str(ROOT / "frontend"), str(ROOT / "common")]
+        spec = importlib.util.spec_from_file_location("frontend_app", ROOT / "frontend" / "app.py")
+        frontend = sys.modules[spec.name] = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(frontend)
+
+        def make_client(role):
+            client = frontend.app.test_client()
+            if role:
+                with client.session_transaction() as session:
+                    session["username"] = "bench"
+                    session["role"] = role
+            return client
+
+        return run_scenarios("frontend", frontend_scenarios(ids), make_client, args)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def seed(db_path, sizes, seed_value):
+    from sqlalchemy import create_engine
+
+    backend_layout()
+    from app.extensions import db
+    from app.seed import generate, load
+
+    engine = create_engine(f"sqlite:///{db_path}")
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        load(connection, generate(**sizes, seed=seed_value))
+    engine.dispose()
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if not previous or not previous["rps"] or not current["requests"]:
+            continue
+        if current["rps"] < previous["rps"] * (1 - threshold):
+            regressions.append(f"{name}: throughput {previous['rps']} -> {current['rps']} req/s")
+        if current["p99_ms"] > previous["p99_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p99 {previous['p99_ms']} -> {current['p99_ms']} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", default="1k", help="1k, 10k, 100k or a coin count")
+    parser.add_argument("--duties-per-coin", type=int, default=5)
+    parser.add_argument("--ksbs-per-duty", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--target", choices=("backend", "frontend", "all"), default="all")
+    parser.add_argument("--duration", type=float, default=2.0, help="seconds per route")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE))
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    parser.add_argument("--serve-backend", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--run-target", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve_backend:
+        return serve_backend(args.db, args.serve_backend)
+    if args.run_target:
+        run = run_backend if args.run_target == "backend" else run_frontend
+        json.dump(run(args.db, args), sys.stdout)
+        return
+
+    sizes = sizes_for(args.scale, args.duties_per_coin, args.ksbs_per_duty)
+    targets = ("backend", "frontend") if args.target == "all" else (args.target,)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        seeded = os.path.join(tmp, "seed.db")
+        started = time.perf_counter()
+        seed(seeded, sizes, args.seed)
+        print(f"seeded {sizes} in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        for target in targets:
+            # Every target starts from the same data, whatever the last one wrote.
+            db_path = os.path.join(tmp, f"{target}.db")
+            shutil.copy(seeded, db_path)
+            child = subprocess.run(
+                [sys.executable, "-m", "benchmarks.load", *sys.argv[1:], "--run-target", target, "--db", db_path],
+                cwd=ROOT,
+                stdout=subprocess.PIPE,
+                check=True,
+            )
+            results.update(json.loads(child.stdout))
+
+    report = {
+        "meta": {
+            "scale": args.scale,
+            "sizes": sizes,
+            "seed": args.seed,
+            "duration": args.duration,
+            "concurrency": args.concurrency,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {args.output}", file=sys.stderr)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"saved baseline {args.baseline}", file=sys.stderr)
+        return
+    if not os.path.exists(args.baseline):
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["meta"]["scale"] != args.scale:
+        print(f"baseline was recorded at scale {baseline['meta']['scale']}, not comparing", file=sys.stderr)
+        return
+    regressions = compare(results, baseline["results"], args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
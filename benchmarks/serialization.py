@@ -0,0 +1,58 @@
+"""Encode-time microbenchmark for the backend JSON layer.
+
+Run from the repository root:
+
+    python -m benchmarks.serialization [--coins 10000] [--duties-per-coin 5]
+"""
+import argparse
+import time
+import uuid
+
+from backend.serialization import ENCODERS
+
+
+def coin_payload(coins, duties_per_coin, distinct_duties=200):
+    duties = [
+        {"id": str(uuid.uuid4()), "duty_name": f"Duty {i}", "description": f"Description of duty {i}"}
+        for i in range(distinct_duties)
+    ]
+    return [
+        {
+            "id": str(uuid.uuid4()),
+            "coin_name": f"Coin {i}",
+            "duties": [duties[(i + j) % distinct_duties] for j in range(duties_per_coin)],
+        }
+        for i in range(coins)
+    ]
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--coins", type=int, default=10_000)
+    parser.add_argument("--duties-per-coin", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    payload = coin_payload(args.coins, args.duties_per_coin)
+    print(f"{args.coins} coins x {args.duties_per_coin} duties")
+    baseline = None
+    for name, (dumps, _) in ENCODERS.items():
+        seconds = best_of(lambda: dumps(payload), args.repeat)
+        baseline = baseline or seconds
+        print(
+            f"{name:>8}: {seconds * 1000:8.2f} ms  {len(dumps(payload)):>10} bytes"
+            f"  {baseline / seconds:5.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+from flask import g, request
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    # The standard library's, from Python 3.14.
+    from compression import zstd
+except ImportError:
+    zstd = None
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+
+MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+LEVELS = {
+    "zstd": int(os.getenv("COMPRESS_LEVEL_ZSTD", "3")),
+    "br": int(os.getenv("COMPRESS_LEVEL_BR", "5")),
+    "gzip": int(os.getenv("COMPRESS_LEVEL_GZIP", "6")),
+}
+
+
+class Compressor:
+    def __init__(self, compress, flush):
+        self.compress = compress
+        self.flush = flush
+
+
+def gzip_compressor(level):
+    obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return Compressor(obj.compress, obj.flush)
+
+
+def brotli_compressor(level):
+    obj = brotli.Compressor(quality=level)
+    return Compressor(obj.process, obj.finish)
+
+
+def zstd_compressor(level):
+    if zstd is not None:
+        obj = zstd.ZstdCompressor(level=level)
+    else:
+        obj = zstandard.ZstdCompressor(level=level).compressobj()
+    return Compressor(obj.compress, obj.flush)
+
+
+# Preference order when the client accepts several with the same quality.
+COMPRESSORS = {}
+if zstd is not None or zstandard is not None:
+    COMPRESSORS["zstd"] = zstd_compressor
+if brotli is not None:
+    COMPRESSORS["br"] = brotli_compressor
+COMPRESSORS["gzip"] = gzip_compressor
+
+
+def negotiate():
+    best, best_quality = None, 0
+    for encoding in COMPRESSORS:
+        quality = request.accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(encoding, data):
+    compressor = COMPRESSORS[encoding](LEVELS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(encoding, chunks):
+    compressor = COMPRESSORS[encoding](LEVELS[encoding])
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def strip_encoding(etag):
+    base, _, suffix = etag.rpartition("-")
+    return base if base and suffix in LEVELS else etag
+
+
+def init_compression(app, variants=None):
+    # Compresses bodies for clients that send Accept-Encoding. Each encoding
+    # gets its own strong ETag ("<etag>-gzip"). When a variant store is given,
+    # compressed bodies are kept next to the cached plain body (keyed by
+    # g.cache_key) so cache hits skip compression too.
+    @app.after_request
+    def compress_response(response):
+        response.vary.add("Accept-Encoding")
+        if (
+            response.status_code != 200
+            or "Content-Encoding" in response.headers
+            or response.direct_passthrough
+        ):
+            return response
+        encoding = negotiate()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(encoding, response.response)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < MIN_SIZE:
+                return response
+            key = g.get("cache_key")
+            body = variants.get_variant(key, encoding) if variants and key else None
+            if body is None:
+                body = compress(encoding, data)
+                if variants and key:
+                    variants.set_variant(key, encoding, body)
+            response.set_data(body)
+
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f"{etag}-{encoding}", weak)
+        return response
@@ -0,0 +1,117 @@
+import ipaddress
+import os
+import time
+
+from flask import Response, abort, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram, generate_latest, multiprocess
+
+# Seconds. Most requests land well under 100ms, so the low end is finer.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0)
+
+# A metric without labels opens its file here as soon as it is created,
+# which for most of them is at import time.
+if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent serving HTTP requests.",
+    ("method", "route", "status"),
+    buckets=BUCKETS,
+)
+
+# Networks allowed to scrape /metrics, comma separated. Loopback and the
+# private ranges cover a scraper on the host or the compose network; the
+# public internet has no business reading per-route latencies.
+METRICS_ALLOW = [
+    ipaddress.ip_network(network.strip())
+    for network in os.environ.get(
+        "METRICS_ALLOW", "127.0.0.0/8,::1/128,10.0.0.0/8,172.16.0.0/12,192.168.0.0/16,fc00::/7"
+    ).split(",")
+    if network.strip()
+]
+
+
+def registry():
+    # With PROMETHEUS_MULTIPROC_DIR set every worker writes its samples to
+    # shared files and a scrape of any worker merges all of them.
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        merged = CollectorRegistry()
+        multiprocess.MultiProcessCollector(merged)
+        return merged
+    return REGISTRY
+
+
+def init_metrics(app):
+    @app.before_request
+    def start_timer():
+        g.start_time = time.perf_counter()
+
+    @app.after_request
+    def observe_latency(response):
+        start = g.get("start_time")
+        if start is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        series = REQUEST_LATENCY.labels(request.method, route, str(response.status_code))
+        if response.is_streamed:
+            # The body is still being generated when this hook runs.
+            response.call_on_close(lambda: series.observe(time.perf_counter() - start))
+        else:
+            series.observe(time.perf_counter() - start)
+        return response
+
+    @app.get("/metrics")
+    def metrics():
+        if not metrics_allowed():
+            abort(404)
+        return Response(generate_latest(registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
+def metrics_allowed():
+    # A request a reverse proxy forwarded comes from the proxy's address, so
+    # it is refused whatever that address is: scrapers talk to the app
+    # directly.
+    if "X-Forwarded-For" in request.headers or "X-Real-IP" in request.headers:
+        return False
+    try:
+        address = ipaddress.ip_address(request.remote_addr or "")
+    except ValueError:
+        return False
+    return any(address in network for network in METRICS_ALLOW)
+
+
+def bucket_quantile(q, buckets):
+    # Linear interpolation inside the bucket, as PromQL's histogram_quantile().
+    rank = q * buckets[-1][1]
+    lower, below = 0.0, 0.0
+    for upper, count in buckets:
+        if count >= rank:
+            if upper == float("inf"):
+                return lower
+            return lower + (upper - lower) * (rank - below) / ((count - below) or 1)
+        lower, below = upper, count
+    return lower
+
+
+def latency_summary(name="http_request_duration_seconds", quantiles=(0.5, 0.95, 0.99)):
+    series = {}
+    for metric in registry().collect():
+        if metric.name != name:
+            continue
+        for sample in metric.samples:
+            if not sample.name.endswith("_bucket"):
+                continue
+            labels = dict(sample.labels)
+            upper = float(labels.pop("le"))
+            series.setdefault(tuple(sorted(labels.items())), []).append((upper, sample.value))
+    rows = []
+    for labels, buckets in sorted(series.items()):
+        buckets.sort()
+        if not buckets[-1][1]:
+            continue
+        row = dict(labels, count=int(buckets[-1][1]))
+        for q in quantiles:
+            row[f"p{round(q * 100)}"] = round(bucket_quantile(q, buckets) * 1000, 1)
+        rows.append(row)
+    return rows
@@ -1,16 +1,23 @@
-from flask import Flask, render_template, request, session, redirect
-import requests
+from flask import Flask, render_template, request, session, redirect, g, get_template_attribute
 import os
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
 from collections import deque
 import time
+from backend_client import BackendClient
+from graph import GraphCache, coin_view, coins_for_duty, find
+from fragments import CoinBlocks, FragmentCache
+from completions import CompletionStore
+from passwords import PasswordHasher, PasswordPoolFull
+from http_compression import init_compression
+from metrics import init_metrics, latency_summary
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "dev-secret")
 
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///db.sqlite"
 db = SQLAlchemy(app)
+init_metrics(app)
+init_compression(app)
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -18,17 +25,57 @@ class User(db.Model):
     password = db.Column(db.String, nullable=False)
     role = db.Column(db.String, nullable=False)
 
-with app.app_context():
-    db.create_all()
+class Completion(db.Model):
+    __tablename__ = "completions"
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    coin_id = db.Column(db.String, primary_key=True)
+
+class CompletionVersion(db.Model):
+    __tablename__ = "completion_versions"
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+def create_schema():
+    with app.app_context():
+        db.create_all()
+
+app.cli.command("create-schema")(create_schema)
 
 BACKEND_URL = os.environ.get("BACKEND_URL", "http://localhost:5000")
-completions = set()
+ADMIN_PAGE_SIZE = int(os.environ.get("ADMIN_PAGE_SIZE", "50"))
+DUTY_OPTIONS = {"fields": "id,duty_name", "include": ""}
+backend = BackendClient(
+    BACKEND_URL,
+    pool_size=int(os.environ.get("BACKEND_POOL_SIZE", "20")),
+    timeout=(
+        float(os.environ.get("BACKEND_CONNECT_TIMEOUT", "3.05")),
+        float(os.environ.get("BACKEND_READ_TIMEOUT", "10")),
+    ),
+    max_workers=int(os.environ.get("BACKEND_FANOUT_WORKERS", "8")),
+    ttl=float(os.environ.get("BACKEND_CACHE_TTL", "5")),
+    stale_ttl=float(os.environ.get("BACKEND_CACHE_STALE_TTL", "30")),
+    max_entries=int(os.environ.get("BACKEND_CACHE_ENTRIES", "512")),
+    max_bytes=int(os.environ.get("BACKEND_CACHE_BYTES", str(16 * 1024 * 1024))),
+)
+graph_cache = GraphCache(backend, ttl=backend.ttl, stale_ttl=backend.stale_ttl)
+fragments = FragmentCache(max_entries=int(os.environ.get("FRAGMENT_CACHE_ENTRIES", "256")))
+completions = CompletionStore(
+    app,
+    db,
+    Completion.__table__,
+    CompletionVersion.__table__,
+    flush_interval=float(os.environ.get("COMPLETION_FLUSH_INTERVAL", "0.005")),
+    max_batch=int(os.environ.get("COMPLETION_BATCH_SIZE", "500")),
+    max_users=int(os.environ.get("COMPLETION_CACHE_USERS", "10000")),
+)
 
-request_log = deque(maxlen=100)
+passwords = PasswordHasher(
+    max_workers=int(os.environ.get("PASSWORD_HASH_WORKERS", "1")),
+    max_pending=int(os.environ.get("PASSWORD_HASH_QUEUE", "8")),
+    timeout=float(os.environ.get("PASSWORD_HASH_TIMEOUT", "10")),
+)
 
-@app.before_request
-def start_timer():
-    request.start_time = time.time()
+request_log = deque(maxlen=100)
 
 @app.after_request
 def log_request(response):
@@ -40,28 +87,40 @@ def log_request(response):
             "status": response.status_code,
             "user": session.get("username", "anon"),
             "ip": request.remote_addr,
-            "ms": round((time.time() - getattr(request, "_start_time", time.time())) * 1000),
+            "ms": round((time.perf_counter() - g.get("start_time", time.perf_counter())) * 1000),
         })
     return response
 
+def current_user_id():
+    # Sessions issued before user ids were stored only carry the username.
+    if "user_id" not in session and "username" in session:
+        user = User.query.filter_by(username=session["username"]).first()
+        if user is not None:
+            session["user_id"] = user.id
+    return session.get("user_id")
+
 @app.route('/')
 def index():
-    all_coins = requests.get(f"{BACKEND_URL}/coins").json()
-    for coin in all_coins:
-        coin["completed"] = coin["id"] in completions
+    # The coin list and duty panel come from fragments rendered once per
+    # graph version (and role, for the toggle buttons); only the visitor's
+    # completion markers are applied per request.
+    role = session.get("role", "anonymous")
+    graph = graph_cache.get()
+    version = graph["version"]
+    coins = fragments.get(version, ("coins", role), lambda: CoinBlocks(coin_view(graph), role))
 
-    selected_duty = None
-    linked_coins = []
+    # Only duties in the graph get a cache entry: made-up ids would otherwise
+    # fill the LRU with empty panels and evict the coin lists.
+    duty_panel = ""
+    duty = find(graph["duties"], request.args.get("duty_id"))
+    if duty is not None:
+        duty_panel = fragments.get(version, ("duty", duty["id"]), lambda: render_duty_panel(graph, duty))
 
-    duty_id = request.args.get("duty_id")
-    if duty_id:
-        selected_duty = requests.get(f"{BACKEND_URL}/duties/{duty_id}").json()
-        linked_coins = [
-            coin for coin in all_coins
-            if any(d["id"] == duty_id for d in coin.get("duties", []))
-        ]
+    coin_blocks = coins.render(completions.completed(current_user_id()))
+    return render_template("index.html", coin_blocks=coin_blocks, duty_panel=duty_panel, role=role, session=session)
 
-    return render_template("index.html", coins=all_coins, selected_duty=selected_duty, linked_coins=linked_coins, role=session.get("role", "anonymous"), session=session)
+def render_duty_panel(graph, duty):
+    return get_template_attribute("fragments.html", "duty_panel")(duty, coins_for_duty(graph, duty["id"]))
 
 @app.get("/login")
 def login_page():
@@ -71,9 +130,22 @@ def login():
     username = request.form.get("username")
     password = request.form.get("password")
     user = User.query.filter_by(username=username).first()
-    if user and check_password_hash(user.password, password):
+    if user is None:
+        return render_template("login.html", error="Invalid username or password")
+    user_id, password_hash, role = user.id, user.password, user.role
+    # Hand the connection back to the pool while the hash runs.
+    db.session.rollback()
+    try:
+        matches, rehashed = passwords.verify(password_hash, password)
+    except (PasswordPoolFull, TimeoutError):
+        return render_template("login.html", error="Too many logins, please try again"), 503, {"Retry-After": "1"}
+    if matches:
+        if rehashed is not None:
+            User.query.filter_by(id=user_id).update({"password": rehashed})
+            db.session.commit()
+        session["user_id"] = user_id
         session["username"] = username
-        session["role"] = user.role
+        session["role"] = role
         return redirect("/")
     return render_template("login.html", error="Invalid username or password")
 
@@ -86,32 +158,58 @@ def logout():
 def toggle_coin(id):
     if session.get("role") not in ("user", "admin"):
         return redirect("/login")
-    if id in completions:
-        completions.discard(id)
-    else:
-        completions.add(id)
+    user_id = current_user_id()
+    if user_id is None:
+        return redirect("/login")
+    completions.toggle(user_id, id)
     return redirect("/")
 
 @app.get("/admin")
 def admin_page():
     if session.get("role") != "admin":
         return redirect("/")
-    coins = requests.get(f"{BACKEND_URL}/coins").json()
-    duties = requests.get(f"{BACKEND_URL}/duties").json()
-    return render_template("admin.html", coins=coins, duties=duties)
+    coins_after = request.args.get("coins_after")
+    duties_after = request.args.get("duties_after")
+    coins_page, duties_page, all_duties = backend.get_many(
+        ("/coins", {"limit": ADMIN_PAGE_SIZE, "after": coins_after}),
+        ("/duties", {"limit": ADMIN_PAGE_SIZE, "after": duties_after, "include": ""}),
+        ("/duties", DUTY_OPTIONS),
+        max_age=0,
+    )
+    return render_template(
+        "admin.html",
+        coins=coins_page["items"],
+        coins_next=coins_page["next"],
+        duties=duties_page["items"],
+        duties_next=duties_page["next"],
+        all_duties=all_duties,
+        coins_after=coins_after,
+        duties_after=duties_after,
+    )
 
 @app.get("/logs")
 def logs_page():
     if session.get("role") != "admin":
         return redirect("/")
-    return render_template("logs.html", logs=list(request_log))
+    return render_template(
+        "logs.html",
+        logs=list(request_log),
+        cache_stats=backend.stats(),
+        graph_stats=graph_cache.stats(),
+        fragment_stats=fragments.stats(),
+        password_stats=passwords.stats(),
+        latency=latency_summary(),
+        backend_latency=latency_summary("backend_request_duration_seconds"),
+    )
 
 @app.post("/admin/coins")
 def create_coin():
     if session.get("role") != "admin":
         return redirect("/")
     duty_ids = request.form.getlist("duty_ids")
-    requests.post(f"{BACKEND_URL}/coins", json={"coin_name": request.form["coin_name"], "duty_ids": duty_ids})
+    backend.post("/coins", json={"coin_name": request.form["coin_name"], "duty_ids": duty_ids})
+    backend.invalidate("/coins", *(f"/duties/{duty_id}/coins" for duty_id in duty_ids))
+    graph_cache.invalidate()
 
     return redirect("/admin")
 
@@ -119,15 +217,16 @@ def create_coin():
 def delete_coin(id):
     if session.get("role") != "admin":
         return redirect("/")
-    requests.delete(f"{BACKEND_URL}/coins/{id}")
+    backend.delete(f"/coins/{id}")
+    backend.invalidate("/coins", f"/coins/{id}", "/duties/*/coins")
+    graph_cache.invalidate()
     return redirect("/admin")
 
 @app.get("/admin/coins/<id>/edit")
 def edit_coin_page(id):
     if session.get("role") != "admin":
         return redirect("/")
-    coin = requests.get(f"{BACKEND_URL}/coins/{id}").json()
-    duties = requests.get(f"{BACKEND_URL}/duties").json()
+    coin, duties = backend.get_many(f"/coins/{id}", ("/duties", DUTY_OPTIONS), max_age=0)
     return render_template("edit_coin.html", coin=coin, duties=duties)
 
 @app.post("/admin/coins/<id>/edit")
@@ -135,42 +234,50 @@ def edit_coin(id):
     if session.get("role") != "admin":
         return redirect("/")
     duty_ids = request.form.getlist("duty_ids")
-    requests.put(f"{BACKEND_URL}/coins/{id}", json={
+    backend.put(f"/coins/{id}", json={
         "coin_name": request.form["coin_name"],
         "duty_ids": duty_ids
     })
+    backend.invalidate("/coins", f"/coins/{id}", "/duties/*/coins")
+    graph_cache.invalidate()
     return redirect("/admin")
 
 @app.post("/admin/duties")
 def create_duty():
     if session.get("role") != "admin":
         return redirect("/")
-    requests.post(f"{BACKEND_URL}/duties", json={
+    backend.post("/duties", json={
         "duty_name": request.form.get("duty_name"),
         "description": request.form.get("description") or None,
     })
+    backend.invalidate("/duties")
+    graph_cache.invalidate()
     return redirect("/admin")
 
 @app.post("/admin/duties/<id>/delete")
 def delete_duty(id):
     if session.get("role") != "admin":
         return redirect("/")
-    requests.delete(f"{BACKEND_URL}/duties/{id}")
+    backend.delete(f"/duties/{id}")
+    backend.invalidate("/duties", f"/duties/{id}", f"/duties/{id}/*", "/coins", "/coins/*")
+    graph_cache.invalidate()
     return redirect("/admin")
 
 @app.get("/admin/duties/<id>/edit")
 def edit_duty_page(id):
     if session.get("role") != "admin":
         return redirect("/")
-    duty = requests.get(f"{BACKEND_URL}/duties/{id}").json()
+    duty = backend.get(f"/duties/{id}", max_age=0)
     return render_template("edit_duty.html", duty=duty)
 
 @app.post("/admin/duties/<id>/edit")
 def edit_duty(id):
     if session.get("role") != "admin":
         return redirect("/")
-    requests.put(f"{BACKEND_URL}/duties/{id}", json={
+    backend.put(f"/duties/{id}", json={
         "duty_name": request.form["duty_name"],
         "description": request.form.get("description") or None,
     })
+    backend.invalidate("/duties", f"/duties/{id}", "/coins", "/coins/*")
+    graph_cache.invalidate()
     return redirect("/admin")
\ No newline at end of file
@@ -0,0 +1,194 @@
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from prometheus_client import Histogram
+from urllib3.util import make_headers
+
+from metrics import BUCKETS
+
+BACKEND_LATENCY = Histogram(
+    "backend_request_duration_seconds",
+    "Time spent waiting on backend API calls, as seen by the frontend.",
+    ("method", "route", "status"),
+    buckets=BUCKETS,
+)
+ID_SEGMENT = re.compile(r"/[^/]*\d[^/]*")
+
+
+class BackendClient:
+    def __init__(
+        self,
+        base_url,
+        pool_size=20,
+        timeout=(3.05, 10),
+        max_workers=8,
+        ttl=5.0,
+        stale_ttl=30.0,
+        max_entries=512,
+        max_bytes=16 * 1024 * 1024,
+    ):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # One keep-alive session shared by every request thread, so backend
+        # calls reuse pooled TCP connections instead of opening one per call.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Ask for every encoding urllib3 can decode here (gzip always, br and
+        # zstd when their libraries are installed).
+        self.session.headers["Accept-Encoding"] = make_headers(accept_encoding=True)["accept-encoding"]
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="backend")
+        # url -> (etag, body, fetched_at). Bodies are kept as bytes and decoded
+        # per call so callers can mutate what they get back.
+        self._entries = OrderedDict()
+        self._size = 0
+        self._refreshing = set()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(
+            ("hits", "stale_hits", "misses", "revalidated", "evictions", "invalidations"), 0
+        )
+
+    def url(self, path, params=None):
+        return requests.Request("GET", f"{self.base_url}{path}", params=params).prepare().url
+
+    def get(self, path, params=None, timeout=None, max_age=None):
+        # Read-through cache: fresh entries are served without a backend call,
+        # entries inside the stale window are served while a background
+        # conditional GET refreshes them, anything older is revalidated inline.
+        # max_age=0 always revalidates, which costs a 304 when nothing changed.
+        url = self.url(path, params)
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+                age = time.monotonic() - entry[2]
+                if age < max_age:
+                    self._stats["hits"] += 1
+                    return json.loads(entry[1])
+                if max_age and age < max_age + self.stale_ttl:
+                    self._stats["stale_hits"] += 1
+                    if url not in self._refreshing:
+                        self._refreshing.add(url)
+                        self.executor.submit(self._refresh, url)
+                    return json.loads(entry[1])
+            self._stats["misses"] += 1
+        return self._fetch(url, timeout)
+
+    def get_many(self, *calls, max_age=None):
+        # Each call is a path or a (path, params) pair. The calls run
+        # concurrently, so the total wait is the slowest call, not the sum.
+        calls = [(call, None) if isinstance(call, str) else call for call in calls]
+        futures = [
+            self.executor.submit(self.get, path, params, max_age=max_age) for path, params in calls
+        ]
+        return [future.result() for future in futures]
+
+    def fetch(self, path, params=None, timeout=None):
+        # Uncached GET; the caller gets the response and handles its status.
+        return self._send("GET", self.url(path, params), timeout=timeout or self.timeout)
+
+    def post(self, path, json=None, timeout=None):
+        return self._send("POST", f"{self.base_url}{path}", json=json, timeout=timeout or self.timeout)
+
+    def put(self, path, json=None, timeout=None):
+        return self._send("PUT", f"{self.base_url}{path}", json=json, timeout=timeout or self.timeout)
+
+    def delete(self, path, timeout=None):
+        return self._send("DELETE", f"{self.base_url}{path}", timeout=timeout or self.timeout)
+
+    def invalidate(self, *patterns):
+        # Drop cached GETs whose path matches one of the glob patterns, whatever
+        # their query string, e.g. "/coins" or "/duties/*/coins".
+        prefix = len(urlsplit(self.base_url).path)
+        with self._lock:
+            self._generation += 1
+            for url in list(self._entries):
+                path = urlsplit(url).path[prefix:]
+                if any(fnmatchcase(path, pattern) for pattern in patterns):
+                    self._discard(url)
+                    self._stats["invalidations"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "stale_ttl": self.stale_ttl,
+            }
+
+    def _refresh(self, url):
+        try:
+            self._fetch(url, None)
+        except requests.RequestException:
+            pass
+        finally:
+            with self._lock:
+                self._refreshing.discard(url)
+
+    def _fetch(self, url, timeout):
+        with self._lock:
+            entry = self._entries.get(url)
+            generation = self._generation
+
+        headers = {"If-None-Match": entry[0]} if entry and entry[0] else {}
+        response = self._send("GET", url, headers=headers, timeout=timeout or self.timeout)
+
+        if response.status_code == 304 and entry:
+            body = entry[1]
+            with self._lock:
+                self._stats["revalidated"] += 1
+                if generation == self._generation and url in self._entries:
+                    self._entries[url] = (entry[0], body, time.monotonic())
+            return json.loads(body)
+
+        if response.status_code == 200:
+            with self._lock:
+                if generation == self._generation:
+                    self._store(url, response.headers.get("ETag"), response.content)
+        return response.json()
+
+    def _send(self, method, url, **kwargs):
+        # IDs are folded into "<id>" so each backend route is one series.
+        route = ID_SEGMENT.sub("/<id>", urlsplit(url).path[len(urlsplit(self.base_url).path):])
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = self.session.request(method, url, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            BACKEND_LATENCY.labels(method, route, status).observe(time.perf_counter() - start)
+
+    def _store(self, url, etag, body):
+        if len(body) > self.max_bytes:
+            return
+        self._discard(url)
+        self._entries[url] = (etag, body, time.monotonic())
+        self._size += len(body)
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            self._discard(next(iter(self._entries)))
+            self._stats["evictions"] += 1
+
+    def _discard(self, url):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self._size -= len(entry[1])
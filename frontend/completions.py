@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from sqlalchemy import bindparam, select
+
+
+class CompletionStore:
+    def __init__(self, app, db, completions, versions, flush_interval=0.005, max_batch=500, max_users=10000, timeout=10.0):
+        self.app = app
+        self.db = db
+        self.completions = completions
+        self.versions = versions
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_users = max_users
+        self.timeout = timeout
+        # user_id -> (version, frozenset of coin ids). The version row is the
+        # only thing read per request; the set is reloaded only when another
+        # worker (or this one) has committed a change for that user.
+        self._users = OrderedDict()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._writer = None
+        self._pid = None
+
+    def completed(self, user_id):
+        if user_id is None:
+            return frozenset()
+        with self.db.engine.connect() as conn:
+            version = conn.scalar(select(self.versions.c.version).where(self.versions.c.user_id == user_id)) or 0
+            with self._lock:
+                cached = self._users.get(user_id)
+                if cached is not None and cached[0] == version:
+                    self._users.move_to_end(user_id)
+                    return cached[1]
+            coin_ids = frozenset(conn.scalars(
+                select(self.completions.c.coin_id).where(self.completions.c.user_id == user_id)
+            ))
+        self._remember(user_id, version, coin_ids)
+        return coin_ids
+
+    def toggle(self, user_id, coin_id):
+        # Toggles from every request thread are queued and committed together
+        # by one writer thread, so a burst of clicks costs one SQLite write
+        # transaction instead of one each. The caller still waits for its
+        # batch to commit, so the redirect that follows sees the change on
+        # whichever worker serves it.
+        future = Future()
+        with self._lock:
+            self._start_writer()
+            self._pending.append((user_id, coin_id, future))
+            self._wake.notify()
+        return future.result(self.timeout)
+
+    def _start_writer(self):
+        # Threads don't survive a fork, so a worker forked from a process that
+        # already had a writer starts its own on first use.
+        if self._writer is not None and self._pid == os.getpid():
+            return
+        self._pending = []
+        self._pid = os.getpid()
+        self._writer = threading.Thread(target=self._run, name="completions", daemon=True)
+        self._writer.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._wake.wait()
+            if self.flush_interval > 0:
+                time.sleep(self.flush_interval)
+            with self._lock:
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            try:
+                with self.app.app_context():
+                    results = self._apply(batch)
+            except Exception as error:
+                for _, _, future in batch:
+                    future.set_exception(error)
+            else:
+                for (_, _, future), done in zip(batch, results):
+                    future.set_result(done)
+
+    def _apply(self, batch):
+        completions, versions = self.completions, self.versions
+        user_ids = {user_id for user_id, _, _ in batch}
+        coin_ids = {coin_id for _, coin_id, _ in batch}
+        with self.db.engine.begin() as conn:
+            existing = set(conn.execute(
+                select(completions.c.user_id, completions.c.coin_id)
+                .where(completions.c.user_id.in_(user_ids), completions.c.coin_id.in_(coin_ids))
+            ).tuples())
+            state = {}
+            results = []
+            for user_id, coin_id, _ in batch:
+                key = (user_id, coin_id)
+                state[key] = not state.get(key, key in existing)
+                results.append(state[key])
+            added = [key for key, done in state.items() if done and key not in existing]
+            removed = [key for key, done in state.items() if not done and key in existing]
+            if added:
+                conn.execute(completions.insert(), [{"user_id": u, "coin_id": c} for u, c in added])
+            if removed:
+                conn.execute(
+                    completions.delete().where(
+                        completions.c.user_id == bindparam("_user_id"),
+                        completions.c.coin_id == bindparam("_coin_id"),
+                    ),
+                    [{"_user_id": u, "_coin_id": c} for u, c in removed],
+                )
+            changed = {user_id for user_id, _ in added + removed}
+            new_versions = {}
+            if changed:
+                known = set(conn.scalars(select(versions.c.user_id).where(versions.c.user_id.in_(changed))))
+                if known:
+                    conn.execute(
+                        versions.update()
+                        .where(versions.c.user_id == bindparam("_user_id"))
+                        .values(version=versions.c.version + 1),
+                        [{"_user_id": user_id} for user_id in known],
+                    )
+                if changed - known:
+                    conn.execute(versions.insert(), [{"user_id": user_id, "version": 1} for user_id in changed - known])
+                new_versions = {
+                    user_id: version
+                    for user_id, version in conn.execute(
+                        select(versions.c.user_id, versions.c.version).where(versions.c.user_id.in_(changed))
+                    )
+                }
+        self._apply_cached(new_versions, added, removed)
+        return results
+
+    def _apply_cached(self, new_versions, added, removed):
+        # Patch cached sets in place when they were current right before this
+        # batch; anything else is dropped and reloaded on the next read.
+        with self._lock:
+            for user_id, version in new_versions.items():
+                cached = self._users.get(user_id)
+                if cached is None:
+                    continue
+                if cached[0] != version - 1:
+                    del self._users[user_id]
+                    continue
+                coin_ids = set(cached[1])
+                coin_ids.update(c for u, c in added if u == user_id)
+                coin_ids.difference_update(c for u, c in removed if u == user_id)
+                self._users[user_id] = (version, frozenset(coin_ids))
+
+    def _remember(self, user_id, version, coin_ids):
+        with self._lock:
+            cached = self._users.get(user_id)
+            if cached is not None and cached[0] > version:
+                return
+            self._users[user_id] = (version, coin_ids)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
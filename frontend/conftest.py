@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The images put common/ on PYTHONPATH; in a checkout it sits beside this
+# directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
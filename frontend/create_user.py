@@ -1,13 +1,15 @@
 import sys
 sys.path.insert(0, "/app")
 
-from app import app, db, User
-from werkzeug.security import generate_password_hash
+from app import app, db, User, create_schema
+from passwords import hash_password
+
+create_schema()
 
 with app.app_context():
     users = [
-        ("admin", generate_password_hash("adminpass"), "admin"),
-        ("user", generate_password_hash("userpass"), "user"),
+        ("admin", hash_password("adminpass"), "admin"),
+        ("user", hash_password("userpass"), "user"),
     ]
     for username, password, role in users:
         if not User.query.filter_by(username=username).first():
@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+
+from flask import get_template_attribute
+from markupsafe import Markup
+
+
+class FragmentCache:
+    # Rendered template fragments for one graph version at a time. The first
+    # request that sees a newer version drops everything rendered from older
+    # data; within a version entries are LRU-bounded.
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(("hits", "misses", "evictions", "flushes"), 0)
+
+    def get(self, version, key, render):
+        with self._lock:
+            if self._version is None or version > self._version:
+                if self._entries:
+                    self._stats["flushes"] += 1
+                self._entries.clear()
+                self._version = version
+            fragment = self._entries.get(key) if version == self._version else None
+            if fragment is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return fragment
+            self._stats["misses"] += 1
+
+        fragment = render()
+        with self._lock:
+            if version == self._version:
+                self._entries[key] = fragment
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self._stats["evictions"] += 1
+        return fragment
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "version": self._version,
+            }
+
+
+class CoinBlocks:
+    # The index page's coin list for one graph version and role. Each coin's
+    # block is rendered at most once per completion state, so a visitor's
+    # page is their completed set picking a block per coin, then one join.
+    def __init__(self, coins, role):
+        self.coins = coins
+        self.role = role
+        self._blocks = {}
+        self._render = get_template_attribute("fragments.html", "coin_block")
+
+    def render(self, completed):
+        parts = []
+        for coin in self.coins:
+            key = (coin["id"], coin["id"] in completed)
+            block = self._blocks.get(key)
+            if block is None:
+                block = self._blocks[key] = self._render(coin, key[1], self.role)
+            parts.append(block)
+        return Markup("".join(parts))
@@ -0,0 +1,181 @@
+import threading
+import time
+
+import requests
+
+ENTITIES = ("coins", "duties", "ksbs")
+# link table -> (owner table, target table)
+LINKS = {"coins_duties": ("coins", "duties"), "duties_ksbs": ("duties", "ksbs")}
+
+
+class GraphCache:
+    # Holds one copy of GET /graph and keeps it current by applying
+    # GET /changes deltas, so a refresh costs what changed rather than the
+    # whole dataset. A 410 (the backend compacted past our cursor, or was
+    # reseeded) falls back to reloading the graph. One thread at a time talks
+    # to the backend; while it does, and while the backend is failing, other
+    # callers get the last snapshot for up to `stale_ttl` past the TTL.
+    def __init__(self, backend, ttl=5.0, stale_ttl=30.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        # table -> {id: entity} or {(owner id, target id): None}, in order
+        self._tables = None
+        self._seq = None
+        self._snapshot = None
+        self._version = 0
+        # When the backend last answered, and when to ask it again after it
+        # failed to.
+        self._fetched_at = 0.0
+        self._retry_at = 0.0
+        self._invalidated = False
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stats = dict.fromkeys(("hits", "stale_hits", "deltas", "changes", "reloads", "errors"), 0)
+
+    def get(self, max_age=None):
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            if self._fresh(max_age):
+                self._stats["hits"] += 1
+                return self._current()
+            # A write of our own must be read back, so it waits its turn.
+            stale = not self._invalidated and self._usable(max_age)
+        if not self._refresh_lock.acquire(blocking=not stale):
+            with self._lock:
+                self._stats["stale_hits"] += 1
+                return self._current()
+        try:
+            with self._lock:
+                # Whoever held the refresh lock may have just done the work.
+                if self._fresh(max_age):
+                    self._stats["hits"] += 1
+                    return self._current()
+                self._invalidated = False
+            try:
+                self._refresh()
+            except requests.RequestException:
+                with self._lock:
+                    self._stats["errors"] += 1
+                    if not self._usable(max_age):
+                        raise
+                    self._retry_at = time.monotonic() + self.ttl
+                    self._stats["stale_hits"] += 1
+            with self._lock:
+                return self._current()
+        finally:
+            self._refresh_lock.release()
+
+    def invalidate(self):
+        # The next get() pulls changes; called after this process writes.
+        with self._lock:
+            self._invalidated = True
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "seq": self._seq, "ttl": self.ttl, "stale_ttl": self.stale_ttl}
+
+    def _fresh(self, max_age):
+        if self._tables is None or self._invalidated:
+            return False
+        now = time.monotonic()
+        return now - self._fetched_at < max_age or now < self._retry_at
+
+    def _usable(self, max_age):
+        return self._tables is not None and time.monotonic() - self._fetched_at < max_age + self.stale_ttl
+
+    def _current(self):
+        # One snapshot is shared until the data changes; callers must not
+        # mutate it. Its version is bumped on every change, reloads
+        # included, so anything derived from it can be keyed on it.
+        if self._snapshot is None:
+            self._version += 1
+            graph = {name: list(self._tables[name].values()) for name in ENTITIES}
+            graph.update({name: list(self._tables[name]) for name in LINKS})
+            graph["seq"] = self._seq
+            graph["version"] = self._version
+            self._snapshot = graph
+        return self._snapshot
+
+    def _refresh(self):
+        # Every page is fetched before any is applied, so readers never see
+        # half of a refresh.
+        deltas, seq = [], self._seq
+        while self._tables is not None:
+            response = self.backend.fetch("/changes", {"since": seq})
+            if response.status_code == 410:
+                break
+            response.raise_for_status()
+            delta = response.json()
+            deltas.append(delta)
+            seq = delta["next"]
+            if not delta["more"]:
+                with self._lock:
+                    for delta in deltas:
+                        self._apply(delta)
+                    self._seq = seq
+                    self._fetched_at = time.monotonic()
+                    self._retry_at = 0.0
+                return
+        response = self.backend.fetch("/graph")
+        response.raise_for_status()
+        graph = response.json()
+        tables = {name: {entity["id"]: entity for entity in graph[name]} for name in ENTITIES}
+        tables.update({name: dict.fromkeys(map(tuple, graph[name])) for name in LINKS})
+        with self._lock:
+            self._tables = tables
+            self._seq = graph["seq"]
+            self._snapshot = None
+            self._fetched_at = time.monotonic()
+            self._retry_at = 0.0
+            self._stats["reloads"] += 1
+
+    def _apply(self, delta):
+        upserts, deletes = delta["upserts"], delta["deletes"]
+        changes = sum(map(len, upserts.values())) + sum(map(len, deletes.values()))
+        self._stats["deltas"] += 1
+        self._stats["changes"] += changes
+        if not changes:
+            return
+        self._snapshot = None
+        for name in ENTITIES:
+            for entity in upserts[name]:
+                self._tables[name][entity["id"]] = entity
+            for id in deletes[name]:
+                self._tables[name].pop(id, None)
+        for name, (owner, target) in LINKS.items():
+            links = self._tables[name]
+            for pair in deletes[name]:
+                links.pop(tuple(pair), None)
+            for pair in upserts[name]:
+                links[tuple(pair)] = None
+            # A deleted entity takes its links with it.
+            if deletes[owner] or deletes[target]:
+                owners, targets = set(deletes[owner]), set(deletes[target])
+                for pair in [pair for pair in links if pair[0] in owners or pair[1] in targets]:
+                    del links[pair]
+
+
+def coin_view(graph):
+    # Rebuilds the nested coin -> duties -> KSBs shape the templates use from
+    # the normalized graph. Each duty and KSB dict is built once and shared by
+    # every coin or duty that links to it, so the work and the memory grow
+    # with entities plus links. The graph's own dicts are left untouched.
+    ksbs = {ksb["id"]: ksb for ksb in graph["ksbs"]}
+    duties = {duty["id"]: {**duty, "ksbs": []} for duty in graph["duties"]}
+    for duty_id, ksb_id in graph["duties_ksbs"]:
+        duties[duty_id]["ksbs"].append(ksbs[ksb_id])
+
+    coins = {coin["id"]: {**coin, "duties": []} for coin in graph["coins"]}
+    for coin_id, duty_id in graph["coins_duties"]:
+        coins[coin_id]["duties"].append(duties[duty_id])
+    return list(coins.values())
+
+
+def find(items, id):
+    return next((item for item in items if item["id"] == id), None)
+
+
+def coins_for_duty(graph, duty_id):
+    linked = {coin_id for coin_id, id in graph["coins_duties"] if id == duty_id}
+    return [coin for coin in graph["coins"] if coin["id"] in linked]
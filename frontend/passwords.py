@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from prometheus_client import Histogram
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from metrics import BUCKETS
+
+# Any method generate_password_hash() accepts, e.g. "scrypt:32768:8:1" or
+# "pbkdf2:sha256:1000000". Stored hashes made with other settings are
+# replaced on the user's next successful login.
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1")
+
+PASSWORD_QUEUE_TIME = Histogram(
+    "password_hash_queue_seconds",
+    "Time password hashing work waited for a free hashing thread.",
+    buckets=BUCKETS,
+)
+PASSWORD_HASH_TIME = Histogram(
+    "password_hash_duration_seconds",
+    "Time spent hashing or verifying a password.",
+    ("operation",),
+    buckets=BUCKETS,
+)
+
+
+class PasswordPoolFull(Exception):
+    pass
+
+
+def hash_password(password, method=PASSWORD_HASH_METHOD):
+    return generate_password_hash(password, method)
+
+
+def hash_method(password_hash):
+    return password_hash.partition("$")[0]
+
+
+class PasswordHasher:
+    # Hashing is deliberately slow, so it runs on a small pool of its own
+    # rather than on the request thread: a burst of logins can occupy at most
+    # `max_workers` cores per worker process, and the request threads it
+    # would otherwise pin stay free for page views. hashlib releases the GIL
+    # while it hashes. At most `max_pending` calls are running or queued;
+    # past that a login fails fast instead of joining an ever longer queue.
+    def __init__(self, method=PASSWORD_HASH_METHOD, max_workers=1, max_pending=8, timeout=10.0):
+        self.method = method
+        # The normalized prefix generate_password_hash() writes, so that
+        # "scrypt" and "scrypt:32768:8:1" count as the same settings.
+        self.method_id = hash_method(generate_password_hash("", method))
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="passwords")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(("verified", "failed", "rehashed", "rejected"), 0)
+        self._pending = 0
+
+    def verify(self, password_hash, password):
+        # Returns (matches, replacement hash or None). The replacement is set
+        # when the password matched but was stored with other settings.
+        def work():
+            if not self._timed("verify", check_password_hash, password_hash, password):
+                return False, None
+            if hash_method(password_hash) == self.method_id:
+                return True, None
+            return True, self._timed("hash", generate_password_hash, password, self.method)
+
+        matches, rehashed = self._run(work)
+        with self._lock:
+            self._stats["verified" if matches else "failed"] += 1
+            self._stats["rehashed"] += rehashed is not None
+        return matches, rehashed
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self._stats,
+                "pending": self._pending,
+                "max_workers": self.max_workers,
+                "max_pending": self.max_pending,
+                "method": self.method_id,
+            }
+
+    def _run(self, work):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats["rejected"] += 1
+            raise PasswordPoolFull()
+        queued = time.perf_counter()
+
+        def task():
+            PASSWORD_QUEUE_TIME.observe(time.perf_counter() - queued)
+            return work()
+
+        with self._lock:
+            self._pending += 1
+        # The slot is held until the work is done, even if the caller has
+        # given up waiting, so the cap holds.
+        future = self.executor.submit(task)
+        future.add_done_callback(self._release)
+        return future.result(self.timeout)
+
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def _timed(self, operation, function, *args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            PASSWORD_HASH_TIME.labels(operation).observe(time.perf_counter() - start)
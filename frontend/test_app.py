@@ -0,0 +1,529 @@
+import json
+import os
+import runpy
+import subprocess
+import sys
+import threading
+import types
+
+import pytest
+import requests
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, ForeignKey, Integer, String, Table, event
+
+from backend_client import BackendClient
+from completions import CompletionStore
+from graph import GraphCache
+from passwords import PasswordHasher, PasswordPoolFull, hash_method, hash_password
+
+
+@pytest.fixture()
+def database(tmp_path):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp_path / 'db.sqlite'}"
+    db = SQLAlchemy(app)
+    users = Table("user", db.metadata, Column("id", Integer, primary_key=True))
+    completions = Table(
+        "completions",
+        db.metadata,
+        Column("user_id", Integer, ForeignKey(users.c.id), primary_key=True),
+        Column("coin_id", String, primary_key=True),
+    )
+    versions = Table(
+        "completion_versions",
+        db.metadata,
+        Column("user_id", Integer, ForeignKey(users.c.id), primary_key=True),
+        Column("version", Integer, nullable=False, default=0),
+    )
+    with app.app_context():
+        db.create_all()
+        with db.engine.begin() as conn:
+            conn.execute(users.insert(), [{"id": 1}, {"id": 2}])
+        yield app, db, completions, versions
+        db.engine.dispose()
+
+
+def make_store(database, **options):
+    app, db, completions, versions = database
+    return CompletionStore(app, db, completions, versions, **options)
+
+
+class TestCompletions:
+    def test_toggles_are_committed_in_one_transaction(self, database):
+        store = make_store(database, flush_interval=0.2)
+        commits = []
+        event.listen(database[1].engine, "commit", lambda conn: commits.append(conn))
+        start = threading.Barrier(4)
+        results = {}
+
+        def toggle(user_id, coin_id):
+            start.wait()
+            results[user_id, coin_id] = store.toggle(user_id, coin_id)
+
+        threads = [
+            threading.Thread(target=toggle, args=key) for key in ((1, "a"), (1, "b"), (2, "a"), (2, "c"))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(commits) == 1
+        assert all(results.values())
+        assert store.completed(1) == {"a", "b"}
+        assert store.completed(2) == {"a", "c"}
+
+    def test_double_toggle_in_one_batch_cancels_out(self, database):
+        store = make_store(database)
+        assert store._apply([(1, "a", None), (1, "a", None), (1, "b", None)]) == [True, False, True]
+        assert store.completed(1) == {"b"}
+        store.toggle(1, "b")
+        assert store.completed(1) == frozenset()
+
+    def test_other_workers_changes_are_seen_through_the_version_row(self, database):
+        store, other = make_store(database), make_store(database)
+        store.toggle(1, "a")
+        assert other.completed(1) == {"a"}
+
+        store.toggle(1, "b")
+        store.toggle(1, "a")
+        assert other.completed(1) == {"b"}
+        assert store.completed(1) == {"b"}
+        assert store.completed(2) == frozenset()
+
+
+class StubResponse:
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.status_code != 200:
+            raise requests.HTTPError(f"{self.status_code} error", response=self)
+
+
+class StubBackend:
+    # Answers fetch() from a queue of responses and records the calls.
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def fetch(self, path, params=None):
+        self.calls.append((path, params))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def graph_response(seq, coins=(), duties=(), ksbs=(), coins_duties=(), duties_ksbs=()):
+    return StubResponse(200, {
+        "coins": [{"id": id} for id in coins],
+        "duties": [{"id": id} for id in duties],
+        "ksbs": [{"id": id} for id in ksbs],
+        "coins_duties": [list(pair) for pair in coins_duties],
+        "duties_ksbs": [list(pair) for pair in duties_ksbs],
+        "seq": seq,
+    })
+
+
+def changes_response(next, more=False, **changes):
+    tables = ("coins", "duties", "ksbs", "coins_duties", "duties_ksbs")
+    upserts = {name: changes.get(name, []) for name in tables}
+    deletes = {name: changes.get(f"deleted_{name}", []) for name in tables}
+    return StubResponse(200, {"upserts": upserts, "deletes": deletes, "next": next, "more": more})
+
+
+class TestGraphCache:
+    def load(self, *responses):
+        backend = StubBackend(
+            graph_response(
+                3, coins=("c1", "c2"), duties=("d1", "d2"), ksbs=("k1",),
+                coins_duties=(("c1", "d1"), ("c2", "d1"), ("c2", "d2")),
+                duties_ksbs=(("d1", "k1"), ("d2", "k1")),
+            ),
+            *responses,
+        )
+        cache = GraphCache(backend, ttl=0)
+        cache.get()
+        return cache, backend
+
+    def test_deleted_entities_take_their_links_with_them(self):
+        cache, backend = self.load(changes_response(5, deleted_duties=["d1"], deleted_ksbs=["k1"]))
+        graph = cache.get()
+        assert backend.calls[-1] == ("/changes", {"since": 3})
+        assert [duty["id"] for duty in graph["duties"]] == ["d2"]
+        assert graph["coins_duties"] == [("c2", "d2")]
+        assert graph["duties_ksbs"] == []
+        assert graph["seq"] == 5
+
+    def test_pages_of_changes_are_applied_until_no_more(self):
+        cache, backend = self.load(
+            changes_response(4, more=True, coins=[{"id": "c3"}]),
+            changes_response(6, more=True, coins_duties=[["c3", "d2"]]),
+            changes_response(7, deleted_coins=["c1"]),
+        )
+        graph = cache.get()
+        assert backend.calls[1:] == [
+            ("/changes", {"since": 3}), ("/changes", {"since": 4}), ("/changes", {"since": 6}),
+        ]
+        assert [coin["id"] for coin in graph["coins"]] == ["c2", "c3"]
+        assert graph["coins_duties"] == [("c2", "d1"), ("c2", "d2"), ("c3", "d2")]
+        assert graph["seq"] == 7
+        assert cache.stats()["deltas"] == 3
+
+    def test_gone_reloads_the_graph(self):
+        cache, backend = self.load(StubResponse(410), graph_response(9, coins=("c9",)))
+        before = cache._version
+        graph = cache.get()
+        assert [call[0] for call in backend.calls] == ["/graph", "/changes", "/graph"]
+        assert [coin["id"] for coin in graph["coins"]] == ["c9"]
+        assert graph["coins_duties"] == []
+        assert graph["seq"] == 9
+        assert graph["version"] > before
+        assert cache.stats()["reloads"] == 2
+
+    def test_backend_down_serves_the_last_snapshot(self):
+        cache, backend = self.load(
+            requests.ConnectionError("refused"),
+            StubResponse(503),
+            changes_response(4, deleted_coins=["c1"]),
+        )
+        first = cache._snapshot
+        assert cache.get() is first
+        assert cache.get() is first
+        assert [coin["id"] for coin in cache.get()["coins"]] == ["c2"]
+        assert cache.stats()["errors"] == 2
+
+    def test_backend_down_past_the_stale_window_raises(self):
+        cache, backend = self.load(requests.ConnectionError("refused"))
+        cache.stale_ttl = 0
+        with pytest.raises(requests.ConnectionError):
+            cache.get()
+
+    def test_failed_refresh_is_not_retried_until_the_ttl(self):
+        cache, backend = self.load(requests.ConnectionError("refused"))
+        cache.ttl = 60
+        cache._fetched_at -= 61
+        first = cache._snapshot
+        for _ in range(3):
+            assert cache.get() is first
+        assert len(backend.calls) == 2
+
+    def test_one_thread_refreshes_while_others_get_the_snapshot(self):
+        cache, backend = self.load(changes_response(4, coins=[{"id": "c3"}]))
+        first = cache._snapshot
+        fetching, release = threading.Event(), threading.Event()
+        fetch = backend.fetch
+
+        def slow_fetch(path, params=None):
+            fetching.set()
+            release.wait()
+            return fetch(path, params)
+
+        backend.fetch = slow_fetch
+        refresher = threading.Thread(target=cache.get)
+        refresher.start()
+        fetching.wait()
+        try:
+            assert cache.get() is first
+            assert cache.stats()["stale_hits"] == 1
+        finally:
+            release.set()
+            refresher.join()
+        assert len(backend.calls) == 2
+        assert [coin["id"] for coin in cache._snapshot["coins"]] == ["c1", "c2", "c3"]
+
+    def test_no_changes_keep_the_snapshot(self):
+        cache, backend = self.load(changes_response(3))
+        first = cache._snapshot
+        assert cache.get() is first
+
+
+class TestPasswords:
+    # A cheap method keeps the tests fast; what matters is that it differs
+    # from the one the hashes were made with.
+    method = "pbkdf2:sha256:1000"
+
+    def test_full_pool_rejects_instead_of_queueing(self):
+        hasher = PasswordHasher(self.method, max_workers=1, max_pending=1)
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+            return True, None
+
+        thread = threading.Thread(target=hasher._run, args=(block,))
+        thread.start()
+        started.wait()
+        try:
+            with pytest.raises(PasswordPoolFull):
+                hasher.verify(hash_password("secret", self.method), "secret")
+            assert hasher.stats()["rejected"] == 1
+            assert hasher.stats()["pending"] == 1
+        finally:
+            release.set()
+            thread.join()
+        assert hasher.verify(hash_password("secret", self.method), "secret") == (True, None)
+        assert hasher.stats()["pending"] == 0
+
+    def test_hash_with_other_settings_is_replaced_after_verify(self):
+        hasher = PasswordHasher(self.method)
+        old = hash_password("secret", "pbkdf2:sha256:2000")
+
+        assert hasher.verify(old, "wrong") == (False, None)
+        matches, rehashed = hasher.verify(old, "secret")
+        assert matches
+        assert hash_method(rehashed) == hasher.method_id == "pbkdf2:sha256:1000"
+        assert hasher.verify(rehashed, "secret") == (True, None)
+        assert hasher.stats()["rehashed"] == 1
+
+    def test_app_imports_before_the_metrics_directory_exists(self, tmp_path):
+        # gunicorn preloads the app; the password histograms have no labels,
+        # so their files are opened at import.
+        here = os.path.dirname(os.path.abspath(__file__))
+        directory = tmp_path / "prometheus" / "frontend"
+        env = {
+            **os.environ,
+            "PROMETHEUS_MULTIPROC_DIR": str(directory),
+            "PYTHONPATH": os.pathsep.join((here, os.path.join(here, os.pardir, "common"))),
+        }
+        subprocess.run([sys.executable, "-c", "import app"], cwd=tmp_path, env=env, check=True)
+        assert any(path.name.startswith("histogram_") for path in directory.iterdir())
+
+    def test_create_user_hashes_with_the_login_method(self, tmp_path, monkeypatch):
+        app = Flask(__name__)
+        app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp_path / 'db.sqlite'}"
+        db = SQLAlchemy(app)
+
+        class User(db.Model):
+            id = db.Column(db.Integer, primary_key=True)
+            username = db.Column(db.String, unique=True, nullable=False)
+            password = db.Column(db.String, nullable=False)
+            role = db.Column(db.String, nullable=False)
+
+        def create_schema():
+            with app.app_context():
+                db.create_all()
+
+        # create_user.py imports the app module for its database and models.
+        stand_in = types.ModuleType("app")
+        stand_in.__dict__.update(app=app, db=db, User=User, create_schema=create_schema)
+        monkeypatch.setitem(sys.modules, "app", stand_in)
+        runpy.run_path(os.path.join(os.path.dirname(__file__), "create_user.py"))
+
+        hasher = PasswordHasher()
+        with app.app_context():
+            users = {user.username: user.password for user in User.query}
+            db.engine.dispose()
+        assert set(users) == {"admin", "user"}
+        assert {hash_method(password) for password in users.values()} == {hasher.method_id}
+        assert hasher.verify(users["user"], "userpass") == (True, None)
+
+
+
+class StubHTTPResponse:
+    def __init__(self, status_code, data=None, etag=None):
+        self.status_code = status_code
+        self.content = json.dumps(data).encode() if data is not None else b""
+        self.headers = {"ETag": etag} if etag else {}
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class StubSession:
+    # Stands in for the client's requests.Session. Each path is answered by
+    # a function of (url, headers); every call is recorded.
+    def __init__(self, **routes):
+        self.routes = routes
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def request(self, method, url, headers=None, **kwargs):
+        with self.lock:
+            self.calls.append((url, headers or {}))
+        path = url.split("://", 1)[1].split("/", 1)[1].split("?")[0]
+        return self.routes[path.replace("/", "_")](url, headers or {})
+
+
+def versioned(data, etag):
+    # Answers 304 to a matching If-None-Match, like the backend.
+    def answer(url, headers):
+        if headers.get("If-None-Match") == etag:
+            return StubHTTPResponse(304)
+        return StubHTTPResponse(200, data, etag)
+
+    return answer
+
+
+def make_client(session, **options):
+    client = BackendClient("http://backend", **{"max_workers": 1, **options})
+    client.session = session
+    return client
+
+
+def age(client, seconds):
+    # Makes every cached entry look `seconds` older.
+    for url, (etag, body, fetched_at) in client._entries.items():
+        client._entries[url] = (etag, body, fetched_at - seconds)
+
+
+class TestBackendClient:
+    def test_fresh_entries_are_served_without_a_call(self):
+        session = StubSession(coins=versioned([1], '"v1"'))
+        client = make_client(session, ttl=60)
+        assert client.get("/coins") == [1]
+        assert client.get("/coins") == [1]
+        assert len(session.calls) == 1
+        assert client.stats()["hits"] == 1
+
+    def test_expired_entries_are_revalidated(self):
+        session = StubSession(coins=versioned([1], '"v1"'))
+        client = make_client(session, ttl=5, stale_ttl=0)
+        client.get("/coins")
+        age(client, 6)
+        assert client.get("/coins") == [1]
+        assert session.calls[-1][1] == {"If-None-Match": '"v1"'}
+        assert client.stats()["revalidated"] == 1
+        # A 304 restarts the entry's TTL.
+        client.get("/coins")
+        assert len(session.calls) == 2
+
+    def test_stale_entries_are_served_while_refreshed_in_the_background(self):
+        session = StubSession(coins=versioned([1], '"v1"'))
+        client = make_client(session, ttl=5, stale_ttl=30)
+        client.get("/coins")
+        session.routes["coins"] = versioned([2], '"v2"')
+        age(client, 6)
+        assert client.get("/coins") == [1]
+        assert client.stats()["stale_hits"] == 1
+        # The one executor thread runs the refresh before this.
+        client.executor.submit(lambda: None).result()
+        assert client.get("/coins") == [2]
+        assert len(session.calls) == 2
+
+    def test_entries_past_the_stale_window_are_fetched_inline(self):
+        session = StubSession(coins=versioned([1], '"v1"'))
+        client = make_client(session, ttl=5, stale_ttl=30)
+        client.get("/coins")
+        session.routes["coins"] = versioned([2], '"v2"')
+        age(client, 36)
+        assert client.get("/coins") == [2]
+        assert client.stats()["stale_hits"] == 0
+
+    def test_fill_racing_an_invalidation_is_dropped(self):
+        client = None
+
+        def write_meanwhile(url, headers):
+            client.invalidate("/coins")
+            return StubHTTPResponse(200, [1], '"v1"')
+
+        session = StubSession(coins=write_meanwhile)
+        client = make_client(session, ttl=60)
+        assert client.get("/coins") == [1]
+        assert client.stats()["entries"] == 0
+
+    def test_invalidate_matches_paths_by_glob(self):
+        session = StubSession(
+            coins=versioned([1], '"c"'),
+            duties_1_coins=versioned([2], '"d1"'),
+            duties_1=versioned([3], '"d"'),
+        )
+        client = make_client(session, ttl=60)
+        client.get("/coins", {"limit": 10})
+        client.get("/duties/1/coins")
+        client.get("/duties/1")
+        client.invalidate("/coins", "/duties/*/coins")
+        assert list(client._entries) == ["http://backend/duties/1"]
+        assert client.stats()["invalidations"] == 2
+
+    def test_least_recently_used_entries_are_evicted(self):
+        session = StubSession(a=versioned([1], '"a"'), b=versioned([2], '"b"'), c=versioned([3], '"c"'))
+        client = make_client(session, ttl=60, max_entries=2)
+        client.get("/a")
+        client.get("/b")
+        client.get("/a")
+        client.get("/c")
+        assert list(client._entries) == ["http://backend/a", "http://backend/c"]
+        assert client.stats()["evictions"] == 1
+
+    def test_byte_budget_bounds_the_cache(self):
+        session = StubSession(
+            small=versioned("x" * 10, '"s"'),
+            medium=versioned("x" * 40, '"m"'),
+            large=versioned("x" * 100, '"l"'),
+        )
+        client = make_client(session, ttl=60, max_bytes=64)
+        client.get("/small")
+        client.get("/medium")
+        assert client.stats()["bytes"] == 54
+        # Too large to cache at all, so nothing is evicted for it.
+        client.get("/large")
+        assert client.stats()["entries"] == 2
+        client.get("/medium", {"page": 2})
+        assert list(client._entries) == ["http://backend/medium?page=2"]
+        assert client.stats()["bytes"] == 42
+
+
+    def test_get_many_runs_calls_concurrently_in_order(self):
+        # Each answer waits for the other two calls to be in flight.
+        arrived = threading.Barrier(3, timeout=5)
+
+        def together(data):
+            def answer(url, headers):
+                arrived.wait()
+                return StubHTTPResponse(200, data, None)
+
+            return answer
+
+        session = StubSession(coins=together("coins"), duties=together("duties"), ksbs=together("ksbs"))
+        client = make_client(session, ttl=60, max_workers=3)
+        assert client.get_many("/coins", ("/duties", {"limit": 5}), "/ksbs") == ["coins", "duties", "ksbs"]
+        assert sorted(url for url, _ in session.calls) == [
+            "http://backend/coins", "http://backend/duties?limit=5", "http://backend/ksbs",
+        ]
+
+
+@pytest.fixture()
+def frontend(monkeypatch):
+    import app as frontend
+
+    graph = {
+        "coins": [{"id": "c1", "coin_name": "Coin one"}],
+        "duties": [{"id": "d1", "duty_name": "Duty one", "description": None}],
+        "ksbs": [],
+        "coins_duties": [("c1", "d1")],
+        "duties_ksbs": [],
+        "seq": 1,
+        "version": 1,
+    }
+    monkeypatch.setattr(frontend.graph_cache, "get", lambda: graph)
+    monkeypatch.setattr(frontend, "fragments", frontend.FragmentCache(max_entries=4))
+    return frontend
+
+
+class TestIndex:
+    def test_duty_panel_is_cached_for_known_duties(self, frontend):
+        client = frontend.app.test_client()
+        for _ in range(2):
+            page = client.get("/?duty_id=d1").get_data(as_text=True)
+            assert "Duty one" in page
+            assert "Coin one" in page
+        stats = frontend.fragments.stats()
+        assert (stats["entries"], stats["hits"]) == (2, 2)
+
+    def test_unknown_duty_ids_do_not_evict_the_coin_list(self, frontend):
+        client = frontend.app.test_client()
+        client.get("/")
+        for n in range(10):
+            assert client.get(f"/?duty_id=missing-{n}").status_code == 200
+        stats = frontend.fragments.stats()
+        assert stats["entries"] == 1
+        assert stats["evictions"] == 0
+        assert stats["hits"] == 10
@@ -36,6 +36,10 @@ def test_can_access_logs(admin):
     admin.goto(f"{BASE_URL}/logs")
     assert admin.url == f"{BASE_URL}/logs"
 
+def test_logs_show_backend_cache_stats(admin):
+    admin.goto(f"{BASE_URL}/logs")
+    assert admin.locator("th:has-text('hits')").count() > 0
+
 def test_can_logout(admin):
     admin.click("button:has-text('Logout')")
     assert admin.url == f"{BASE_URL}/login"
\ No newline at end of file